@@ -0,0 +1,149 @@
+"""Benchmark merge_pdfs: peak memory and time per page, against the previous PdfMerger approach.
+
+Each engine runs in its own Python process. Peak memory is reported as the peak Python heap
+(tracemalloc, which covers PyPDF2 since it is pure Python) and as the peak RSS of that process.
+
+Usage:
+    python benchmarks/bench_merge.py --chapters 30 --pages 4 --image-kb 1024
+    python benchmarks/bench_merge.py --folder Your_Book_Folder
+"""
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Code run in the child process: merge the files and report time and peak memory
+CHILD = """
+import json, os, resource, sys, time, tracemalloc
+sys.path.insert(0, {repo!r})
+import ebook_project
+from PyPDF2 import PdfMerger, PdfReader
+pdf_files = json.loads(sys.argv[1])
+tracemalloc.start()
+start = time.perf_counter()
+if sys.argv[3] == "pdfmerger":
+    # The previous implementation: every chapter appended to one PdfMerger, written at the end
+    merger = PdfMerger()
+    for pdf_file in pdf_files:
+        merger.append(pdf_file)
+    merger.write(sys.argv[2])
+    merger.close()
+else:
+    ebook_project.merge_pdfs(pdf_files, sys.argv[2], [os.path.basename(pdf_file) for pdf_file in pdf_files])
+seconds = time.perf_counter() - start
+heap_peak = tracemalloc.get_traced_memory()[1]
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+tracemalloc.stop()
+reader = PdfReader(sys.argv[2])
+print(json.dumps({{"seconds": seconds, "heap_peak": heap_peak, "peak_rss_kb": peak_rss, "pages": len(reader.pages), "outline_items": len(reader.outline)}}))
+"""
+
+
+# Function to write a small PDF whose pages draw a chapter image and a logo shared by every chapter
+def write_pdf(path, pages, image_data, logo_data, side, logo_side):
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    page_tree = add(None)
+    image = add(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray /BitsPerComponent 8 /Length %d >>\nstream\n" % (side, side, len(image_data)) + image_data + b"\nendstream")
+    logo = add(b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray /BitsPerComponent 8 /Length %d >>\nstream\n" % (logo_side, logo_side, len(logo_data)) + logo_data + b"\nendstream")
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_ids = []
+    for number in range(pages):
+        content = b"q 500 0 0 500 56 250 cm /Im1 Do Q q 60 0 0 60 56 770 cm /Logo Do Q BT /F1 18 Tf 56 200 Td (Page %d) Tj ET" % (number + 1)
+        content_id = add(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 842] /Contents %d 0 R "
+            b"/Resources << /XObject << /Im1 %d 0 R /Logo %d 0 R >> /Font << /F1 %d 0 R >> >> >>"
+            % (page_tree, content_id, image, logo, font)
+        ))
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % page_tree
+    objects[page_tree - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % page_id for page_id in page_ids), len(page_ids))
+
+    with open(path, "wb") as file:
+        file.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(file.tell())
+            file.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = file.tell()
+        file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            file.write(b"%010d 00000 n \n" % offset)
+        file.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref))
+
+
+# Function to create the synthetic chapter PDFs of an illustrated book
+def make_book(folder, chapters, pages, image_kb):
+    side = max(8, int((image_kb * 1024) ** 0.5))
+    logo_side = 64
+    logo_data = os.urandom(logo_side * logo_side)
+    pdf_files = []
+    for chapter in range(chapters):
+        pdf_file = os.path.join(folder, f"chapter_{chapter + 1:03d}.pdf")
+        write_pdf(pdf_file, pages, os.urandom(side * side), logo_data, side, logo_side)
+        pdf_files.append(pdf_file)
+    return pdf_files
+
+
+# Function to merge the files with one engine in a fresh process and collect its numbers
+def run_engine(engine, pdf_files, output_pdf):
+    env = dict(os.environ, RESPONSE_CACHE="0")
+    env.setdefault("OPENAI_API_KEY", "benchmark")
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD.format(repo=REPO_DIR), json.dumps(pdf_files), output_pdf, engine],
+        check=True, capture_output=True, text=True, env=env
+    )
+    numbers = json.loads(result.stdout.strip().splitlines()[-1])
+    return {
+        "engine": engine,
+        "files": len(pdf_files),
+        "pages": numbers["pages"],
+        "outline_items": numbers["outline_items"],
+        "seconds": round(numbers["seconds"], 3),
+        "ms_per_page": round(numbers["seconds"] * 1000 / max(1, numbers["pages"]), 3),
+        "peak_heap_mb": round(numbers["heap_peak"] / 1024 / 1024, 1),
+        "peak_rss_mb": round(numbers["peak_rss_kb"] / 1024, 1),
+        "input_mb": round(sum(os.path.getsize(pdf_file) for pdf_file in pdf_files) / 1024 / 1024, 1),
+        "output_mb": round(os.path.getsize(output_pdf) / 1024 / 1024, 1)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark peak memory and time per page of merge_pdfs.")
+    parser.add_argument("--folder", help="merge the PDFs of an existing book folder instead of synthetic ones")
+    parser.add_argument("--chapters", type=int, default=30, help="number of synthetic chapter PDFs (default: 30)")
+    parser.add_argument("--pages", type=int, default=4, help="pages per synthetic chapter (default: 4)")
+    parser.add_argument("--image-kb", type=int, default=1024, help="size of each synthetic chapter image in KB (default: 1024)")
+    parser.add_argument("--engines", default="streaming,pdfmerger", help="comma separated engines to compare: streaming (merge_pdfs) and pdfmerger")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        if args.folder:
+            pdf_files = sorted(glob.glob(os.path.join(args.folder, "*.pdf")))
+        else:
+            pdf_files = make_book(work_dir, args.chapters, args.pages, args.image_kb)
+
+        results = []
+        for engine in args.engines.split(","):
+            result = run_engine(engine, pdf_files, os.path.join(work_dir, f"merged_{engine}.pdf"))
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""Benchmark the whole book pipeline offline: wall time, peak memory, requests and tokens per stage.
+
+Every book size runs main(), from research to export, as a batch job in its own Python process. OpenAI and
+DALL-E 3 are answered by the mock backend and Tavily by a synthetic local corpus, each with a
+configurable latency, so no API key is needed. A response cache recorded by an earlier run can be
+replayed instead with --replay (use the same --topic as the recorded run).
+
+Stage wall times come from the metrics of the run. Peak memory is reported per stage as the peak
+Python heap (tracemalloc) and for the whole run as the peak RSS of the process.
+
+Usage:
+    python benchmarks/bench_pipeline.py --chapters 5,10,25,50,100 --output pipeline.json
+    python benchmarks/bench_pipeline.py --chapters 25 --latency 0.5 --tokens-per-second 80 --images
+    python benchmarks/bench_pipeline.py --baseline pipeline.json --tolerance 0.2
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Code run in the child process: generate and export one book and report its numbers per stage
+CHILD = """
+import contextlib, json, os, resource, sys, time, tracemalloc
+sys.path.insert(0, {repo!r})
+import ebook_project
+from ebook_project import metrics
+job = json.loads(sys.argv[1])
+
+# Peak Python heap of each stage: read and reset the peak whenever a new stage starts
+heap_peaks = {{}}
+current_stage = [None]
+set_labels = metrics.set_labels
+
+def measure_stage(**labels):
+    if "stage" in labels:
+        if current_stage[0] is not None:
+            heap_peaks[current_stage[0]] = max(heap_peaks.get(current_stage[0], 0), tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        current_stage[0] = labels["stage"]
+    set_labels(**labels)
+
+metrics.set_labels = measure_stage
+tracemalloc.start()
+start = time.perf_counter()
+with contextlib.redirect_stdout(open(os.devnull, "w")):
+    book, exported = ebook_project.main(job=job)
+seconds = time.perf_counter() - start
+heap_peaks[current_stage[0]] = max(heap_peaks.get(current_stage[0], 0), tracemalloc.get_traced_memory()[1])
+tracemalloc.stop()
+
+stages = {{}}
+for stage, row in metrics.summary(book.folder).items():
+    stages[stage] = dict(row, heap_peak=heap_peaks.get(stage, 0))
+print(json.dumps({{
+    "seconds": seconds,
+    "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "chapters": len(book.chapters),
+    "exported": exported,
+    "stages": stages
+}}))
+"""
+
+WORDS = (
+    "design brand market audience history method practice system quality impact growth modern example "
+    "principle industry school movement century shape colour typography layout product service user "
+    "research study evidence strategy culture story media digital print craft tool process team"
+).split()
+
+
+# Function to write a synthetic research corpus for the local Tavily stand-in
+def make_corpus(folder, documents, words_per_document, seed=0):
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    for number in range(documents):
+        title = " ".join(rng.choice(WORDS).title() for _ in range(4))
+        paragraphs = []
+        for _ in range(max(1, words_per_document // 80)):
+            paragraphs.append(" ".join(rng.choice(WORDS) for _ in range(80)).capitalize() + ".")
+        with open(os.path.join(folder, f"doc_{number:04d}.md"), "w") as file:
+            file.write(f"# {title}\n\n" + "\n\n".join(paragraphs) + "\n")
+
+
+# Function to run the pipeline for one book size in a fresh process and collect its numbers
+def run_book(chapters, args, work_dir, corpus):
+    env = dict(
+        os.environ,
+        MODEL_BACKEND=args.backend,
+        MOCK_LATENCY=str(args.latency),
+        MOCK_TOKENS_PER_SECOND=str(args.tokens_per_second),
+        MOCK_TOC_CHAPTERS=str(chapters),
+        TAVILY_LOCAL_CORPUS=corpus,
+        TAVILY_LOCAL_LATENCY=str(args.search_latency),
+        RESPONSE_CACHE="0"
+    )
+    if args.backend == "mock":
+        env.pop("OPENAI_API_KEY", None)
+    if args.replay:
+        # Replay a copy so the recorded cache is never changed
+        cache_path = os.path.join(work_dir, f"replay_{chapters}.sqlite")
+        shutil.copy(args.replay, cache_path)
+        env.update(RESPONSE_CACHE="1", RESPONSE_CACHE_PATH=cache_path)
+    job = {
+        "topic": args.topic,
+        "book_folder": os.path.join(work_dir, f"book_{chapters}"),
+        "resume": False,
+        "generate_images": args.images,
+        "pdf_generation_mode": args.pdf_mode,
+        "proofread": not args.no_proofread
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", CHILD.format(repo=REPO_DIR), json.dumps(job)],
+        check=True, capture_output=True, text=True, env=env, cwd=work_dir
+    )
+    numbers = json.loads(result.stdout.strip().splitlines()[-1])
+    stages = {
+        stage: {
+            "wall_s": round(row["wall_time"], 3),
+            "api_s": round(row["latency"], 3),
+            "requests": row["calls"],
+            "cached": row["cached"],
+            "prompt_tokens": row["prompt_tokens"],
+            "completion_tokens": row["completion_tokens"],
+            "peak_heap_mb": round(row["heap_peak"] / 1024 / 1024, 1)
+        }
+        for stage, row in numbers["stages"].items()
+    }
+    return {
+        "chapters": numbers["chapters"],
+        "seconds": round(numbers["seconds"], 3),
+        "peak_rss_mb": round(numbers["peak_rss_kb"] / 1024, 1),
+        "requests": sum(stage["requests"] for stage in stages.values()),
+        "prompt_tokens": sum(stage["prompt_tokens"] for stage in stages.values()),
+        "completion_tokens": sum(stage["completion_tokens"] for stage in stages.values()),
+        "exported": numbers["exported"],
+        "stages": stages
+    }
+
+
+# Function to list the totals and stages that got slower than the baseline by more than the tolerance
+def compare(results, baseline, tolerance):
+    previous = {result["chapters"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result["chapters"])
+        if old is None:
+            continue
+        pairs = [("total", old["seconds"], result["seconds"])]
+        pairs += [(stage, old["stages"][stage]["wall_s"], row["wall_s"]) for stage, row in result["stages"].items() if stage in old["stages"]]
+        for name, old_seconds, new_seconds in pairs:
+            # 50 ms of slack keeps the noise of short stages from counting as a regression
+            if new_seconds > old_seconds * (1 + tolerance) + 0.05:
+                regressions.append({"chapters": result["chapters"], "stage": name, "baseline_s": old_seconds, "seconds": new_seconds})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the book pipeline offline against simulated or recorded services.")
+    parser.add_argument("--chapters", default="5,10,25,50,100", help="comma separated book sizes in chapters (default: 5,10,25,50,100)")
+    parser.add_argument("--topic", default="Design Disruptors", help="topic of the benchmark books")
+    parser.add_argument("--backend", default="mock", help="model backend, mock by default; use openai with --replay")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the mock backend answers (default: 0.05)")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="mock streaming speed, 0 answers at once (default: 0)")
+    parser.add_argument("--search-latency", type=float, default=0.05, help="seconds each local Tavily search takes (default: 0.05)")
+    parser.add_argument("--corpus-documents", type=int, default=200, help="documents in the synthetic research corpus (default: 200)")
+    parser.add_argument("--corpus", help="search this folder of .md/.txt files instead of a synthetic corpus")
+    parser.add_argument("--replay", metavar="CACHE_DB", help="replay the responses recorded in this response cache")
+    parser.add_argument("--images", action="store_true", help="generate (mock) images and run the image stage")
+    parser.add_argument("--pdf-mode", default="Single long PDF", choices=["Single long PDF", "Chapter-broken PDF"], help="export mode")
+    parser.add_argument("--no-proofread", action="store_true", help="skip the proofreading stage")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results JSON of an earlier run; exit with status 1 if a stage got slower")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline (default: 0.2)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        corpus = args.corpus or os.path.join(work_dir, "corpus")
+        if not args.corpus:
+            make_corpus(corpus, args.corpus_documents, 600)
+
+        results = []
+        for chapters in [int(size) for size in args.chapters.split(",")]:
+            result = run_book(chapters, args, work_dir, corpus)
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(json.dumps({"regression": regression}))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
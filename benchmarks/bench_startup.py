@@ -0,0 +1,130 @@
+"""Benchmark the startup time of ebook_project and check that the folder commands stay light.
+
+Each command runs many times in a fresh Python process. The time of an empty Python process is
+subtracted, so the numbers are what ebook_project itself adds. The run also reports which heavy
+modules (openai, requests, PyPDF2, Pillow, tiktoken) each command loaded. It exits with status 1 if
+a median is over --target-ms, or a command that makes no API calls loaded openai or requests or
+created the response cache.
+
+The times depend on the machine: --help and stats run ebook_project.py as a script, so Python
+compiles the whole file on every run, and on a slow machine stats lands near the default 150 ms.
+Treat the target as a budget to tune per machine, and compare runs on the same machine.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --runs 20 --target-ms 150 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["openai", "requests", "PyPDF2", "PIL.Image", "tiktoken"]
+
+# Code run in the child process: run the command and report the heavy modules it loaded
+CHILD = """
+import atexit, contextlib, json, os, sys
+sys.path.insert(0, {repo!r})
+atexit.register(lambda: sys.__stderr__.write(json.dumps([name for name in {heavy!r} if name in sys.modules]) + "\\n"))
+sys.argv = ["ebook_project.py"] + json.loads(sys.argv[1])
+if sys.argv[1:] == ["import"]:
+    import ebook_project
+else:
+    import runpy
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        runpy.run_path(os.path.join({repo!r}, "ebook_project.py"), run_name="__main__")
+"""
+
+
+# Function to write a finished book folder with a manifest, chapters and a metrics report for the stats command
+def make_book(folder, chapters):
+    os.makedirs(folder, exist_ok=True)
+    toc = [f"CHAPTER {number:02d} - Startup Chapter {number}" for number in range(1, chapters + 1)]
+    stages = {stage: "done" for stage in ["research", "toc", "options", "chapter_research", "chapters", "proofreading", "export"]}
+    manifest = {"version": 1, "topic": "Startup Book", "toc": toc, "stages": stages, "options": {"generate_images": False, "pdf_generation_mode": "Single long PDF", "generation_mode": "Fast generation"}, "chapters": {}}
+    with open(os.path.join(folder, "manifest.json"), "w") as file:
+        json.dump(manifest, file)
+    row = {"calls": 1, "cached": 0, "prompt_tokens": 100, "completion_tokens": 100, "latency": 1.0, "wall_time": 1.0, "retries": 0, "cost": 0.01}
+    with open(os.path.join(folder, "metrics.json"), "w") as file:
+        json.dump({"totals": {"prompt_tokens": 100, "completion_tokens": 100, "cost": 0.01}, "stages": {"chapters": row}, "calls": []}, file)
+
+
+# Function to time one command in fresh processes, returning the times in ms and the heavy modules it loaded
+def time_command(arguments, runs, env, cwd):
+    times = []
+    loaded = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-c", CHILD.format(repo=REPO_DIR, heavy=HEAVY_MODULES), json.dumps(arguments)],
+            capture_output=True, text=True, env=env, cwd=cwd
+        )
+        times.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            raise SystemExit(f"{' '.join(arguments)} failed:\n{result.stderr}")
+        loaded = json.loads(result.stderr.strip().splitlines()[-1])
+    return times, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of ebook_project and its folder commands.")
+    parser.add_argument("--runs", type=int, default=10, help="fresh processes per command (default: 10)")
+    parser.add_argument("--chapters", type=int, default=25, help="chapters of the book folder used by stats (default: 25)")
+    parser.add_argument("--target-ms", type=float, default=150, help="allowed median startup time above an empty Python process (default: 150)")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    # The response cache stays on as in a normal run, none of these commands should open it
+    env = dict(os.environ)
+    env.pop("RESPONSE_CACHE", None)
+    env.pop("RESPONSE_CACHE_PATH", None)
+    with tempfile.TemporaryDirectory() as work_dir:
+        make_book(os.path.join(work_dir, "Startup_Book"), args.chapters)
+        commands = {
+            "import": ["import"],
+            "help": ["--help"],
+            "stats": ["stats", "Startup_Book"]
+        }
+        # An empty Python process, subtracted from every command
+        baseline_times = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "pass"], check=True, env=env)
+            baseline_times.append((time.perf_counter() - start) * 1000)
+        baseline = statistics.median(baseline_times)
+        print(json.dumps({"command": "python", "median_ms": round(baseline, 1)}))
+
+        results = []
+        failed = False
+        for name, arguments in commands.items():
+            times, loaded = time_command(arguments, args.runs, env, work_dir)
+            median = statistics.median(times) - baseline
+            result = {
+                "command": name,
+                "median_ms": round(median, 1),
+                "min_ms": round(min(times) - baseline, 1),
+                "max_ms": round(max(times) - baseline, 1),
+                "loaded": loaded,
+                "target_ms": args.target_ms
+            }
+            result["created_cache"] = os.path.exists(os.path.join(work_dir, ".ebook_cache"))
+            # None of these commands calls an API, so loading the API clients or opening the cache counts as a regression
+            result["ok"] = median <= args.target_ms and not {"openai", "requests"} & set(loaded) and not result["created_cache"]
+            failed = failed or not result["ok"]
+            results.append(result)
+            print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
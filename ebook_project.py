@@ -1,19 +1,92 @@
 import os
+import argparse
+import contextvars
+import csv
+import difflib
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import random
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import zlib
 from dotenv import load_dotenv
-import requests
+import importlib
+import importlib.util
 import textwrap
-import openai
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import ExitStack, contextmanager
 
-# Initialize cost tracking variables
-total_tokens = 0
-total_cost = 0.0
+
+class LazyModule:
+    """A module imported the first time one of its attributes is used."""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+# openai and requests take most of the startup time, so commands that make no API calls never load them;
+# tiktoken, Pillow and PyPDF2 are also only loaded when they are needed
+openai = LazyModule("openai")
+requests = LazyModule("requests")
+
+# tiktoken gives exact token counts; without it tokens are estimated from the text length
+tiktoken = LazyModule("tiktoken") if importlib.util.find_spec("tiktoken") else None
+
+# Pillow transcodes the generated images; without it the PNGs are exported as generated
+Image = LazyModule("PIL.Image") if importlib.util.find_spec("PIL") else None
+
+# Only needed for a Retry-After date and for the image transcode processes, which the folder commands never use
+email_utils = LazyModule("email.utils")
+multiprocessing = LazyModule("multiprocessing")
+process_pool = LazyModule("concurrent.futures.process")
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Read the OpenAI API key
+# Timeouts in seconds for every HTTP request, and how often a failed request is retried
+http_connect_timeout = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+http_read_timeout = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+api_max_retries = max(0, int(os.getenv("API_MAX_RETRIES", "5")))
+api_backoff_base = float(os.getenv("API_BACKOFF_BASE", "1"))
+api_backoff_max = float(os.getenv("API_BACKOFF_MAX", "60"))
+
+# Read the OpenAI API key; retries are done by call_with_retries so they are counted and share the backoff
 openai_api_key = os.getenv("OPENAI_API_KEY")
-client = openai.Client(api_key=openai_api_key)
+client = None
+client_lock = threading.Lock()
+
+
+# Function to create the OpenAI client on the first API call, None without an API key
+def get_client():
+    global client
+    with client_lock:
+        if client is None and openai_api_key:
+            client = openai.Client(api_key=openai_api_key, max_retries=0, timeout=openai.Timeout(http_read_timeout, connect=http_connect_timeout))
+        return client
+
+# Model backend used when a model has no "backend:" prefix: "openai", or "mock" for offline runs and load tests.
+# MODEL_TOC, MODEL_CHAPTER, MODEL_SUMMARY, MODEL_PROOFREAD, MODEL_REWRITE and MODEL_IMAGE choose the model of each task.
+model_backend = os.getenv("MODEL_BACKEND", "openai")
+
+# Latency in seconds before the first token, generation speed (0 means instant) and TOC length of the mock backend
+mock_latency = float(os.getenv("MOCK_LATENCY", "0.2"))
+mock_tokens_per_second = float(os.getenv("MOCK_TOKENS_PER_SECOND", "0"))
+mock_toc_chapters = int(os.getenv("MOCK_TOC_CHAPTERS", "5"))
 
 # Read the Tavily API key
 tavily_api_key = os.getenv("TAVILY_API_KEY")
@@ -21,18 +94,1380 @@ tavily_api_key = os.getenv("TAVILY_API_KEY")
 # Tavily and Crew.ai API configuration
 tavily_api_url = "https://api.tavily.com/search"
 
+# Number of chapters generated at the same time in "Fast generation" mode
+chapter_concurrency = max(1, int(os.getenv("CHAPTER_CONCURRENCY", "4")))
+
+# Number of DALL-E 3 images generated at the same time
+image_concurrency = max(1, int(os.getenv("IMAGE_CONCURRENCY", "3")))
+
+# Size of the sections the proofreader sends to the LLM, and of the digest of earlier chapters
+proofread_window_chars = int(os.getenv("PROOFREAD_WINDOW_CHARS", "12000"))
+proofread_digest_chars = int(os.getenv("PROOFREAD_DIGEST_CHARS", "16000"))
+
+# How chapter summaries for the image prompts are made: "inline" asks for the summary at the end of the chapter response,
+# "local" extracts key sentences from the chapter without an API call, "llm" makes a separate summary request
+summary_mode = os.getenv("SUMMARY_MODE", "inline")
+
+# Generated images are transcoded to IMAGE_FORMAT ("jpeg", "webp" or "png") in a print and a screen variant,
+# given as their longest side in pixels; IMAGE_EXPORT_VARIANT is the one embedded in the exported PDFs
+image_format = os.getenv("IMAGE_FORMAT", "jpeg").lower()
+image_quality = int(os.getenv("IMAGE_QUALITY", "85"))
+image_variant_sizes = {"print": int(os.getenv("IMAGE_PRINT_SIZE", "1024")), "screen": int(os.getenv("IMAGE_SCREEN_SIZE", "512"))}
+image_export_variant = os.getenv("IMAGE_EXPORT_VARIANT", "screen")
+image_workers = max(1, int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 2))))
+
+# Interactive runs write the first SPECULATIVE_CHAPTERS chapters of a TOC in the background while it is reviewed,
+# spending at most SPECULATIVE_MAX_COST USD on drafts that may be thrown away; 0 turns it off
+speculative_chapters = max(0, int(os.getenv("SPECULATIVE_CHAPTERS", "3")))
+speculative_max_cost = float(os.getenv("SPECULATIVE_MAX_COST", "0.25"))
+
+# Candidate drafts asked for by default when a chapter is compared in review mode, all returned by one request.
+# Each draft is paid for, so at most max_chapter_candidates are written
+max_chapter_candidates = 5
+chapter_candidates = min(max_chapter_candidates, max(2, int(os.getenv("CHAPTER_CANDIDATES", "3"))))
+
+# Timeline of the stages, chapters, API calls, images and PDFs of a run, saved as trace.json in the book folder (0 = off);
+# LOG_LEVEL=debug also prints the research data, prompts and rewritten passages
+trace_enabled = os.getenv("TRACE", "1") != "0"
+log_level = os.getenv("LOG_LEVEL", "info").upper()
+logger = logging.getLogger("ebook_project")
+
+# Number of markdown-pdf processes run at the same time when exporting
+pdf_concurrency = max(1, int(os.getenv("PDF_CONCURRENCY", str(os.cpu_count() or 2))))
+
+# Proofreading mode: "local" finds near-duplicate paragraphs offline and asks the LLM only about those,
+# "llm" sends every chapter section to the LLM
+proofread_mode = os.getenv("PROOFREAD_MODE", "local")
+near_duplicate_threshold = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.35"))
+
+# Per-chapter research: number of Tavily queries run at once, passages sent with each chapter and their size
+research_concurrency = max(1, int(os.getenv("RESEARCH_CONCURRENCY", "4")))
+research_top_k = max(1, int(os.getenv("RESEARCH_TOP_K", "6")))
+research_chunk_chars = int(os.getenv("RESEARCH_CHUNK_CHARS", "1000"))
+
+# Folder of .md/.txt files searched instead of Tavily, for offline runs and tests, and the simulated latency of a search
+tavily_local_corpus = os.getenv("TAVILY_LOCAL_CORPUS")
+tavily_local_latency = float(os.getenv("TAVILY_LOCAL_LATENCY", "0"))
+
+# Token and cost budget of one book, unset means no limit; batch jobs can set token_budget and cost_budget
+book_token_budget = int(os.getenv("BOOK_TOKEN_BUDGET", "0")) or None
+book_cost_budget = float(os.getenv("BOOK_COST_BUDGET", "0")) or None
+
+# Cap on requests in flight at once to each API, shared by every agent and every book in a batch
+max_inflight_requests = max(1, int(os.getenv("MAX_INFLIGHT_REQUESTS", "8")))
+
+# Response cache configuration, set RESPONSE_CACHE=0 to always call the APIs
+response_cache_enabled = os.getenv("RESPONSE_CACHE", "1") != "0"
+response_cache_path = os.getenv("RESPONSE_CACHE_PATH", os.path.join(".ebook_cache", "responses.sqlite"))
+response_cache_max_bytes = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+
+class AdaptiveLimiter:
+    """Cap on the requests in flight to one API that shrinks on rate limits and grows back as requests succeed."""
+
+    def __init__(self, name, max_limit):
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            tracer.counter(f"{self.name} requests", in_flight=self.in_flight, limit=self.limit)
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.condition:
+            self.in_flight -= 1
+            tracer.counter(f"{self.name} requests", in_flight=self.in_flight, limit=self.limit)
+            self.condition.notify_all()
+
+    def throttle(self, reason):
+        # Halve the cap on a rate limit
+        with self.condition:
+            if self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                print(f"{self.name} {reason}, allowing {self.limit} requests at once")
+            self.successes = 0
+
+    def observe(self, headers):
+        # Shrink when the rate-limit headers show the quota running out, grow by one after a run of successes
+        remaining_requests = header_number(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = header_number(headers, "x-ratelimit-remaining-tokens")
+        limit_tokens = header_number(headers, "x-ratelimit-limit-tokens")
+        if remaining_requests is not None and remaining_requests < self.limit:
+            self.throttle(f"has {int(remaining_requests)} requests left in this window")
+        elif remaining_tokens is not None and limit_tokens and remaining_tokens < limit_tokens * 0.1:
+            self.throttle(f"has {int(remaining_tokens)} tokens left in this window")
+        else:
+            with self.condition:
+                self.successes += 1
+                if self.limit < self.max_limit and self.successes >= self.limit * 4:
+                    self.limit += 1
+                    self.successes = 0
+                    self.condition.notify_all()
+
+
+openai_limit = AdaptiveLimiter("OpenAI", max_inflight_requests)
+tavily_limit = AdaptiveLimiter("Tavily", max_inflight_requests)
+
+# One pooled keep-alive session for Tavily and the image downloads, created on the first request
+http_session = None
+http_session_lock = threading.Lock()
+
+
+# Function to return the shared HTTP session
+def get_http_session():
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            http_session = requests.Session()
+            http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max_inflight_requests * 2))
+        return http_session
+
+
+http_timeout = (http_connect_timeout, http_read_timeout)
+
+retryable_status_codes = {408, 409, 429, 500, 502, 503, 504}
+
+
+# Function to read a numeric header, None if it is missing or not a number
+def header_number(headers, name):
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+# Function to choose how long to wait before a retry: the Retry-After header if the API sent one,
+# otherwise exponential backoff with full jitter
+def retry_delay(retries, headers):
+    retry_after_ms = header_number(headers, "retry-after-ms")
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000 + random.uniform(0, 0.5)
+    retry_after = headers.get("retry-after") if headers is not None else None
+    if retry_after:
+        seconds = header_number(headers, "retry-after")
+        if seconds is None:
+            try:
+                seconds = (email_utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                seconds = None
+        if seconds is not None:
+            return max(0.0, seconds) + random.uniform(0, 0.5)
+    return random.uniform(0, min(api_backoff_max, api_backoff_base * 2 ** retries))
+
+
+# Function to run an API request with retries on rate limits, server errors, timeouts and dropped connections;
+# returns the result and the number of retries
+def call_with_retries(request, description, limiter=None, acquire=True):
+    retries = 0
+    while True:
+        status_code = None
+        headers = {}
+        try:
+            if limiter is not None and acquire:
+                with limiter:
+                    result = request()
+            else:
+                result = request()
+            status_code = getattr(result, "status_code", None)
+            if status_code not in retryable_status_codes or retries >= api_max_retries:
+                if limiter is not None:
+                    limiter.observe(getattr(result, "headers", {}))
+                return result, retries
+            headers = result.headers
+            result.close()
+            reason = f"HTTP {status_code}"
+        except (openai.APIStatusError, openai.APIConnectionError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if isinstance(e, openai.APIStatusError):
+                status_code = e.status_code
+                headers = e.response.headers
+                if status_code not in retryable_status_codes:
+                    raise
+            if retries >= api_max_retries:
+                raise
+            reason = f"{type(e).__name__}: {e}"
+        if status_code == 429 and limiter is not None:
+            limiter.throttle("is rate limiting")
+        delay = retry_delay(retries, headers)
+        retries += 1
+        print(f"{description} failed ({reason}), retry {retries} of {api_max_retries} in {delay:.1f} seconds")
+        time.sleep(delay)
+
+
+class ResponseCache:
+    """Content-addressed SQLite cache for LLM, image and Tavily responses with LRU eviction."""
+
+    def __init__(self, path, max_bytes):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(kind, **params):
+        # Hash of the request kind, model, prompt/messages and parameters
+        payload = json.dumps({"kind": kind, **params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, value):
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.total_bytes -= row[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time())
+            )
+            self.total_bytes += len(value)
+            self.evict()
+            self.connection.commit()
+
+    def evict(self):
+        # Drop the least recently used entries until the cache fits in its size cap
+        while self.total_bytes > self.max_bytes:
+            rows = self.connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def get_json(self, key):
+        value = self.get(key)
+        return json.loads(zlib.decompress(value)) if value is not None else None
+
+    def put_json(self, key, data):
+        self.put(key, zlib.compress(json.dumps(data).encode("utf-8")))
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+# Function to open the response cache on the first lookup, None when the cache is turned off
+def get_response_cache():
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None and response_cache_enabled:
+            response_cache = ResponseCache(response_cache_path, response_cache_max_bytes)
+        return response_cache
+
+
+# Prices in USD: chat models per 1M prompt/completion tokens, DALL-E 3 per image, Tavily per search
+model_pricing = {
+    "gpt-4o": {"prompt": 2.50, "completion": 10.00},
+    "gpt-4o-mini": {"prompt": 0.15, "completion": 0.60},
+    "gpt-4-turbo": {"prompt": 10.00, "completion": 30.00},
+    "gpt-4": {"prompt": 30.00, "completion": 60.00},
+    "gpt-3.5-turbo": {"prompt": 0.50, "completion": 1.50},
+    "dall-e-3": {"standard": 0.040, "hd": 0.080},
+    "tavily": {"basic": 0.008, "advanced": 0.016}
+}
+# Context window of each chat model in tokens, prompt and completion together
+model_context = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385
+}
+
+# Context window of other models in tokens, as "model=tokens" pairs separated by commas
+for context in filter(None, os.getenv("MODEL_CONTEXT", "").split(",")):
+    context_model, _, context_tokens = context.strip().rpartition("=")
+    model_context[context_model] = int(context_tokens)
+
+# A JSON file with the same layout overrides or adds prices
+if os.getenv("PRICING_FILE"):
+    with open(os.getenv("PRICING_FILE"), "r") as file:
+        for model, prices in json.load(file).items():
+            model_pricing.setdefault(model, {}).update(prices)
+
+# Labels (book, stage, chapter) of the work running in the current thread, copied into worker threads
+metrics_labels = contextvars.ContextVar("metrics_labels", default={})
+
+
+class MetricsCollector:
+    """Thread-safe record of every API call with its stage, chapter, model, tokens, latency, retries and cost."""
+
+    fields = ["time", "book", "stage", "chapter", "kind", "backend", "model", "status", "prompt_tokens", "completion_tokens", "latency", "retries", "cost"]
+
+    def __init__(self, pricing):
+        self.pricing = pricing
+        self.records = []
+        self.budgets = {}
+        self.reserved = {}
+        self.stage_starts = {}
+        self.lock = threading.Lock()
+
+    def set_labels(self, **labels):
+        # Labels set here stay for the rest of the current thread or copied context
+        metrics_labels.set(dict(metrics_labels.get(), **labels))
+        # The start of a stage ends the previous stage of the same book, which gives the wall time of each stage
+        if "stage" in labels:
+            with self.lock:
+                self.stage_starts.setdefault(metrics_labels.get().get("book"), []).append((labels["stage"], time.perf_counter()))
+
+    def stage_spans(self, book=None):
+        # (book, stage, start, end) of every stage run, the stage running now ends now
+        now = time.perf_counter()
+        spans = []
+        with self.lock:
+            for stage_book, starts in self.stage_starts.items():
+                if book is not None and stage_book != book:
+                    continue
+                for (stage, start), (_, end) in zip(starts, starts[1:] + [(None, now)]):
+                    spans.append((stage_book, stage, start, end))
+        return spans
+
+    def stage_times(self, book=None):
+        # Wall time of each stage in seconds, the stage running now is counted until now
+        times = {}
+        for _, stage, start, end in self.stage_spans(book):
+            times[stage] = times.get(stage, 0.0) + end - start
+        return times
+
+    @contextmanager
+    def labels(self, **labels):
+        token = metrics_labels.set(dict(metrics_labels.get(), **labels))
+        try:
+            yield
+        finally:
+            metrics_labels.reset(token)
+
+    def price(self, kind, model, prompt_tokens=0, completion_tokens=0, units=1, tier=None):
+        prices = self.pricing.get(model)
+        if prices is None:
+            # Unknown models are priced like gpt-4o so the report still shows a cost
+            prices = self.pricing["gpt-4o"] if kind == "chat" else {}
+        if kind == "chat":
+            return (prompt_tokens * prices["prompt"] + completion_tokens * prices["completion"]) / 1000000
+        return units * prices.get(tier, 0.0)
+
+    def record(self, kind, model, prompt_tokens=0, completion_tokens=0, latency=0.0, retries=0, status="ok", units=1, tier=None, backend="openai", reservation=None, **labels):
+        labels = dict(metrics_labels.get(), **labels)
+        # Cached, local and failed calls are not billed
+        cost = self.price(kind, model, prompt_tokens, completion_tokens, units, tier) if status in ("ok", "aborted") else 0.0
+        record = {
+            "time": round(time.time(), 3),
+            "book": labels.get("book", ""),
+            "stage": labels.get("stage", ""),
+            "chapter": labels.get("chapter", ""),
+            "kind": kind,
+            "backend": backend,
+            "model": model,
+            "status": status,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "latency": round(latency, 3),
+            "retries": retries,
+            "cost": round(cost, 6)
+        }
+        # The actual cost replaces what check_budget reserved for this call
+        with self.lock:
+            self.records.append(record)
+            self.unreserve(reservation)
+        # Every API call is also a span of the trace, ending now
+        tracer.complete(f"{kind} {model}", latency, record)
+        return record
+
+    def set_budget(self, book, tokens=None, cost=None):
+        self.budgets[book] = {"tokens": tokens, "cost": cost}
+
+    def check_budget(self, kind, model, prompt_tokens=0, completion_tokens=0, tier=None):
+        # Refuse a call that could take the current book over its budget, before anything is sent
+        book = metrics_labels.get().get("book", "")
+        budget = self.budgets.get(book)
+        if budget is None:
+            return None
+        reservation = {"book": book, "tokens": prompt_tokens + completion_tokens, "cost": self.price(kind, model, prompt_tokens, completion_tokens, 1, tier)}
+        # Calls still running count with what they reserved, so calls checked at the same time cannot all pass on the same totals
+        with self.lock:
+            reserved = self.reserved.setdefault(book, {"tokens": 0, "cost": 0.0})
+            records = [record for record in self.records if record["book"] == book]
+            tokens = sum(record["prompt_tokens"] + record["completion_tokens"] for record in records) + reserved["tokens"] + reservation["tokens"]
+            cost = sum(record["cost"] for record in records) + reserved["cost"] + reservation["cost"]
+            if budget["tokens"] is not None and tokens > budget["tokens"]:
+                raise BudgetExceeded(f"The next {kind} call could bring '{book}' to {tokens} tokens, over its budget of {budget['tokens']}")
+            if budget["cost"] is not None and cost > budget["cost"]:
+                raise BudgetExceeded(f"The next {kind} call could bring '{book}' to ${cost:.4f}, over its budget of ${budget['cost']:g}")
+            reserved["tokens"] += reservation["tokens"]
+            reserved["cost"] += reservation["cost"]
+        return reservation
+
+    def release(self, reservation):
+        # Give back the reservation of a call that failed before it could be recorded
+        with self.lock:
+            self.unreserve(reservation)
+
+    def unreserve(self, reservation):
+        # Called with the lock held
+        if reservation is not None:
+            reserved = self.reserved[reservation["book"]]
+            reserved["tokens"] -= reservation["tokens"]
+            reserved["cost"] -= reservation["cost"]
+
+    def select(self, book=None):
+        with self.lock:
+            return [record for record in self.records if book is None or record["book"] == book]
+
+    def totals(self, book=None):
+        records = self.select(book)
+        return {
+            "calls": len(records),
+            "prompt_tokens": sum(record["prompt_tokens"] for record in records),
+            "completion_tokens": sum(record["completion_tokens"] for record in records),
+            "cost": round(sum(record["cost"] for record in records), 6)
+        }
+
+    def summary(self, book=None):
+        # Calls, cache hits, tokens, API time, wall time and cost per stage, in the order the stages ran
+        stages = {}
+        empty = {"calls": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency": 0.0, "wall_time": 0.0, "retries": 0, "cost": 0.0}
+        for record in self.select(book):
+            stage = stages.setdefault(record["stage"] or "other", dict(empty))
+            stage["calls"] += 1
+            stage["cached"] += record["status"] == "cached"
+            stage["prompt_tokens"] += record["prompt_tokens"]
+            stage["completion_tokens"] += record["completion_tokens"]
+            stage["latency"] += record["latency"]
+            stage["retries"] += record["retries"]
+            stage["cost"] += record["cost"]
+        # Stages without API calls, such as a local proofreading pass, still show their wall time
+        for stage, seconds in self.stage_times(book).items():
+            stages.setdefault(stage, dict(empty))["wall_time"] = seconds
+        return stages
+
+    def print_summary(self, book=None):
+        self.print_report(self.summary(book), self.totals(book))
+
+    @staticmethod
+    def print_report(stages, totals):
+        # Also prints the summary saved in a metrics.json report; reports from before wall times were measured show 0
+        print(f"{'Stage':<18}{'Calls':>7}{'Cached':>8}{'Prompt':>10}{'Completion':>12}{'API time':>10}{'Wall time':>11}{'Retries':>9}{'Cost':>10}")
+        for stage, row in stages.items():
+            print(f"{stage:<18}{row['calls']:>7}{row['cached']:>8}{row['prompt_tokens']:>10}{row['completion_tokens']:>12}{row['latency']:>9.1f}s{row.get('wall_time', 0.0):>10.1f}s{row['retries']:>9}{'$' + format(row['cost'], '.4f'):>10}")
+        print(f"Total tokens used: {totals['prompt_tokens'] + totals['completion_tokens']} ({totals['prompt_tokens']} prompt, {totals['completion_tokens']} completion)")
+        print(f"Total cost: ${totals['cost']:.4f}")
+
+    def save_report(self, path, book=None):
+        # path.json gets the totals, the per-stage summary and every call; path.csv gets one row per call
+        records = self.select(book)
+        with open(path + ".json", "w") as file:
+            json.dump({"totals": self.totals(book), "stages": self.summary(book), "calls": records}, file, indent=2)
+        with open(path + ".csv", "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=self.fields)
+            writer.writeheader()
+            writer.writerows(records)
+        return path + ".json", path + ".csv"
+
+
+metrics = MetricsCollector(model_pricing)
+
+
+class Tracer:
+    """Thread-safe timeline of the run as Chrome trace events, viewable in chrome://tracing or ui.perfetto.dev."""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.start = time.perf_counter()
+        self.events = []
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def timestamp(self, perf_time=None):
+        # Microseconds since the tracer was created
+        return ((perf_time if perf_time is not None else time.perf_counter()) - self.start) * 1000000
+
+    def add(self, event):
+        thread = threading.current_thread()
+        with self.lock:
+            event["tid"] = self.threads.setdefault((thread.ident, thread.name), len(self.threads) + 1)
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name, **args):
+        # A span labelled with the book, stage and chapter of the calling thread; the caller can add results to the args it gets
+        if not self.enabled:
+            yield args
+            return
+        labels = metrics_labels.get()
+        start = self.timestamp()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.add({"name": name, "cat": labels.get("stage") or "other", "ph": "X", "ts": start, "dur": self.timestamp() - start, "args": dict(labels, **args)})
+
+    def complete(self, name, seconds, args):
+        # A span that ended now and took seconds, for work timed by its caller
+        if self.enabled:
+            self.add({"name": name, "cat": args.get("stage") or "other", "ph": "X", "ts": self.timestamp() - seconds * 1000000, "dur": seconds * 1000000, "args": dict(args)})
+
+    def counter(self, name, **values):
+        # A value over time, such as the requests in flight to an API, shared by every book
+        if self.enabled:
+            self.add({"name": name, "ph": "C", "ts": self.timestamp(), "args": values})
+
+    def save(self, path, book=None):
+        # Each book is a process of the trace, with a track for its stages and one per thread; counters are process 0
+        with self.lock:
+            events = [dict(event) for event in self.events if book is None or event["ph"] == "C" or event["args"].get("book") == book]
+            threads = dict(self.threads)
+        books = {}
+        for event in events:
+            event["pid"] = 0 if event["ph"] == "C" else books.setdefault(event["args"].get("book") or None, len(books) + 1)
+        for stage_book, stage, start, end in metrics.stage_spans(book):
+            pid = books.setdefault(stage_book, len(books) + 1)
+            events.append({"name": stage, "cat": "stage", "ph": "X", "pid": pid, "tid": 0, "ts": self.timestamp(start), "dur": (end - start) * 1000000, "args": {"book": stage_book}})
+        metadata = [{"name": "process_name", "ph": "M", "pid": 0, "args": {"name": "API limits"}}]
+        for stage_book, pid in books.items():
+            metadata.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": stage_book or "run"}})
+            metadata.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "stages"}})
+        # Name the threads that ran work in each process
+        thread_names = {tid: thread_name for (_, thread_name), tid in threads.items()}
+        used_threads = sorted({(event["pid"], event["tid"]) for event in events if event["ph"] == "X" and event["tid"] in thread_names})
+        metadata += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_names[tid]}} for pid, tid in used_threads]
+        with open(path, "w") as file:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, file)
+        return path
+
+
+tracer = Tracer(trace_enabled)
+
+
+# Function to submit work to an executor with the metrics labels of the calling thread
+def submit_with_labels(executor, fn, *args, **kwargs):
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+class TaskGraph:
+    """Runs every task as soon as the tasks it waits for are finished, with a limit of running tasks per resource."""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.executors = {}
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, fn, *args, after=(), resource="llm", **kwargs):
+        # A task is added once per name, adding it again returns the first one
+        with self.lock:
+            if name in self.tasks:
+                return self.tasks[name]
+            task = self.tasks[name] = Future()
+            if resource not in self.executors:
+                self.executors[resource] = ThreadPoolExecutor(max_workers=self.limits[resource], thread_name_prefix=resource)
+            executor = self.executors[resource]
+        # The task runs with the metrics labels of the code that added it
+        context = contextvars.copy_context()
+        after = list(after)
+        remaining = [len(after)]
+        ready_at = [time.perf_counter()]
+
+        def run():
+            if any(dependency.cancelled() for dependency in after):
+                task.cancel()
+            if not task.set_running_or_notify_cancel():
+                return
+            # A task fails without running when a task it waits for failed
+            for dependency in after:
+                if dependency.exception() is not None:
+                    task.set_exception(dependency.exception())
+                    return
+            try:
+                task.set_result(context.run(self.run_task, name, resource, ready_at[0], fn, *args, **kwargs))
+            except BaseException as e:
+                task.set_exception(e)
+
+        def dependency_done(dependency):
+            with self.lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                ready_at[0] = time.perf_counter()
+                executor.submit(run)
+
+        for dependency in after:
+            dependency.add_done_callback(dependency_done)
+        if not after:
+            executor.submit(run)
+        return task
+
+    @staticmethod
+    def run_task(name, resource, ready_at, fn, *args, **kwargs):
+        # The trace shows how long each task waited for a free slot of its resource
+        with tracer.span(f"{resource} task", task=name, queued_ms=round((time.perf_counter() - ready_at) * 1000, 1)):
+            return fn(*args, **kwargs)
+
+    def cancel(self):
+        # Tasks that have not started are dropped, running tasks finish
+        with self.lock:
+            tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+
+    def close(self):
+        with self.lock:
+            executors = list(self.executors.values())
+            self.executors = {}
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+
+# Function to return a task graph with the limits of this run for LLM calls, image calls, PDF renders and image transcodes
+def book_task_graph():
+    return TaskGraph({"llm": chapter_concurrency, "image": image_concurrency * 2, "render": pdf_concurrency, "transcode": image_workers, "save": 1})
+
+
+# Raised before an API call that could take a book over its token or cost budget
+class BudgetExceeded(Exception):
+    pass
+
+
+# Raised before a chat call to a model whose context window is not known, so its prompts are never cut to a guessed size
+class UnknownContextWindow(Exception):
+    pass
+
+
+# Function to count the tokens of a text with the tokenizer of the model
+def count_tokens(text, model="gpt-4o"):
+    encoding = token_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1  # About four characters per token for English text
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+# Function to count the prompt tokens of chat messages, including the few tokens each message adds
+def count_message_tokens(messages, model="gpt-4o"):
+    return sum(count_tokens(message["content"], model) + 4 for message in messages) + 3
+
+
+token_encodings = {}
+
+
+# Function to load the tiktoken encoding of a model once
+def token_encoding(model):
+    if tiktoken is None:
+        return None
+    if model not in token_encodings:
+        try:
+            token_encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            token_encodings[model] = tiktoken.get_encoding("o200k_base")
+    return token_encodings[model]
+
+
+# Function to shorten a text to max_tokens, cutting from the middle so the instructions and the end are kept
+def truncate_to_tokens(text, max_tokens, model="gpt-4o"):
+    marker = "\n\n[...]\n\n"
+    encoding = token_encoding(model)
+    if encoding is None:
+        max_chars = max(0, max_tokens * 4 - len(marker))
+        if len(text) <= max_chars:
+            return text
+        return text[:max_chars // 2] + marker + text[len(text) - max_chars // 2:]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    keep = max(0, max_tokens - 8)
+    return encoding.decode(tokens[:keep // 2]) + marker + encoding.decode(tokens[len(tokens) - keep // 2:])
+
+
+# Function to make the messages fit the context window of the model, shortening the longest message
+def fit_messages(messages, max_tokens, model="gpt-4o"):
+    if model not in model_context:
+        raise UnknownContextWindow(f"The context window of {model} is not known, set it with MODEL_CONTEXT={model}=<tokens>")
+    context = model_context[model]
+    limit = context - max_tokens
+    prompt_tokens = count_message_tokens(messages, model)
+    if prompt_tokens <= limit:
+        return messages, prompt_tokens
+    longest = max(range(len(messages)), key=lambda index: len(messages[index]["content"]))
+    excess = prompt_tokens - limit
+    content = messages[longest]["content"]
+    print(f"Prompt of about {prompt_tokens} tokens does not fit the {context} token context of {model}, shortening it by {excess} tokens")
+    messages = list(messages)
+    messages[longest] = dict(messages[longest], content=truncate_to_tokens(content, count_tokens(content, model) - excess, model))
+    return messages, count_message_tokens(messages, model)
+
+
+class OpenAIBackend:
+    """Chat and image models served by the OpenAI API."""
+
+    name = "openai"
+
+    def __init__(self):
+        self.limiter = openai_limit
+
+    def check_client(self):
+        if get_client() is None:
+            raise openai.OpenAIError("OPENAI_API_KEY is not set, set it or use MODEL_BACKEND=mock")
+        return client
+
+    def chat(self, model, messages, max_tokens, task):
+        client = self.check_client()
+        raw_response, retries = call_with_retries(
+            lambda: client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens
+            ),
+            f"{model} request",
+            self.limiter
+        )
+        completion_response = raw_response.parse()
+        usage = completion_response.usage
+        return completion_response.choices[0].message.content.strip(), usage.prompt_tokens, usage.completion_tokens, retries
+
+    def chat_choices(self, model, messages, max_tokens, task, n):
+        # n samples of the same prompt in one request, the prompt is only paid for once
+        client = self.check_client()
+        raw_response, retries = call_with_retries(
+            lambda: client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                n=n
+            ),
+            f"{model} request",
+            self.limiter
+        )
+        completion_response = raw_response.parse()
+        usage = completion_response.usage
+        contents = [choice.message.content.strip() for choice in sorted(completion_response.choices, key=lambda choice: choice.index)]
+        return contents, usage.prompt_tokens, usage.completion_tokens, retries
+
+    def stream_chat(self, model, messages, max_tokens, task):
+        # Only opening the stream is retried, never a stream part way; the caller holds the limiter slot
+        client = self.check_client()
+        raw_response, retries = call_with_retries(
+            lambda: client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True}
+            ),
+            f"{model} request",
+            self.limiter,
+            acquire=False
+        )
+        return self.stream_events(raw_response.parse()), retries
+
+    def stream_events(self, stream):
+        # Closing the generator closes the connection, which stops the generation
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    yield {"usage": (chunk.usage.prompt_tokens, chunk.usage.completion_tokens)}
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield {"text": chunk.choices[0].delta.content}
+        finally:
+            stream.close()
+
+    def image(self, model, prompt, size, quality, style):
+        client = self.check_client()
+        raw_response, retries = call_with_retries(
+            lambda: client.images.with_raw_response.generate(
+                model=model,
+                prompt=prompt,
+                n=1,
+                size=size,
+                quality=quality,
+                style=style
+            ),
+            f"{model} request",
+            self.limiter
+        )
+        return {"url": raw_response.parse().data[0].url}, retries
+
+
+class MockBackend:
+    """Offline backend returning deterministic synthetic text and images, with a configurable latency."""
+
+    name = "mock"
+    words = (
+        "design people work idea product history world change simple form use new make time early modern "
+        "brand market company style material technology culture example study industry create build movement "
+        "shape color space user experience function value quality process practice method principle model "
+        "system project century school artist engineer invention impact growth trend audience story"
+    ).split()
+
+    def __init__(self, latency, tokens_per_second):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.limiter = AdaptiveLimiter("Mock", max_inflight_requests)
+
+    def chat(self, model, messages, max_tokens, task):
+        with self.limiter:
+            content = self.text(model, messages, max_tokens, task)
+            completion_tokens = count_tokens(content, model)
+            time.sleep(self.latency + (completion_tokens / self.tokens_per_second if self.tokens_per_second else 0))
+        return content, count_message_tokens(messages, model), completion_tokens, 0
+
+    def chat_choices(self, model, messages, max_tokens, task, n):
+        with self.limiter:
+            contents = [self.text(model, messages, max_tokens, task, choice) for choice in range(n)]
+            completion_tokens = [count_tokens(content, model) for content in contents]
+            time.sleep(self.latency + (max(completion_tokens) / self.tokens_per_second if self.tokens_per_second else 0))
+        return contents, count_message_tokens(messages, model), sum(completion_tokens), 0
+
+    def stream_chat(self, model, messages, max_tokens, task):
+        return self.stream_events(model, messages, max_tokens, task), 0
+
+    def stream_events(self, model, messages, max_tokens, task):
+        content = self.text(model, messages, max_tokens, task)
+        time.sleep(self.latency)
+        for piece in re.findall(r"\S+\s*|\s+", content):
+            if self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            yield {"text": piece}
+        yield {"usage": (count_message_tokens(messages, model), count_tokens(content, model))}
+
+    def text(self, model, messages, max_tokens, task, choice=0):
+        # The same messages always give the same answer, shaped like what each task expects; choice picks another sample
+        prompt = messages[-1]["content"]
+        rng = random.Random(hashlib.sha256(json.dumps([model, messages, max_tokens] + ([choice] if choice else [])).encode("utf-8")).hexdigest())
+        if task == "toc":
+            topic = re.search(r"ebook about (.+?) based on", prompt)
+            topic = topic.group(1) if topic else "the topic"
+            return "\n".join(f"CHAPTER {number:02d} - {topic} {rng.choice(self.words).title()} {rng.choice(self.words).title()}" for number in range(1, mock_toc_chapters + 1))
+        if task == "proofread":
+            return "NONE"
+        if task == "rewrite":
+            numbers = re.findall(r"Passage (\d+):", prompt)
+            return json.dumps({number: self.sentences(rng, 3) for number in numbers})
+        if task == "summary":
+            return self.sentences(rng, 2)
+        title = re.search(r"chapter called '(.+?)'", prompt)
+        lines = [f"# {title.group(1) if title else 'Chapter'}"]
+        # Chapters use about 80% of max_tokens, at roughly 4 tokens for 3 words
+        words = 0
+        while words < max_tokens * 0.6:
+            if rng.random() < 0.2:
+                lines.append(f"## {rng.choice(self.words).title()} and {rng.choice(self.words)}")
+            paragraph = self.sentences(rng, rng.randint(3, 6))
+            words += len(paragraph.split())
+            lines.append(paragraph)
+        if summary_marker in prompt:
+            lines.append(f"{summary_marker}\n{self.sentences(rng, 2)}")
+        return "\n\n".join(lines)
+
+    def sentences(self, rng, count):
+        return " ".join(" ".join(rng.choice(self.words) for _ in range(rng.randint(8, 16))).capitalize() + "." for _ in range(count))
+
+    def image(self, model, prompt, size, quality, style):
+        with self.limiter:
+            time.sleep(self.latency)
+            seed = hashlib.sha256(prompt.encode("utf-8")).digest()
+            width, height = (int(side) for side in size.split("x"))
+            return {"data": mock_png(width, height, seed)}, 0
+
+
+# Function to draw a deterministic gradient PNG from a seed, used by the mock backend
+def mock_png(width, height, seed):
+    # The first row is a colour gradient, every other row repeats it with the PNG "Up" filter
+    first_row = b"\x00" + bytes(value for x in range(width) for value in (seed[0], seed[1], (seed[2] + x) % 256))
+    rows = first_row + (b"\x02" + bytes(width * 3)) * (height - 1)
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+
+class ModelRouter:
+    """Picks the backend and model of each task, trying the fallbacks in order when one fails."""
+
+    defaults = {
+        "toc": "gpt-4o",
+        "chapter": "gpt-4o",
+        "summary": "gpt-4o-mini,gpt-4o",
+        "proofread": "gpt-4o",
+        "rewrite": "gpt-4o",
+        "image": "dall-e-3"
+    }
+
+    def __init__(self, backends, default_backend):
+        self.backends = backends
+        self.default_backend = default_backend
+        self.routes = {task: self.parse(os.getenv(f"MODEL_{task.upper()}", default)) for task, default in self.defaults.items()}
+
+    def parse(self, value):
+        # "gpt-4o-mini,gpt-4o" or "mock:gpt-4o": comma separated models, each with an optional backend prefix
+        routes = []
+        for spec in value.split(","):
+            backend_name, _, model = spec.strip().rpartition(":")
+            routes.append((self.backends[backend_name or self.default_backend], model))
+        return routes
+
+    def route(self, task):
+        return self.routes.get(task, self.routes["chapter"])
+
+    def primary_model(self, task):
+        return self.route(task)[0][1]
+
+    def run(self, task, call):
+        # call(backend, model) is tried with each model of the task until one succeeds
+        routes = self.route(task)
+        for number, (backend, model) in enumerate(routes):
+            try:
+                return call(backend, model)
+            except (openai.OpenAIError, requests.exceptions.RequestException) as e:
+                if number == len(routes) - 1:
+                    raise
+                next_backend, next_model = routes[number + 1]
+                print(f"{backend.name}:{model} failed for {task} ({type(e).__name__}: {e}), falling back to {next_backend.name}:{next_model}")
+
+
+model_router = ModelRouter({"openai": OpenAIBackend(), "mock": MockBackend(mock_latency, mock_tokens_per_second)}, model_backend)
+
+
+# Raised when the user stops a streamed completion with Ctrl+C, carrying the text received so far
+class GenerationAborted(Exception):
+    def __init__(self, partial_content):
+        super().__init__("Generation aborted by the user")
+        self.partial_content = partial_content
+
+
+# Function to call the chat model of a task through the response cache, falling back to the next model on failure
+def chat_completion(messages, max_tokens, task="chapter", fresh=False, on_token=None):
+    return model_router.run(task, lambda backend, model: backend_chat_completion(backend, model, messages, max_tokens, task, fresh, on_token))
+
+
+# Function to run one chat request on one backend and model
+def backend_chat_completion(backend, model, messages, max_tokens, task, fresh, on_token):
+    # fresh=True skips the cached answer so "Regenerate" still gets a new sample
+    key = ResponseCache.make_key("chat", model=model, messages=messages, max_tokens=max_tokens, **({"backend": backend.name} if backend.name != "openai" else {}))
+    cache = get_response_cache()
+    if cache is not None and not fresh:
+        cached = cache.get_json(key)
+        if cached is not None:
+            print("Using cached response, no tokens used")
+            metrics.record("chat", model, status="cached", backend=backend.name)
+            if on_token is not None:
+                on_token(cached["content"])
+            return cached["content"]
+
+    # Check the prompt size and the book budget locally, before the request is sent
+    messages, estimated_prompt_tokens = fit_messages(messages, max_tokens, model)
+    reservation = metrics.check_budget("chat", model, estimated_prompt_tokens, max_tokens)
+
+    start = time.perf_counter()
+    try:
+        if on_token is not None:
+            response_content, prompt_tokens, completion_tokens, retries = stream_chat_completion(backend, model, messages, max_tokens, task, on_token)
+        else:
+            response_content, prompt_tokens, completion_tokens, retries = backend.chat(model, messages, max_tokens, task)
+    except BaseException:
+        metrics.release(reservation)
+        raise
+
+    # Track the cost with the prices of the model that was called
+    record = metrics.record("chat", model, prompt_tokens, completion_tokens, latency=time.perf_counter() - start, retries=retries, backend=backend.name, reservation=reservation)
+    print(f"Tokens used: {prompt_tokens + completion_tokens} ({prompt_tokens} prompt, {completion_tokens} completion), Cost: ${record['cost']:.4f}")
+
+    if cache is not None:
+        cache.put_json(key, {"content": response_content, "tokens_used": prompt_tokens + completion_tokens})
+    return response_content
+
+
+# Function to ask the chat model of a task for n different answers to the same messages in one request
+def chat_completion_choices(messages, max_tokens, n, task="chapter"):
+    return model_router.run(task, lambda backend, model: backend_chat_choices(backend, model, messages, max_tokens, n, task))
+
+
+# Function to run one request for n answers on one backend and model, never cached since each call should give new samples
+def backend_chat_choices(backend, model, messages, max_tokens, n, task):
+    messages, estimated_prompt_tokens = fit_messages(messages, max_tokens, model)
+    reservation = metrics.check_budget("chat", model, estimated_prompt_tokens, max_tokens * n)
+
+    start = time.perf_counter()
+    try:
+        contents, prompt_tokens, completion_tokens, retries = backend.chat_choices(model, messages, max_tokens, task, n)
+    except BaseException:
+        metrics.release(reservation)
+        raise
+    record = metrics.record("chat", model, prompt_tokens, completion_tokens, latency=time.perf_counter() - start, retries=retries, backend=backend.name, reservation=reservation)
+    print(f"Tokens used: {prompt_tokens + completion_tokens} ({prompt_tokens} prompt, {completion_tokens} completion for {len(contents)} drafts), Cost: ${record['cost']:.4f}")
+    return contents
+
+
+# Function to stream a chat completion, passing each piece of text to on_token as it arrives
+def stream_chat_completion(backend, model, messages, max_tokens, task, on_token):
+    pieces = []
+    chunks = 0
+    usage = None
+    start = time.perf_counter()
+    first_token_at = None
+    # Estimate used when the backend sends no usage, as for an aborted stream
+    estimated_prompt_tokens = count_message_tokens(messages, model)
+    # The slot is held for the whole stream
+    events = None
+    retries = 0
+    with backend.limiter:
+        # Ctrl+C while the stream is opened or retried aborts the generation as well
+        try:
+            events, retries = backend.stream_chat(model, messages, max_tokens, task)
+            for event in events:
+                if "usage" in event:
+                    usage = event["usage"]
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                chunks += 1
+                pieces.append(event["text"])
+                on_token(event["text"])
+        except KeyboardInterrupt:
+            # Closing the connection stops the generation, so only the tokens received so far are billed
+            if events is not None:
+                events.close()
+            record = metrics.record("chat", model, estimated_prompt_tokens, chunks, latency=time.perf_counter() - start, retries=retries, status="aborted", backend=backend.name)
+            print(f"\nGeneration aborted after {chunks} tokens, about {estimated_prompt_tokens + chunks} tokens used, Cost: ${record['cost']:.4f}")
+            raise GenerationAborted("".join(pieces))
+    end = time.perf_counter()
+
+    # Report time to first token and generation speed; chunks are close to one token each
+    if first_token_at is not None:
+        tokens_per_second = chunks / max(end - first_token_at, 1e-6)
+        print(f"\nTime to first token: {first_token_at - start:.2f}s, {chunks} tokens at {tokens_per_second:.1f} tokens/s")
+    if usage is None:
+        return "".join(pieces).strip(), estimated_prompt_tokens, chunks, retries
+    return "".join(pieces).strip(), usage[0], usage[1], retries
+
+
+# Function to split text into sections of at most max_chars, on paragraph boundaries where possible
+def split_into_windows(text, max_chars):
+    windows = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            windows.append(current)
+            current = ""
+        while len(paragraph) > max_chars:
+            # A single paragraph longer than a window is cut into pieces
+            windows.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current.strip():
+        windows.append(current)
+    return windows
+
+
+# Function to build a compact outline of a chapter: its headings and the first sentence of each paragraph
+def chapter_digest(chapter, max_chars):
+    lines = [f"{chapter.title}:"]
+    for paragraph in chapter.content.split("\n\n"):
+        paragraph = paragraph.strip()
+        if not paragraph or paragraph.startswith("!["):
+            continue
+        if paragraph.startswith("#"):
+            lines.append(paragraph.splitlines()[0])
+        else:
+            lines.append("- " + paragraph.split(". ")[0][:200])
+    return "\n".join(lines)[:max_chars] + "\n\n"
+
+
+class NearDuplicateIndex:
+    """MinHash signatures of paragraph word shingles, bucketed with LSH to find near-duplicate passages."""
+
+    prime = (1 << 61) - 1
+
+    def __init__(self, num_perm=64, bands=32, shingle_size=3, min_words=12):
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_words = min_words
+        # Fixed seeds keep the signatures identical from run to run
+        rng = random.Random(42)
+        self.permutations = [(rng.randrange(1, self.prime), rng.randrange(0, self.prime)) for _ in range(num_perm)]
+        self.passages = []
+        self.buckets = {}
+
+    def shingles(self, text):
+        words = re.findall(r"\w+", text.lower())
+        if len(words) < self.min_words:
+            return set()
+        return {" ".join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, shingles):
+        hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingles]
+        return [min((a * h + b) % self.prime for h in hashes) for a, b in self.permutations]
+
+    def add(self, chapter_index, start, text):
+        shingles = self.shingles(text)
+        if not shingles:
+            return
+        signature = self.signature(shingles)
+        passage_index = len(self.passages)
+        self.passages.append({"chapter": chapter_index, "start": start, "text": text, "shingles": shingles})
+        for band in range(self.bands):
+            key = (band, tuple(signature[band * self.rows:(band + 1) * self.rows]))
+            self.buckets.setdefault(key, []).append(passage_index)
+
+    def add_chapter(self, chapter_index, content):
+        # Index every paragraph with its offset, skipping headings and images
+        for match in re.finditer(r"[^\n]+(?:\n(?!\n)[^\n]*)*", content):
+            text = match.group(0).strip()
+            if text and not text.startswith(("#", "![")):
+                self.add(chapter_index, match.start() + match.group(0).index(text), text)
+
+    def candidate_pairs(self, threshold):
+        # Passages sharing an LSH bucket are compared exactly with the Jaccard similarity of their shingles
+        seen = set()
+        pairs = []
+        for members in self.buckets.values():
+            for i, first in enumerate(members):
+                for second in members[i + 1:]:
+                    if (first, second) in seen:
+                        continue
+                    seen.add((first, second))
+                    a, b = self.passages[first], self.passages[second]
+                    similarity = len(a["shingles"] & b["shingles"]) / len(a["shingles"] | b["shingles"])
+                    if similarity >= threshold:
+                        pairs.append((similarity, a, b))
+        pairs.sort(key=lambda pair: (pair[2]["chapter"], pair[2]["start"]))
+        return pairs
+
+
+# Function to find passages that nearly repeat an earlier passage of the book
+def find_near_duplicates(chapters, threshold=None):
+    index = NearDuplicateIndex()
+    for chapter_index, chapter in enumerate(chapters):
+        index.add_chapter(chapter_index, chapter.content)
+    duplicates = []
+    for similarity, first, second in index.candidate_pairs(threshold if threshold is not None else near_duplicate_threshold):
+        duplicates.append({
+            "chapter": chapters[second["chapter"]].title,
+            "start": second["start"],
+            "passage": second["text"],
+            "original_chapter": chapters[first["chapter"]].title,
+            "original": first["text"],
+            "similarity": round(similarity, 3)
+        })
+    return duplicates
+
+
+class ResearchIndex:
+    """BM25 index over chunks of research documents, used to pick the passages relevant to one chapter."""
+
+    def __init__(self, chunk_chars=None, k1=1.5, b=0.75):
+        self.chunk_chars = chunk_chars or research_chunk_chars
+        self.k1 = k1
+        self.b = b
+        self.chunks = []
+        self.postings = {}
+        self.seen_urls = set()
+        self.seen_chunks = set()
+        self.total_length = 0
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"[a-z0-9]+", text.lower())
+
+    def add_document(self, document):
+        # The same page can come back for several queries, and the same passage from several pages
+        url = document.get("url", "")
+        if url and url in self.seen_urls:
+            return
+        self.seen_urls.add(url)
+        text = document.get("raw_content") or document.get("content") or ""
+        for chunk in split_into_windows(text, self.chunk_chars):
+            chunk = chunk.strip()
+            digest = hashlib.sha1(chunk.lower().encode("utf-8")).hexdigest()
+            terms = self.tokenize(chunk)
+            if not terms or digest in self.seen_chunks:
+                continue
+            self.seen_chunks.add(digest)
+            chunk_index = len(self.chunks)
+            self.chunks.append({"title": document.get("title", ""), "url": url, "content": chunk, "length": len(terms)})
+            self.total_length += len(terms)
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append((chunk_index, count))
+
+    def search(self, query, k):
+        if not self.chunks:
+            return []
+        average_length = self.total_length / len(self.chunks)
+        scores = {}
+        for term in set(self.tokenize(query)):
+            postings = self.postings.get(term, [])
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.chunks) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for chunk_index, count in postings:
+                length = self.chunks[chunk_index]["length"]
+                scores[chunk_index] = scores.get(chunk_index, 0.0) + idf * count * (self.k1 + 1) / (count + self.k1 * (1 - self.b + self.b * length / average_length))
+        best = sorted(scores, key=lambda chunk_index: (-scores[chunk_index], chunk_index))[:k]
+        return [dict(self.chunks[chunk_index], score=round(scores[chunk_index], 3)) for chunk_index in best]
+
+    def chapter_research(self, research_data, chapter_title, k=None):
+        # Only the topic, the overall answer and the top passages for this chapter are sent to the writer
+        query = f"{chapter_topic(chapter_title)} {research_data.get('query', '')}"
+        return {
+            "query": research_data.get("query", ""),
+            "answer": research_data.get("answer", ""),
+            "sources": [
+                {"title": chunk["title"], "url": chunk["url"], "content": chunk["content"]}
+                for chunk in self.search(query, k or research_top_k)
+            ]
+        }
+
+
+# Function to remove the "CHAPTER 01 - " prefix from a chapter title
+def chapter_topic(chapter_title):
+    return re.sub(r"^\W*chapter\s+\d+\s*[-–:.]*\s*", "", chapter_title, flags=re.IGNORECASE).strip()
+
+
+class LocalTavily:
+    """Stand-in for the Tavily search API over local documents, returning responses of the same shape."""
+
+    def __init__(self, documents, latency=0.0):
+        self.documents = documents
+        self.latency = latency
+        self.index = ResearchIndex()
+        for document in documents:
+            self.index.add_document(document)
+
+    @classmethod
+    def from_folder(cls, folder, latency=0.0):
+        documents = []
+        for file_name in sorted(os.listdir(folder)):
+            if file_name.endswith((".md", ".txt")):
+                with open(os.path.join(folder, file_name), "r") as file:
+                    content = file.read()
+                title = content.lstrip("# ").splitlines()[0] if content.strip() else file_name
+                documents.append({"title": title, "url": f"file://{os.path.abspath(os.path.join(folder, file_name))}", "content": content})
+        return cls(documents, latency)
+
+    def search(self, query, max_results=5, include_raw_content=False):
+        if self.latency:
+            time.sleep(self.latency)
+        documents = {document.get("url"): document for document in self.documents}
+        results = []
+        urls = set()
+        for chunk in self.index.search(query, max_results * 4):
+            if chunk["url"] in urls:
+                continue
+            urls.add(chunk["url"])
+            result = {"title": chunk["title"], "url": chunk["url"], "content": chunk["content"], "score": chunk["score"]}
+            if include_raw_content:
+                result["raw_content"] = documents[chunk["url"]]["content"]
+            results.append(result)
+            if len(results) == max_results:
+                break
+        return {
+            "query": query,
+            "answer": results[0]["content"][:500] if results else "",
+            "images": [],
+            "results": results,
+            "response_time": self.latency,
+            "follow_up_questions": []
+        }
+
+
+# Pillow format name and file extension of each image format
+image_formats = {"jpeg": ("JPEG", "jpg"), "webp": ("WEBP", "webp"), "png": ("PNG", "png")}
+
+
+# Function to return the path of an image variant, in the images folder next to the image
+def image_variant_path(image_path, variant):
+    folder, file_name = os.path.split(image_path)
+    return f"{folder}/images/{os.path.splitext(file_name)[0]}_{variant}.{image_formats[image_format][1]}"
+
+
+# Function to check that a file was made from the current version of another file
+def up_to_date(path, source_path):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source_path)
+
+
+# Function to transcode one image into its print and screen variants, run in a worker process
+def transcode_image(image_path, variant_paths, image_format, quality, sizes):
+    pillow_format = image_formats[image_format][0]
+    with Image.open(image_path) as image:
+        # JPEG has no alpha channel
+        image = image.convert("RGB") if pillow_format == "JPEG" else image.copy()
+        for variant, size in sizes.items():
+            variant_path = variant_paths[variant]
+            # Variants made from the same image by an earlier run are kept
+            if up_to_date(variant_path, image_path):
+                continue
+            os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.LANCZOS)
+            partial_path = variant_path + ".part"
+            resized.save(partial_path, format=pillow_format, quality=quality, optimize=True)
+            os.replace(partial_path, variant_path)
+    return variant_paths
+
+
+image_pool = None
+image_pool_lock = threading.Lock()
+
+
+# Function to return the process pool shared by every book for image transcoding
+def get_image_pool():
+    global image_pool
+    with image_pool_lock:
+        if image_pool is None:
+            # Spawned workers, because forking a process that runs books in threads is not safe
+            image_pool = process_pool.ProcessPoolExecutor(max_workers=image_workers, mp_context=multiprocessing.get_context("spawn"))
+        return image_pool
+
+
 # Custom Agent Classes
 
 class DesignerAgent:
-    def __init__(self):
+    def __init__(self, book_folder, tasks, manifest=None):
         self.name = "Designer"
         self.role = "Generate cover page design"
         self.goal = "Create a relevant, minimal, and beautiful cover page using DALL-E 3"
         self.backstory = "Creative designer with a knack for generating stunning visuals"
         self.verbose = True
-        self.llm = "dalle-3"
+        self.llm = model_router.primary_model("image")
         self.allow_delegation = True
         self.tools = ["advanced_llm", "image_generation"]
+        self.book_folder = book_folder
+        self.image_semaphore = threading.BoundedSemaphore(image_concurrency)
+        self.tasks = tasks
+        self.manifest = manifest
+        self.image_futures = {}
+        self.transcoded = {}
+        self.lock = threading.Lock()
 
     def generate_cover_prompt(self, book_title):
         prompt = f"Create an artwork design on subject '{book_title}'. The design should be minimal, beautiful, and relevant to the topic. The artwork should not be too imaginary. The artwork should not have actual book, book cover, book mockups and texts."
@@ -43,57 +1478,133 @@ class DesignerAgent:
         return prompt
 
 
-    def execute_task(self, book_title, toc, chapters):
-        print(f"\n{self.name} is executing the task: Generating cover page design\n")
-        cover_prompt = self.generate_cover_prompt(book_title)
-        print(f"Prompt for DALL-E 3: {cover_prompt}")
-
-        # Use DALL-E 3 to generate the cover page design
-        completion_response = client.images.generate(
-            model="dall-e-3",
-            prompt=cover_prompt,
-            n=1,
-            size="1024x1024",
-            quality="hd",
-            style="vivid"
-        )
+    def generate_image(self, prompt, image_path, chapter=""):
+        return model_router.run("image", lambda backend, model: self.generate_backend_image(backend, model, prompt, image_path, chapter))
 
+    def generate_backend_image(self, backend, model, prompt, image_path, chapter):
+        # Reuse an image generated earlier for the same prompt
+        cache_key = ResponseCache.make_key("image", model=model, prompt=prompt, size="1024x1024", quality="hd", style="vivid", **({"backend": backend.name} if backend.name != "openai" else {}))
+        cache = get_response_cache()
+        cached_image = cache.get(cache_key) if cache is not None else None
+        if cached_image is not None:
+            with open(image_path, "wb") as file:
+                file.write(cached_image)
+            metrics.record("image", model, status="cached", backend=backend.name, stage="images", chapter=chapter)
+            return True
 
-        # Save the generated image
-        image_url = completion_response.data[0].url
-        image_response = requests.get(image_url)
-        if image_response.status_code == 200:
-            with open(f"{book_folder}/cover_page.png", "wb") as file:
-                file.write(image_response.content)
-            print(f"Cover page design saved as {book_folder}/cover_page.png")
+        # Only a few image requests are in flight at once
+        reservation = metrics.check_budget("image", model, tier="hd")
+        start = time.perf_counter()
+        try:
+            with self.image_semaphore:
+                image, retries = backend.image(model, prompt, "1024x1024", "hd", "vivid")
+        except BaseException:
+            metrics.release(reservation)
+            raise
+        metrics.record("image", model, latency=time.perf_counter() - start, retries=retries, tier="hd", backend=backend.name, stage="images", chapter=chapter, reservation=reservation)
+
+        if "data" in image:
+            with open(image_path + ".part", "wb") as file:
+                file.write(image["data"])
+            os.replace(image_path + ".part", image_path)
+            saved = True
         else:
-            print("Failed to download the cover page design.")
-
-        # Generate prompts and images for each chapter
-        for chapter, summary in zip(chapters, chapter_summaries):
-            chapter_title = chapter['title']
-            chapter_prompt = self.generate_chapter_prompt(chapter_title, summary)
-            print(f"Prompt for DALL-E 3: {chapter_prompt}")
-
-            # Use DALL-E 3 to generate the chapter image
-            completion_response = client.images.generate(
-                model="dall-e-3",
-                prompt=chapter_prompt,
-                n=1,
-                size="1024x1024",
-                quality="hd",
-                style="vivid"
-            )
+            # Download outside the semaphore so the next image is generated while this one downloads
+            saved = self.download_image(image["url"], image_path)
+        if saved and cache is not None:
+            with open(image_path, "rb") as file:
+                cache.put(cache_key, file.read())
+        return saved
+
+    def download_image(self, image_url, image_path):
+        # Stream the image to disk in chunks instead of holding the whole PNG in memory
+        with tracer.span("image download", image_path=image_path):
+            image_response, retries = call_with_retries(lambda: get_http_session().get(image_url, stream=True, timeout=http_timeout), "Image download")
+            with image_response:
+                if image_response.status_code != 200:
+                    return False
+                partial_path = image_path + ".part"
+                with open(partial_path, "wb") as file:
+                    for chunk in image_response.iter_content(chunk_size=64 * 1024):
+                        file.write(chunk)
+                os.replace(partial_path, image_path)
+            return True
+
+    def save_image(self, prompt, image_path, chapter=""):
+        # An image saved by an earlier attempt of this run is not paid for again on --resume
+        if self.manifest is not None and self.manifest.image_done(image_path):
+            print(f"Image {image_path} was already generated")
+            return True
+        # The prompt of a chapter image is made when the task runs, from the summary its chapter task saved
+        prompt = prompt() if callable(prompt) else prompt
+        print(f"Prompt for DALL-E 3: {prompt}")
+        try:
+            saved = self.generate_image(prompt, image_path, chapter)
+        except (openai.OpenAIError, requests.exceptions.RequestException) as e:
+            print(f"Failed to generate the image {image_path}: {e}")
+            return False
+        if saved:
+            print(f"Image saved as {image_path}")
+            if self.manifest is not None:
+                self.manifest.mark_image(image_path)
+        else:
+            print(f"Failed to download the image {image_path}")
+        return saved
 
-            # Save the generated image
-            image_url = completion_response.data[0].url
-            image_response = requests.get(image_url)
-            if image_response.status_code == 200:
-                with open(f"{book_folder}/{chapter_title.replace(' ', '_')}_image.png", "wb") as file:
-                    file.write(image_response.content)
-                print(f"Chapter image saved as {book_folder}/{chapter_title.replace(' ', '_')}_image.png")
-            else:
-                print(f"Failed to download the image for chapter: {chapter_title}")
+    def submit_image(self, prompt, image_path, chapter="", after=()):
+        # Generate an image once per path, as soon as the tasks it waits for are done
+        with self.lock:
+            self.image_futures[image_path] = self.tasks.add(f"image:{image_path}", self.save_image, prompt, image_path, chapter, after=after, resource="image")
+            return self.image_futures[image_path]
+
+    def submit_cover_image(self, book_title):
+        return self.submit_image(self.generate_cover_prompt(book_title), f"{self.book_folder}/cover_page.png", "Cover")
+
+    def submit_chapter_image(self, chapter, after=()):
+        return self.submit_image(lambda: self.generate_chapter_prompt(chapter.title, chapter.summary), chapter.image_path, chapter.title, after)
+
+    def execute_task(self, book_title, chapters):
+        print(f"\n{self.name} is executing the task: Generating cover page design\n")
+
+        # Images already started during chapter generation are not requested again, and none is waited for here
+        self.submit_cover_image(book_title)
+        for chapter in chapters:
+            self.submit_chapter_image(chapter)
+
+    def wait_images(self):
+        with self.lock:
+            futures = list(self.image_futures.values())
+        return all([future.result() for future in futures])
+
+    def submit_variants(self, image_path):
+        # Transcode an image as soon as it is saved
+        with self.lock:
+            after = [self.image_futures[image_path]] if image_path in self.image_futures else []
+        return self.tasks.add(f"variants:{image_path}", self.transcode, image_path, after=after, resource="transcode")
+
+    def transcode(self, image_path):
+        # Transcode the image into print and screen variants in a worker process, an identical image only once
+        if not os.path.exists(image_path):
+            return {}
+        variant_paths = {variant: image_variant_path(image_path, variant) for variant in image_variant_sizes}
+        with open(image_path, "rb") as file:
+            image_hash = hashlib.sha256(file.read()).hexdigest()
+        with self.lock:
+            first_paths = self.transcoded.get(image_hash)
+            if first_paths is None:
+                self.transcoded[image_hash] = (variant_paths, get_image_pool().submit(transcode_image, image_path, variant_paths, image_format, image_quality, image_variant_sizes))
+            first_paths, future = self.transcoded[image_hash]
+        future.result()
+        # An identical image gets links to the variants of the first one
+        for variant, variant_path in variant_paths.items():
+            if variant_path != first_paths[variant] and not up_to_date(variant_path, image_path):
+                if os.path.exists(variant_path):
+                    os.remove(variant_path)
+                try:
+                    os.link(first_paths[variant], variant_path)
+                except OSError:
+                    shutil.copyfile(first_paths[variant], variant_path)
+        return variant_paths
 
 class ProofreaderAgent:
     def __init__(self):
@@ -102,48 +1613,128 @@ class ProofreaderAgent:
         self.goal = "Ensure no repeated content across chapters"
         self.backstory = "Expert in proofreading and content analysis"
         self.verbose = True
-        self.llm = "gpt-4o"
+        self.llm = model_router.primary_model("proofread")
         self.allow_delegation = True
         self.tools = ["advanced_llm", "text_analysis"]
+        # Findings per (chapter title, section hash), so later passes only re-check the chapters that changed
+        self.analysis_cache = {}
+        self.duplicate_passages = []
 
-    def execute_task(self, chapters):
-        print(f"\n{self.name} is executing the task: Analyzing chapters for repeated content\n")
-        # Combine all chapters into a single text for analysis, excluding book title and chapter titles
-        combined_text = "\n\n".join([chapter['content'] for chapter in chapters])
-        
+    def analyze_section(self, chapter_title, section, digest):
         # Formulate the prompt for the LLM
         prompt = (
-            "Analyze the following ebook content and identify any content that are repeated multiple times, making the book appear unprofessional and repetitive. Ignore the book title, chapter titles, and repetitive titles, however the actual content should not be repeated. Provide a list of such repeated topics or headings:\n\n"
-            f"{combined_text}"
+            f"The following is a section of the chapter '{chapter_title}' of an ebook. Identify any content in this section that repeats content already covered by the earlier chapters, summarized in the digest below, or repeats content within this section, making the book appear unprofessional and repetitive. Ignore the book title, chapter titles, and repetitive titles, however the actual content should not be repeated. Copy each repeated passage exactly as it is written in the section, one per line, without numbering or comments. If nothing is repeated, answer NONE.\n\n"
+            f"Digest of the earlier chapters:\n{digest or 'This is the first chapter.'}\n\n"
+            f"Section:\n{section}"
         )
-        
+
         # Use the LLM to analyze the content
-        completion_response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
+        repeated_content_feedback = chat_completion(
+            [
                 {"role": "system", "content": "You are a helpful assistant."},
                 {"role": "user", "content": prompt}
             ],
-            max_tokens=4000
+            max_tokens=1000,
+            task="proofread"
+        )
+        print(f"LLM Feedback on repeated content in {chapter_title}:\n{repeated_content_feedback}")
+
+        # Keep only passages that really occur in the section, so they can be found and rewritten later
+        findings = []
+        for line in repeated_content_feedback.split('\n'):
+            line = line.strip().lstrip("-*").strip().strip('"')
+            if line and line != "NONE" and line in section:
+                findings.append(line)
+        return findings
+
+    def confirm_duplicates(self, duplicates):
+        # Ask the LLM about a batch of numbered passage pairs and keep the ones it confirms
+        pairs = "\n\n".join(
+            f"Pair {number}:\nA ({duplicate['original_chapter']}): {duplicate['original']}\nB ({duplicate['chapter']}): {duplicate['passage']}"
+            for number, duplicate in enumerate(duplicates, start=1)
         )
-        
-        # Track the cost for GPT-4 API call
-        tokens_used = completion_response.usage.total_tokens
-        cost = tokens_used * 0.03 / 1000  # Assuming $0.03 per 1,000 tokens for GPT-4
-        global total_tokens, total_cost
-        total_tokens += tokens_used
-        total_cost += cost
-
-        print(f"Tokens used: {tokens_used}, Cost: ${cost:.4f}")
-
-        # Process the LLM's feedback
-        repeated_content_feedback = completion_response.choices[0].message.content.strip()
-        print(f"LLM Feedback on repeated content:\n{repeated_content_feedback}")
-        
-        # Extract repeated topics or headings from the LLM's feedback
-        # Extract repeated topics or headings from the LLM's feedback
-        repeated_content = [line.strip() for line in repeated_content_feedback.split('\n') if line.strip()]
+        prompt = (
+            "Each of the following pairs holds two passages from different places of an ebook. For each pair, decide whether passage B repeats the content of passage A, making the book appear unprofessional and repetitive. Answer only with the numbers of the pairs that are repeated, separated by commas, or NONE.\n\n"
+            f"{pairs}"
+        )
+        answer = chat_completion(
+            [
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=200,
+            task="proofread"
+        )
+        numbers = {int(number) for number in re.findall(r"\d+", answer)}
+        return [duplicate for number, duplicate in enumerate(duplicates, start=1) if number in numbers]
+
+    def find_repeated_passages(self, chapters):
+        # Near-duplicate paragraphs are found locally; only uncertain ones are sent to the LLM
+        duplicates = find_near_duplicates(chapters)
+        print(f"Found {len(duplicates)} near-duplicate passages across chapters")
+        confirmed = [duplicate for duplicate in duplicates if duplicate["similarity"] >= 0.8]
+        uncertain = [duplicate for duplicate in duplicates if duplicate["similarity"] < 0.8]
+
+        # Batch the uncertain pairs into bounded-size requests, each batch cached by its content
+        batches = []
+        for duplicate in uncertain:
+            size = len(duplicate["original"]) + len(duplicate["passage"])
+            if not batches or batches[-1][0] + size > proofread_window_chars:
+                batches.append([0, []])
+            batches[-1][0] += size
+            batches[-1][1].append(duplicate)
+        for size, batch in batches:
+            key = RunManifest.content_hash(json.dumps(batch, sort_keys=True))
+            if key not in self.analysis_cache:
+                self.analysis_cache[key] = self.confirm_duplicates(batch)
+            confirmed.extend(self.analysis_cache[key])
+
+        # A passage that repeats several earlier passages is reported once, in book order
+        titles = [chapter.title for chapter in chapters]
+        self.duplicate_passages = []
+        for duplicate in sorted(confirmed, key=lambda duplicate: (titles.index(duplicate["chapter"]), duplicate["start"])):
+            if not any(d["chapter"] == duplicate["chapter"] and d["start"] == duplicate["start"] for d in self.duplicate_passages):
+                self.duplicate_passages.append(duplicate)
+        repeated_content = []
+        for duplicate in self.duplicate_passages:
+            print(f"Repeated in {duplicate['chapter']} (similarity {duplicate['similarity']}): {duplicate['passage'][:80]}")
+            if duplicate["passage"] not in repeated_content:
+                repeated_content.append(duplicate["passage"])
         return repeated_content
+
+    def execute_task(self, chapters):
+        print(f"\n{self.name} is executing the task: Analyzing chapters for repeated content\n")
+        if proofread_mode == "local":
+            return self.find_repeated_passages(chapters)
+
+        # Check each chapter in bounded-size sections against a running digest of the chapters before it
+        digest_chars = max(200, proofread_digest_chars // max(1, len(chapters)))
+        sections = []
+        digest = ""
+        for chapter in chapters:
+            for section in split_into_windows(chapter.content, proofread_window_chars):
+                key = (chapter.title, RunManifest.content_hash(section))
+                sections.append((chapter.title, section, digest, key))
+            digest += chapter_digest(chapter, digest_chars)
+
+        # Only sections whose own text changed are sent to the LLM again, checked against the current digest.
+        # An edit to one chapter does not make every later chapter count as changed.
+        pending = {key: (title, section, preceding) for title, section, preceding, key in sections if key not in self.analysis_cache}
+        print(f"Analyzing {len(pending)} of {len(sections)} sections, the rest are unchanged since the last pass")
+        with ThreadPoolExecutor(max_workers=chapter_concurrency) as executor:
+            futures = {key: submit_with_labels(executor, self.analyze_section, *job) for key, job in pending.items()}
+            for key, future in futures.items():
+                self.analysis_cache[key] = future.result()
+
+        # Extract repeated passages in book order
+        repeated_content = []
+        for title, section, preceding, key in sections:
+            for finding in self.analysis_cache[key]:
+                if finding not in repeated_content:
+                    repeated_content.append(finding)
+        return repeated_content
+
+
 class ResearcherAgent:
     def __init__(self, tavily_api_key):
         self.name = "Researcher"
@@ -155,29 +1746,88 @@ class ResearcherAgent:
         self.allow_delegation = True
         self.tools = ["advanced_llm", "web_access", "pdf_reader", "image_reader", "tavily_api"]
         self.tavily_api_key = tavily_api_key
+        self.local_search = LocalTavily.from_folder(tavily_local_corpus, tavily_local_latency) if tavily_local_corpus else None
 
     def execute_task(self, task):
         print(f"\n  \n{self.name} is executing the task: \n{task} \n  \n ")
         try:
-            # Use Tavily API to gather information
-            tavily_response = requests.post(
-                tavily_api_url,
-                headers={"Content-Type": "application/json"},
-                json={"query": task, "api_key": self.tavily_api_key}
-            )
-            
-            if tavily_response.status_code == 200:
-                tavily_data = tavily_response.json()
-                
+            tavily_data = self.search(task)
+            if tavily_data is not None:
                 # Validate data
                 research_data = self.validate_data(tavily_data)
-                print(research_data)
+                print(f"Found {len(research_data['results'])} results for {task}")
+                logger.debug("Research data: %s", research_data)
                 return research_data
             else:
                 return f"Failed to gather information for {task}"
         except requests.exceptions.RequestException as e:
             return f"Error during API request: {e}"
-    
+
+    def search(self, query, **options):
+        # Offline runs and tests search the local corpus instead of Tavily
+        if self.local_search is not None:
+            start = time.perf_counter()
+            tavily_data = self.local_search.search(query, **options)
+            metrics.record("search", "tavily", latency=time.perf_counter() - start, status="local", backend="tavily")
+            return tavily_data
+        # Reuse an earlier Tavily answer for the same query
+        cache_key = ResponseCache.make_key("tavily", query=query, **options)
+        cache = get_response_cache()
+        tavily_data = cache.get_json(cache_key) if cache is not None else None
+        if tavily_data is not None:
+            metrics.record("search", "tavily", status="cached", backend="tavily")
+        else:
+            # Use Tavily API to gather information
+            start = time.perf_counter()
+            tavily_response, retries = call_with_retries(
+                lambda: get_http_session().post(
+                    tavily_api_url,
+                    headers={"Content-Type": "application/json"},
+                    json=dict(options, query=query, api_key=self.tavily_api_key),
+                    timeout=http_timeout
+                ),
+                "Tavily search",
+                tavily_limit
+            )
+            metrics.record("search", "tavily", latency=time.perf_counter() - start, retries=retries, tier=options.get("search_depth", "basic"), status="ok" if tavily_response.status_code == 200 else f"http_{tavily_response.status_code}", backend="tavily")
+            if tavily_response.status_code == 200:
+                tavily_data = tavily_response.json()
+                if cache is not None:
+                    cache.put_json(cache_key, tavily_data)
+        return tavily_data
+
+    # Search every chapter title at the same time and return the unique result pages
+    def research_chapters(self, topic, chapter_titles, max_workers=None):
+        queries = [f"{topic}: {chapter_topic(chapter_title)}" for chapter_title in chapter_titles]
+        documents = []
+        urls = set()
+        with ThreadPoolExecutor(max_workers=max_workers or research_concurrency) as executor:
+            # Results are read in TOC order, so the documents and their order do not depend on timing
+            futures = [submit_with_labels(executor, self.search_chapter, query) for query in queries]
+            for query, tavily_data in zip(queries, (future.result() for future in futures)):
+                if tavily_data is None:
+                    print(f"Failed to gather information for {query}")
+                    continue
+                for result in tavily_data.get("results", []):
+                    if result.get("url") in urls:
+                        continue
+                    urls.add(result.get("url"))
+                    documents.append({
+                        "title": result.get("title", ""),
+                        "url": result.get("url", ""),
+                        # Raw page text is capped so the manifest stays small
+                        "content": (result.get("raw_content") or result.get("content") or "")[:20000]
+                    })
+        print(f"Gathered {len(documents)} research pages for {len(chapter_titles)} chapters.")
+        return documents
+
+    def search_chapter(self, query):
+        try:
+            return self.search(query, max_results=5, include_raw_content=True)
+        except requests.exceptions.RequestException as e:
+            print(f"Error during API request for {query}: {e}")
+            return None
+
     def validate_data(self, tavily_data):
         # Implement validation logic
         # For simplicity, we assume the data source returns a list of information
@@ -201,34 +1851,27 @@ class ContentOrganizerAgent:
         self.goal = "Create a logical flow and structure for the ebook"
         self.backstory = "Skilled in organizing information and creating outlines"
         self.verbose = True
-        self.llm = "gpt-4o"
+        self.llm = model_router.primary_model("toc")
         self.allow_delegation = True
         self.tools = ["advanced_llm", "text_structuring", "rag"]
 
-    def execute_task(self, task):
-        print(f" \n  \n{self.name} is executing the task: \n{task} \n  \n ")
+    def execute_task(self, task, fresh=False, on_token=None):
+        print(f" \n  \n{self.name} is executing the task: Creating the table of contents for {task['query']} \n  \n ")
+        logger.debug("Task of the %s with its research data: %s", self.name, task)
         try:
             # Process research data to generate TOC
             research_summary = "\n".join([f"{key}: {value}" for key, value in task.items() if key in ["answer", "query", "results"]])
             toc_task = f"Create a TOC for an ebook about {task['query']} based on the following research data:\n{research_summary}. \n \nTable of contents should only have chapters, but no sub chapters or sections. Table of content should be systematic, should have high level topics and gradually increase the depth on the topic rather than a random list. Chapters should have CHAPTER 01 - Chapter name, CHAPTER 02 - Chapter name and so on as prefix. Do not include the text Table of contents as a chapter. Do not generate prefatory or introductory statements. Just show the output."
-            completion_response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
+            response_content = chat_completion(
+                [
                     {"role": "system", "content": "You are a helpful assistant."},
                     {"role": "user", "content": toc_task}
                 ],
-                max_tokens=1200
+                max_tokens=1200,
+                task="toc",
+                fresh=fresh,
+                on_token=on_token
             )
-            response_content = completion_response.choices[0].message.content.strip()
-
-            # Track the cost for GPT-4 API call
-            tokens_used = completion_response.usage.total_tokens
-            cost = tokens_used * 0.03 / 1000  # Assuming $0.03 per 1,000 tokens for GPT-4
-            global total_tokens, total_cost
-            total_tokens += tokens_used
-            total_cost += cost
-
-            print(f"Tokens used: {tokens_used}, Cost: ${cost:.4f}")
 
             return response_content
         except requests.exceptions.RequestException as e:
@@ -242,33 +1885,264 @@ class WriterAgent:
         self.goal = "Write detailed and engaging content for each chapter"
         self.backstory = "Experienced writer with a flair for creating informative and captivating content"
         self.verbose = True
-        self.llm = "gpt-4o"
+        self.llm = model_router.primary_model("chapter")
         self.allow_delegation = True
         self.tools = ["advanced_llm", "text_writer"]
+        self.max_tokens = 1200
     
-    def execute_task(self, task, research_data):
-        # Simulate task execution with research data
-        print(f" \n  \n{self.name} is executing the task: \n{task} \n  \n ")
-        completion_response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": f"{task} based on the following research data: {research_data}"}
-            ],
-            max_tokens=1200
+    def messages(self, task, research_data):
+        return [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": f"{task} based on the following research data: {research_data}" if research_data is not None else task}
+        ]
+
+    def execute_task(self, task, research_data, fresh=False, on_token=None, kind="chapter", max_tokens=None):
+        # Simulate task execution with research data; kind picks the model (chapter, summary or rewrite)
+        print(f" \n  \n{self.name} is executing the task: \n{textwrap.shorten(task, 160)} \n  \n ")
+        logger.debug("Full task of the %s: %s", self.name, task)
+        response_content = chat_completion(
+            self.messages(task, research_data),
+            max_tokens=max_tokens or self.max_tokens,
+            task=kind,
+            fresh=fresh,
+            on_token=on_token
         )
-        response_content = completion_response.choices[0].message.content.strip()
+        return response_content
 
-        # Track the cost for GPT-4 API call
-        tokens_used = completion_response.usage.total_tokens
-        cost = tokens_used * 0.03 / 1000  # Assuming $0.03 per 1,000 tokens for GPT-4
-        global total_tokens, total_cost
-        total_tokens += tokens_used
-        total_cost += cost
+    def execute_choices(self, task, research_data, n, kind="chapter", max_tokens=None):
+        # n different drafts of the same task, sharing one prompt
+        print(f" \n  \n{self.name} is writing {n} drafts for the task: \n{textwrap.shorten(task, 160)} \n  \n ")
+        logger.debug("Full task of the %s: %s", self.name, task)
+        return chat_completion_choices(
+            self.messages(task, research_data),
+            max_tokens=max_tokens or self.max_tokens,
+            n=n,
+            task=kind
+        )
 
-        print(f"Tokens used: {tokens_used}, Cost: ${cost:.4f}")
 
-        return response_content
+# Run manifest saved in the book folder so an interrupted run can be resumed
+class RunManifest:
+    """Persisted state of one book run: research data, accepted TOC, options and per-chapter status."""
+
+    file_name = "manifest.json"
+    research_file_name = "research.json"
+
+    def __init__(self, book_folder, data=None):
+        self.book_folder = book_folder
+        self.path = os.path.join(book_folder, self.file_name)
+        self.lock = threading.Lock()
+        self.data = data or {"version": 1, "stages": {}, "options": {}, "chapters": {}}
+
+    @classmethod
+    def load(cls, book_folder):
+        with open(os.path.join(book_folder, cls.file_name), "r") as file:
+            return cls(book_folder, json.load(file))
+
+    def save(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        # Called with the lock held, so no thread changes the data while it is written
+        # Write to a temporary file first so a crash never leaves a half written manifest
+        partial_path = self.path + ".part"
+        with open(partial_path, "w") as file:
+            json.dump(self.data, file, indent=2)
+        os.replace(partial_path, self.path)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.write()
+
+    def save_research(self, documents):
+        # The research corpus is large and written once, so it has its own file and the manifest only names it
+        path = os.path.join(self.book_folder, self.research_file_name)
+        partial_path = path + ".part"
+        with open(partial_path, "w") as file:
+            json.dump(documents, file)
+        os.replace(partial_path, path)
+        self.set("research_documents", self.research_file_name)
+
+    def load_research(self):
+        # None when the research was not saved or its file is gone, manifests of older runs hold the documents themselves
+        documents = self.get("research_documents")
+        if isinstance(documents, str):
+            path = os.path.join(self.book_folder, documents)
+            if not os.path.exists(path):
+                return None
+            with open(path, "r") as file:
+                return json.load(file)
+        return documents
+
+    def stage_done(self, stage):
+        return self.data["stages"].get(stage) == "done"
+
+    def mark_stage(self, stage, status="done"):
+        with self.lock:
+            self.data["stages"][stage] = status
+            self.write()
+
+    @staticmethod
+    def content_hash(content):
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def mark_chapter(self, chapter_title, chapter_file, chapter_content, chapter_summary=None):
+        with self.lock:
+            chapter = self.data["chapters"].setdefault(chapter_title, {})
+            chapter["status"] = "done"
+            chapter["file"] = chapter_file
+            chapter["sha256"] = self.content_hash(chapter_content)
+            if chapter_summary is not None:
+                chapter["summary"] = chapter_summary
+            self.write()
+
+    def chapter_done(self, chapter_title, content_hash):
+        # A chapter counts as done only if its file still has the content recorded in the manifest
+        chapter = self.data["chapters"].get(chapter_title)
+        return bool(chapter) and chapter.get("status") == "done" and chapter.get("sha256") == content_hash
+
+    def mark_image(self, image_path):
+        with self.lock:
+            self.data.setdefault("images", {})[image_path] = "done"
+            self.write()
+
+    def image_done(self, image_path):
+        # An image counts as done only if this run saved it and its file is still there
+        return self.data.get("images", {}).get(image_path) == "done" and os.path.exists(image_path)
+
+    def chapter_summary(self, chapter_title):
+        return self.data["chapters"].get(chapter_title, {}).get("summary")
+
+
+class Chapter:
+    """One chapter of a book, held in memory and written through to its markdown file and the manifest."""
+
+    def __init__(self, book, title):
+        self.book = book
+        self.title = title
+        file_name = title.replace(" ", "_")
+        self.path = os.path.join(book.folder, f"{file_name}.md")
+        self.pdf_path = os.path.join(book.folder, f"{file_name}.pdf")
+        self.image_path = f"{book.folder}/{file_name}_image.png"
+        self.content = None
+        self.sha256 = None
+        self.summary = book.manifest.chapter_summary(title)
+
+    def export_path(self, image_variant=None):
+        # Markdown converted to the chapter PDF, a copy pointing to the image variant when one is exported
+        return f"{self.path[:-3]}.{image_variant}.md" if image_variant else self.path
+
+    def load(self):
+        # The file is read once, every later stage uses the content held here
+        if self.content is None and os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                self.content = file.read()
+            self.sha256 = RunManifest.content_hash(self.content)
+        return self.content
+
+    def done(self):
+        return self.load() is not None and self.book.manifest.chapter_done(self.title, self.sha256)
+
+    def save(self, content, summary=None):
+        self.content = content
+        self.sha256 = RunManifest.content_hash(content)
+        if summary is not None:
+            self.summary = summary
+        partial_path = self.path + ".part"
+        with open(partial_path, "w") as file:
+            file.write(content)
+        os.replace(partial_path, self.path)
+        self.book.manifest.mark_chapter(self.title, self.path, content, summary)
+
+
+class Book:
+    """The chapters of an ebook in TOC order and the paths of the files exported from them."""
+
+    def __init__(self, topic, folder, toc, manifest):
+        self.topic = topic
+        self.folder = folder
+        self.toc = toc
+        self.manifest = manifest
+        self.chapters = [Chapter(self, title) for title in toc if "SECTION" not in title.upper()]  # Skip sections
+        file_name = topic.replace(" ", "_")
+        self.md_file = os.path.join(folder, f"{file_name}.md")
+        self.pdf_file = os.path.join(folder, f"{file_name}.pdf")
+        self.cover_md_file = os.path.join(folder, "cover.md")
+        self.toc_md_file = os.path.join(folder, "toc.md")
+        self.back_cover_md_file = os.path.join(folder, "back_cover.md")
+        self.cover_pdf_file = self.cover_md_file.replace(".md", ".pdf")
+        self.toc_pdf_file = self.toc_md_file.replace(".md", ".pdf")
+        self.back_cover_pdf_file = self.back_cover_md_file.replace(".md", ".pdf")
+        self.cover_image_path = f"{folder}/cover_page.png"
+
+    @classmethod
+    def load(cls, folder):
+        # A book written by an earlier run, from the manifest in its folder
+        folder = folder.rstrip("/")
+        manifest = RunManifest.load(folder)
+        return cls(manifest.get("topic"), folder, manifest.get("toc") or [], manifest)
+
+    def pdf_parts(self):
+        # The PDFs merged into the book in chapter-broken mode, in order, with their bookmark titles
+        return (
+            [(self.cover_pdf_file, "Cover"), (self.toc_pdf_file, "Table of Contents")]
+            + [(chapter.pdf_path, chapter.title) for chapter in self.chapters]
+            + [(self.back_cover_pdf_file, "Thank you for reading")]
+        )
+
+    def image_variants(self, image_variant):
+        # Transcoded image to embed in place of each generated PNG, its path is known before it is made
+        image_paths = [self.cover_image_path] + [chapter.image_path for chapter in self.chapters]
+        return {image_path: image_variant_path(image_path, image_variant) for image_path in image_paths}
+
+    @staticmethod
+    def export_content(content, images):
+        for image_path, variant_path in images.items():
+            content = content.replace(f"]({image_path})", f"]({variant_path})")
+        return content
+
+    def write_markdown(self, author, designer, generate_images, single_file=True, image_variant=None):
+        # One pass writes the cover, TOC and back cover pages and, for a single PDF, streams every chapter into the merged file
+        images = self.image_variants(image_variant) if image_variant else {}
+        cover_image_path = images.get(self.cover_image_path, self.cover_image_path)
+        with ExitStack() as stack:
+            cover = stack.enter_context(open(self.cover_md_file, "w"))
+            toc = stack.enter_context(open(self.toc_md_file, "w"))
+            back_cover = stack.enter_context(open(self.back_cover_md_file, "w"))
+            merged = stack.enter_context(open(self.md_file, "w")) if single_file else None
+
+            cover.write(f"# {self.topic}\n\n![Cover Page]({cover_image_path})\n\n### AUTHOR: {author}\n\n### DESIGNER: {designer}\n")
+            toc.write("## Table of Contents\n\n")
+            if merged:
+                merged.write(f"# {self.topic}\n\n")
+                if generate_images:
+                    merged.write(f"![Cover Page]({cover_image_path})\n\n")
+                merged.write(f"### AUTHOR: {author}\n\n### DESIGNER: {designer}\n\n## Table of Contents\n\n")
+            for chapter in self.chapters:
+                toc.write(f"- {chapter.title}\n")
+                if merged:
+                    merged.write(f"- {chapter.title}\n")
+            if merged:
+                merged.write("\n")
+            for chapter in self.chapters:
+                if merged:
+                    merged.write("\n\n")
+                    merged.write(self.export_content(chapter.load(), images))
+                    merged.write("\n\n")
+                elif images:
+                    # Chapter PDFs are made from copies of the chapters that embed the exported variant
+                    with open(chapter.export_path(image_variant), "w") as file:
+                        file.write(self.export_content(chapter.load(), images))
+            if merged:
+                merged.write("Thank you for reading.\n")
+            back_cover.write("## Thank you for reading.\n")
+        if merged:
+            print(f"All chapters merged into {self.md_file}")
 
 
 # Function to get user input with options
@@ -285,35 +2159,453 @@ def get_user_input(prompt, options):
 
 
 # Function to generate table of contents
-def generate_toc(topic, content_organizer, research_data):
-    # Extract relevant information from research data
-    research_summary = "\n".join([f"{key}: {value}" for key, value in research_data.items() if key in ["answer", "query", "results"]])
+def generate_toc(topic, content_organizer, research_data, fresh=False, on_token=None):
+    with tracer.span("table of contents request"):
+        # Extract relevant information from research data
+        research_summary = "\n".join([f"{key}: {value}" for key, value in research_data.items() if key in ["answer", "query", "results"]])
     
-    task = {
-        "query": topic,
-        "answer": research_data.get("answer", ""),
-        "results": research_data.get("results", [])
-    }
-    toc_response = content_organizer.execute_task(task)
-    return toc_response.split('\n')
+        task = {
+            "query": topic,
+            "answer": research_data.get("answer", ""),
+            "results": research_data.get("results", [])
+        }
+        toc_response = content_organizer.execute_task(task, fresh=fresh, on_token=on_token)
+        return toc_response.split('\n')
 
 
 # Function to generate chapter with specified format
-def generate_chapter(chapter_title, writer, research_data, generate_images):
-    print(f"Debug: research_data['query'] = {research_data['query']}")
-    print(f"Debug: Research data for chapter '{chapter_title}': {research_data}")
-    task = f"Write a detailed content for a book with chapter called '{chapter_title}' for this ebook about {research_data['query']}. Use simple and understandable English. Follow the research data and do not create imaginary content. Use your creative freedom, it is suggested but not important to divide it into structured segments similar to an academic book, including any relevant examples, facts, quotes, and notable people or brands only if applicable. Conduct research on the web to gather accurate information and provide references for any key points made. Each chapter should be around 750 to 1000 words. Use your creative freedom, it is suggested but not important that each segments might include the following elements, all or a few or even none: Start with an engaging introduction that provides a brief overview of the segment. Include practical examples to illustrate key points. Incorporate factual information and quotes from credible sources or notable figures. Mention notable people or brands related to the subject matter. Add a short exercise or interactive activity at the end to engage readers and reinforce learning. Provide references for all the key points made to ensure accuracy and credibility. End with a conclusion with a summary that recaps the main points discussed in the chapter. Make sure that you go through past and future topics from the table of contents so that there are no redundant content in this chapter. Do not add prefatory statements, your own status, notes, apologizes and inconvenience, like you don't have access to internet, feel free to adjust, I cannot provide direct reference from web, fact checking or follow ups like sure, here is a detailed structure for your book. Do not keep unended sentences. Do not generate any elements if you don't have enough information. Make the content print ready without any remarks or feedback from your side. Output should be a well formatted mark down for example H1 for Chapter title, H2, H3 and other headings for other segment titles."
+def generate_chapter(chapter, writer, research_data, generate_images, fresh=False, stream=False, research_index=None):
+    chapter_title = chapter.title
+    # Every API call made for this chapter is labelled with its title in the metrics
+    with metrics.labels(chapter=chapter_title), tracer.span("chapter", stream=stream):
+        task, research_data = chapter_request(chapter, research_data, research_index)
+        max_tokens = writer.max_tokens
+        if summary_mode == "inline":
+            # The summary comes back at the end of the same response, with a little room added for it
+            task += f" After the chapter, write a line with only {summary_marker} followed by a summary of the chapter in 2-3 sentences."
+            max_tokens += 150
+
+        if stream:
+            # Show the chapter and write the draft to its file while the tokens arrive
+            with open(chapter.path, "w") as file:
+                chapter_content = writer.execute_task(task, research_data, fresh=fresh, on_token=chapter_stream_writer(file), max_tokens=max_tokens)
+        else:
+            chapter_content = writer.execute_task(task, research_data, fresh=fresh, max_tokens=max_tokens)
+        chapter_content, chapter_summary = split_chapter_summary(chapter_content)
+        chapter_content = clean_chapter_content(chapter, chapter_content, generate_images)
+        if not chapter_summary:
+            chapter_summary = summarize_chapter(chapter_content, writer)
+        return chapter_content, chapter_summary
+
+
+# Function to build the writing task of a chapter with the research data it is written from
+def chapter_request(chapter, research_data, research_index=None):
+    # With a research index the writer only gets the passages relevant to this chapter
+    if research_index is not None:
+        research_data = research_index.chapter_research(research_data, chapter.title)
+    logger.debug("Research data for chapter '%s': %s", chapter.title, research_data)
+    return chapter_task(chapter.title, research_data['query']), research_data
+
+
+# Function to generate several drafts of a chapter with one request, without summaries
+def generate_chapter_candidates(chapter, writer, research_data, generate_images, count, research_index=None):
+    # Only the draft the user keeps is summarized, so the drafts are asked for without the inline summary
+    with metrics.labels(chapter=chapter.title), tracer.span("chapter candidates", n=count):
+        task, research_data = chapter_request(chapter, research_data, research_index)
+        drafts = writer.execute_choices(task, research_data, count)
+    return [clean_chapter_content(chapter, split_chapter_summary(draft)[0], generate_images) for draft in drafts]
+
+
+summary_marker = "=== SUMMARY ==="
+
 
-    chapter_content = writer.execute_task(task, research_data)
+# Function to split the summary written after the marker from the chapter, "" if the response has none
+def split_chapter_summary(chapter_content):
+    if summary_marker not in chapter_content:
+        return chapter_content, ""
+    chapter_content, _, chapter_summary = chapter_content.rpartition(summary_marker)
+    return chapter_content.rstrip(), chapter_summary.strip()
+
+
+# Function to build the writing task of a chapter
+def chapter_task(chapter_title, topic):
+    return f"Write a detailed content for a book with chapter called '{chapter_title}' for this ebook about {topic}. Use simple and understandable English. Follow the research data and do not create imaginary content. Use your creative freedom, it is suggested but not important to divide it into structured segments similar to an academic book, including any relevant examples, facts, quotes, and notable people or brands only if applicable. Conduct research on the web to gather accurate information and provide references for any key points made. Each chapter should be around 750 to 1000 words. Use your creative freedom, it is suggested but not important that each segments might include the following elements, all or a few or even none: Start with an engaging introduction that provides a brief overview of the segment. Include practical examples to illustrate key points. Incorporate factual information and quotes from credible sources or notable figures. Mention notable people or brands related to the subject matter. Add a short exercise or interactive activity at the end to engage readers and reinforce learning. Provide references for all the key points made to ensure accuracy and credibility. End with a conclusion with a summary that recaps the main points discussed in the chapter. Make sure that you go through past and future topics from the table of contents so that there are no redundant content in this chapter. Do not add prefatory statements, your own status, notes, apologizes and inconvenience, like you don't have access to internet, feel free to adjust, I cannot provide direct reference from web, fact checking or follow ups like sure, here is a detailed structure for your book. Do not keep unended sentences. Do not generate any elements if you don't have enough information. Make the content print ready without any remarks or feedback from your side. Output should be a well formatted mark down for example H1 for Chapter title, H2, H3 and other headings for other segment titles."
+
+
+# Function to return a callback that prints streamed text and appends it to an open file
+def chapter_stream_writer(file):
+    def on_token(text):
+        print(text, end="", flush=True)
+        file.write(text)
+        file.flush()
+    return on_token
+
+
+# Function to remove the code fences around generated markdown and add the chapter image
+def clean_chapter_content(chapter, chapter_content, generate_images):
     chapter_content = f"\n" + chapter_content.replace("```markdown", "").replace("```", "")
-    chapter_image_path = f"{book_folder}/{chapter_title.replace(' ', '_')}_image.png"
     if generate_images:
-        chapter_image_markdown = f"![{chapter_title} Image]({chapter_image_path})\n\n"
-        chapter_content = chapter_image_markdown + chapter_content
-    # Generate a summary for the chapter
-    summary_task = f"Summarize the following chapter content in 2-3 sentences:\n\n{chapter_content}"
-    chapter_summary = writer.execute_task(summary_task, research_data)
-    return chapter_content, chapter_summary
+        chapter_content = add_chapter_image(chapter, chapter_content)
+    return chapter_content
+
+
+# Function to put the chapter image above the chapter content
+def add_chapter_image(chapter, chapter_content):
+    return f"![{chapter.title} Image]({chapter.image_path})\n\n" + chapter_content
+
+
+# Function to generate a summary for the chapter, with the LLM only in "llm" summary mode
+def summarize_chapter(chapter_content, writer):
+    with tracer.span("summary", mode=summary_mode):
+        if summary_mode != "llm":
+            return extractive_summary(chapter_content)
+        # The summary only needs the chapter itself, not the research data
+        summary_task = f"Summarize the following chapter content in 2-3 sentences:\n\n{chapter_content}"
+        return writer.execute_task(summary_task, None, kind="summary")
+
+
+summary_stopwords = set("a an and are as at be been but by can for from has have in into is it its of on or that the their this to was were which with you your".split())
+
+
+# Function to summarize a chapter locally with its most representative sentences, in their original order
+def extractive_summary(chapter_content, sentence_count=3):
+    # Only prose counts: headings, images, tables, quotes, rules and code blocks are skipped
+    lines = []
+    in_code = False
+    for line in chapter_content.splitlines():
+        line = line.strip()
+        if line.startswith("```"):
+            in_code = not in_code
+        elif line and not in_code and not line.startswith(("#", "![", "|", ">")) and re.search(r"\w", line):
+            lines.append(re.sub(r"^([-*+]|\d+\.)\s+", "", line))
+    text = re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", " ".join(lines))  # Keep the text of links
+    text = re.sub(r"\*+|`+|(?<!\w)_+|_+(?!\w)", "", text)
+    sentences = [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+", text) if sentence.strip()]
+
+    # Sentences made of the chapter's most frequent words represent it best
+    frequencies = {}
+    for word in re.findall(r"[a-z0-9']+", text.lower()):
+        if word not in summary_stopwords:
+            frequencies[word] = frequencies.get(word, 0) + 1
+    scored = []
+    for index, sentence in enumerate(sentences):
+        words = [word for word in re.findall(r"[a-z0-9']+", sentence.lower()) if word not in summary_stopwords]
+        if 6 <= len(words) <= 50:
+            scored.append((sum(frequencies[word] for word in words) / len(words) ** 0.5, index))
+    best = sorted(index for _, index in sorted(scored, reverse=True)[:sentence_count])
+    return " ".join(sentences[index] for index in best) or " ".join(sentences[:sentence_count])
+
+
+# Function to predict the tokens and cost of the remaining chapters, their proofreading and their images
+def estimate_book_cost(topic, chapter_titles, writer, research_data, research_index=None, generate_images=False, proofread=True, candidates=1):
+    # Each task is priced with the first model it is routed to, and every chapter is written as that many drafts sharing one prompt
+    chapter_model = model_router.primary_model("chapter")
+    summary_model = model_router.primary_model("summary")
+    proofread_model = model_router.primary_model("proofread")
+    chapter_tokens = [0, 0]
+    summary_tokens = [0, 0]
+    proofread_tokens = [0, 0]
+    for chapter_title in chapter_titles:
+        chapter_research = research_index.chapter_research(research_data, chapter_title) if research_index is not None else research_data
+        chapter_tokens[0] += count_message_tokens(writer.messages(chapter_task(chapter_title, topic), chapter_research), chapter_model)
+        chapter_tokens[1] += writer.max_tokens * candidates
+        if summary_mode == "inline":
+            chapter_tokens[1] += 150
+        elif summary_mode == "llm":
+            # The summary prompt holds the whole chapter and asks for 2-3 sentences
+            summary_tokens[0] += writer.max_tokens + 40
+            summary_tokens[1] += 120
+    if proofread and chapter_titles:
+        if proofread_mode == "llm":
+            # Every chapter is sent with a digest of the earlier chapters
+            proofread_tokens = [len(chapter_titles) * (writer.max_tokens + proofread_digest_chars // 4 + 300), len(chapter_titles) * 300]
+        else:
+            # Only uncertain near-duplicate pairs are sent, usually a single batch
+            proofread_tokens = [2000, 200]
+    images = len(chapter_titles) + 1 if generate_images else 0
+    cost = (
+        metrics.price("chat", chapter_model, *chapter_tokens)
+        + metrics.price("chat", summary_model, *summary_tokens)
+        + metrics.price("chat", proofread_model, *proofread_tokens)
+        + metrics.price("image", model_router.primary_model("image"), units=images, tier="hd")
+    )
+    return {
+        "prompt_tokens": chapter_tokens[0] + summary_tokens[0] + proofread_tokens[0],
+        "completion_tokens": chapter_tokens[1] + summary_tokens[1] + proofread_tokens[1],
+        "images": images,
+        "cost": round(cost, 4)
+    }
+
+
+# Function to save one written chapter, run as a task of the book graph after the chapter before it is saved
+def save_chapter(chapter, chapter_task):
+    chapter.save(*chapter_task.result())
+    print(f"\nGenerated and saved content for {chapter.title}")
+    print("="*50 + "\n")
+
+
+# Function to generate chapters concurrently and save them in TOC order, starting each chapter image as soon as its chapter is saved
+def generate_chapters_concurrently(chapters, writer, research_data, generate_images, tasks, designer=None, research_index=None):
+    chapter_tasks = []
+    previous_save = []
+    for chapter in chapters:
+        chapter_task = tasks.add(f"chapter:{chapter.title}", generate_chapter, chapter, writer, research_data, generate_images, research_index=research_index, resource="llm")
+        # Save every chapter after the one before it, so files and summaries stay aligned with the TOC
+        save_task = tasks.add(f"save:{chapter.title}", save_chapter, chapter, chapter_task, after=[chapter_task] + previous_save, resource="save")
+        previous_save = [save_task]
+        chapter_tasks += [chapter_task, save_task]
+        if designer is not None:
+            designer.submit_chapter_image(chapter, after=[save_task])
+    wait(chapter_tasks, return_when=FIRST_EXCEPTION)
+    for chapter_task in chapter_tasks:
+        if chapter_task.done() and chapter_task.exception() is not None:
+            # Do not start the remaining chapters if one of them failed
+            tasks.cancel()
+            raise chapter_task.exception()
+
+
+class QuietThreadsStdout:
+    """Stdout that drops what threads marked as quiet print, so background work does not break into the prompts."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.quiet = threading.local()
+
+    def write(self, text):
+        if getattr(self.quiet, "active", False):
+            return len(text)
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ChapterSpeculator:
+    """Writes the first chapters of a TOC in the background while the user reviews it and answers the prompts."""
+
+    def __init__(self, topic, book_folder, manifest, writer, researcher, research_data, max_chapters=None, max_cost=None):
+        self.topic = topic
+        self.book_folder = book_folder
+        self.manifest = manifest
+        self.writer = writer
+        self.researcher = researcher
+        self.research_data = research_data
+        self.max_chapters = speculative_chapters if max_chapters is None else max_chapters
+        self.max_cost = speculative_max_cost if max_cost is None else max_cost
+        # A draft is only used for the same chapter title written from the same research data
+        self.research_hash = RunManifest.content_hash(json.dumps(research_data, sort_keys=True, default=str))
+        self.drafts = {}
+        self.reserved_cost = 0.0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, min(chapter_concurrency, self.max_chapters)))
+        self.stdout = sys.stdout = QuietThreadsStdout(sys.stdout)
+
+    def key(self, chapter_title):
+        return (chapter_title, self.research_hash)
+
+    def update(self, toc):
+        # Cancel the drafts of titles that left the TOC being shown, keep the others wherever they moved,
+        # and start drafts for the first chapters that have none yet
+        chapters = Book(self.topic, self.book_folder, toc, self.manifest).chapters
+        titles = {self.key(chapter.title) for chapter in chapters}
+        with self.lock:
+            for key in list(self.drafts):
+                if key not in titles:
+                    self.cancel(key)
+            for chapter in chapters[:self.max_chapters]:
+                key = self.key(chapter.title)
+                if key not in self.drafts:
+                    cancelled = threading.Event()
+                    self.drafts[key] = (submit_with_labels(self.executor, self.draft, chapter, cancelled), cancelled)
+
+    def cancel(self, key):
+        # Called with the lock held. A draft not started yet never starts, a running draft stops after its current request
+        future, cancelled = self.drafts.pop(key)
+        cancelled.set()
+        future.cancel()
+
+    def spent(self):
+        return sum(record["cost"] for record in metrics.select(self.book_folder) if record["stage"] == "speculative")
+
+    def draft(self, chapter, cancelled):
+        self.stdout.quiet.active = True
+        with metrics.labels(stage="speculative"):
+            # Drafts stop starting once the money spent and reserved on them would go over the cap
+            estimate = estimate_book_cost(self.topic, [chapter.title], self.writer, self.research_data, proofread=False)["cost"]
+            with self.lock:
+                if cancelled.is_set() or self.spent() + self.reserved_cost + estimate > self.max_cost:
+                    return None
+                self.reserved_cost += estimate
+            try:
+                research_index = None
+                if isinstance(self.research_data, dict):
+                    research_index = ResearchIndex()
+                    for document in self.researcher.research_chapters(self.topic, [chapter.title]) + self.research_data.get("results", []):
+                        research_index.add_document(document)
+                if cancelled.is_set():
+                    return None
+                # The chapter image is added when the draft is used, once the options are known
+                draft = generate_chapter(chapter, self.writer, self.research_data, False, research_index=research_index)
+                # The title may have left the TOC while the chapter was written
+                return None if cancelled.is_set() else draft
+            finally:
+                with self.lock:
+                    self.reserved_cost -= estimate
+
+    def collect(self, chapters):
+        # Return the finished drafts of these chapters by title, cancel the others and stop drafting
+        drafts = {}
+        with self.lock:
+            futures = {chapter.title: self.drafts.pop(self.key(chapter.title), (None, None))[0] for chapter in chapters}
+            discarded = [future for future, cancelled in self.drafts.values()]
+            for key in list(self.drafts):
+                self.cancel(key)
+        # Only the drafts of chapters still in the TOC are waited for, discarded drafts finish on their own
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for chapter_title, future in futures.items():
+            if future is None or future.cancel():
+                continue
+            try:
+                draft = future.result()
+            except (BudgetExceeded, openai.OpenAIError, requests.exceptions.RequestException) as e:
+                print(f"The draft of {chapter_title} written during the review failed, it is written again: {e}")
+                continue
+            if draft is not None:
+                drafts[chapter_title] = draft
+        # Discarded drafts still running stay quiet until the last one returns
+        running = [future for future in discarded if not future.done()]
+        if running:
+            remaining = [len(running)]
+
+            def draft_done(future):
+                with self.lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0 and sys.stdout is self.stdout:
+                        sys.stdout = self.stdout.stream
+
+            for future in running:
+                future.add_done_callback(draft_done)
+        else:
+            sys.stdout = self.stdout.stream
+        spent = self.spent()
+        print(f"{len(drafts)} chapters were written while the TOC was reviewed, drafts cost ${spent:.4f}")
+        return drafts
+
+
+# Function to find where repeated passages should be rewritten, as (chapter index, start, passage)
+def locate_repeated_passages(chapters, repeated_content, duplicate_passages=()):
+    titles = [chapter.title for chapter in chapters]
+    locations = []
+    # Passages found by the near-duplicate index already know their chapter and offset
+    for duplicate in duplicate_passages:
+        if duplicate["chapter"] in titles:
+            index = titles.index(duplicate["chapter"])
+            passage = duplicate["passage"]
+            if chapters[index].content[duplicate["start"]:duplicate["start"] + len(passage)] == passage:
+                locations.append((index, duplicate["start"], passage))
+    located = {passage for index, start, passage in locations}
+    for passage in repeated_content:
+        if passage in located:
+            continue
+        occurrences = [
+            (index, match.start())
+            for index, chapter in enumerate(chapters)
+            for match in re.finditer(re.escape(passage), chapter.content)
+        ]
+        # The first copy stays and later copies are rewritten; a single copy repeats earlier content, so it is rewritten
+        for index, start in occurrences[1:] or occurrences:
+            locations.append((index, start, passage))
+
+    # Drop passages overlapping one that is already being rewritten
+    locations.sort()
+    kept = []
+    for index, start, passage in locations:
+        if kept and kept[-1][0] == index and start < kept[-1][1] + len(kept[-1][2]):
+            continue
+        kept.append((index, start, passage))
+    return kept
+
+
+# Function to return the section of a chapter around a passage, from the heading before it to the next heading
+def passage_context(content, start, end, max_chars=3000):
+    section_start = content.rfind("\n#", 0, start) + 1
+    section_end = content.find("\n#", end)
+    if section_end == -1:
+        section_end = len(content)
+    section_start = max(section_start, start - max_chars // 2)
+    section_end = min(section_end, end + max_chars // 2)
+    return content[section_start:section_end].strip()
+
+
+# Function to read the numbered rewrites from the writer's JSON answer
+def parse_rewrites(response):
+    response = response.replace("```json", "").replace("```", "")
+    try:
+        rewrites = json.loads(response[response.index("{"):response.rindex("}") + 1])
+    except ValueError:
+        return {}
+    return {str(number): str(text).strip() for number, text in rewrites.items()}
+
+
+# Function to rewrite repeated passages in place, sending only their surrounding section and a digest of the other chapters
+def rewrite_repeated_content(chapters, repeated_content, writer, research_data, duplicate_passages=(), max_attempts=3):
+    passages_by_chapter = {}
+    for index, start, passage in locate_repeated_passages(chapters, repeated_content, duplicate_passages):
+        passages_by_chapter.setdefault(index, []).append((start, passage))
+
+    digest_chars = max(200, proofread_digest_chars // max(1, len(chapters)))
+    research_summary = research_data.get("answer", "") if isinstance(research_data, dict) else research_data
+    for index, passages in passages_by_chapter.items():
+        chapter = chapters[index]
+        content = chapter.content
+        digest = "".join(chapter_digest(other, digest_chars) for other in chapters if other is not chapter)
+
+        # Passages of the same chapter are rewritten together, in batches of bounded size
+        batches = []
+        for start, passage in passages:
+            size = len(passage) + min(len(content), 3000)
+            if not batches or batches[-1][0] + size > proofread_window_chars:
+                batches.append([0, []])
+            batches[-1][0] += size
+            batches[-1][1].append((start, passage))
+
+        rewrites = {}
+        for size, pending in batches:
+            attempts = 0
+            while pending and attempts < max_attempts:
+                print(f"Rewriting {len(pending)} passages for chapter: {chapter.title} (Attempt {attempts + 1})")
+                numbered = "\n\n".join(
+                    f"Passage {number}:\nSection around it:\n{passage_context(content, start, start + len(passage))}\n\nPassage to rewrite:\n{passage}"
+                    for number, (start, passage) in enumerate(pending, start=1)
+                )
+                with metrics.labels(chapter=chapter.title), tracer.span("rewrite", passages=len(pending), attempt=attempts + 1):
+                    response = writer.execute_task(
+                        f"Rewrite each numbered passage from the chapter '{chapter.title}' so that it no longer repeats content covered elsewhere in the book. Keep what is specific to this chapter and keep the Markdown formatting. Do not add new sections or content. A digest of the other chapters is given for reference. Answer only with a JSON object that maps each passage number to its rewritten text.\n\nDigest of the other chapters:\n{digest}\n{numbered}\n\n",
+                        research_summary,
+                        kind="rewrite"
+                    )
+                answers = parse_rewrites(response)
+                still_pending = []
+                for number, (start, passage) in enumerate(pending, start=1):
+                    new_content = answers.get(str(number))
+                    if new_content and new_content != passage:
+                        rewrites[start] = (passage, new_content)
+                        logger.debug("Original repeated content: %s", passage)
+                        logger.debug("Rewritten content: %s", new_content)
+                    else:
+                        still_pending.append((start, passage))
+                pending = still_pending
+                attempts += 1
+            if pending:
+                print(f"Max rewrite attempts reached for chapter: {chapter.title}. Skipping further rewrites.")
+
+        # Splice the rewrites in from the end of the chapter so earlier offsets stay valid
+        for start in sorted(rewrites, reverse=True):
+            passage, new_content = rewrites[start]
+            content = content[:start] + new_content + content[start + len(passage):]
+
+        # Save the updated chapter content to its markdown file
+        chapter.save(content)
 
 
 def import_file(file_path):
@@ -327,40 +2619,16 @@ def import_file(file_path):
         print(f"File {file_path} not found.")
         return None
 
-# Main workflow
-def main():
-    global book_folder, toc, topic, chapter_summaries
-    chapter_summaries = []
-    # Step 1: Get the ebook topic
-    topic = input("Enter the topic for the ebook (Min. 5 characters): ").strip()
-    print("="*50 + "\n")
-    book_folder = topic.replace(" ", "_")
-
-    # Create directory for the ebook
-    if not os.path.exists(book_folder):
-        os.makedirs(book_folder)
-
-    # Initialize agents with Tavily API key
-    researcher = ResearcherAgent(tavily_api_key)
-    content_organizer = ContentOrganizerAgent(tavily_api_key)
-    writer = WriterAgent()
-    proofreader = ProofreaderAgent()
-    designer = DesignerAgent()
-
-    # Research Information
-    research_task = f"{topic}"
-    research_data = researcher.execute_task(research_task)
-    print("\n" + "="*50)
-    print("Research data gathered successfully.")
-    print(f"Debug: Full research_data = {research_data}")
-    print("="*50 + "\n")
-
-    # Step 2: Generate and review TOC
-    toc = generate_toc(topic, content_organizer, research_data)
+# Function to show the TOC until the user accepts it
+def review_toc(topic, content_organizer, research_data, speculator=None):
+    toc = stream_toc(topic, content_organizer, research_data)
     while True:
         print("Table of Contents:")
         for item in toc:
             print(f"- {item}")
+        # Start writing the first chapters of the TOC being shown while the user decides
+        if speculator is not None:
+            speculator.update(toc)
         action = input("\nType a number and hit enter to select an action: \n Accept = 1 \n Modify = 2 \n Regenerate = 3:\n ")
         if action.lower() == "1":
             break
@@ -374,9 +2642,79 @@ def main():
                 toc_input.append(line)
             toc = toc_input
         elif action.lower() == "3":
-            toc = generate_toc(topic, content_organizer, research_data)
+            # Regenerate bypasses the response cache to get a new sample
+            toc = stream_toc(topic, content_organizer, research_data, fresh=True)
+    return toc
+
+
+# Function to show the TOC while it is generated, keeping the lines received so far if it is aborted
+def stream_toc(topic, content_organizer, research_data, fresh=False):
+    try:
+        return generate_toc(topic, content_organizer, research_data, fresh=fresh, on_token=lambda text: print(text, end="", flush=True))
+    except GenerationAborted as e:
+        return e.partial_content.split('\n')
 
 
+# Function to stream a chapter in review mode, returning the partial draft without a summary if it is aborted
+def review_generate_chapter(chapter, writer, research_data, generate_images, fresh=False, research_index=None):
+    print(f"\nWriting {chapter.title}:\n")
+    try:
+        chapter_content, chapter_summary = generate_chapter(chapter, writer, research_data, generate_images, fresh=fresh, stream=True, research_index=research_index)
+        return chapter_content, chapter_summary, True
+    except GenerationAborted as e:
+        print(f"\nStopped {chapter.title}, the partial draft is kept so it can be modified or regenerated.")
+        partial_content = split_chapter_summary(e.partial_content)[0]
+        return clean_chapter_content(chapter, partial_content, generate_images), None, True
+
+
+# Function to print the headings of the drafts in columns next to each other, with how much each differs from the current draft
+def show_candidates(chapter_content, candidates):
+    width = max(20, (shutil.get_terminal_size().columns - 3 * (len(candidates) - 1)) // len(candidates))
+    current_words = chapter_content.split()
+    columns = []
+    for number, candidate in enumerate(candidates, start=1):
+        words = candidate.split()
+        similarity = difflib.SequenceMatcher(None, current_words, words, autojunk=False).ratio()
+        headings = [line.strip() for line in candidate.splitlines() if line.startswith("#")]
+        columns.append([f"Draft {number}", f"{len(words)} words, {similarity:.0%} like current", ""] + headings)
+    for row in itertools.zip_longest(*columns, fillvalue=""):
+        print(" | ".join(textwrap.shorten(cell, width, placeholder="...").ljust(width) for cell in row).rstrip())
+
+
+# Function to print the lines a draft adds to and removes from the current draft, each cut to one screen line
+def show_candidate_diff(chapter_content, candidate, max_lines=40):
+    width = shutil.get_terminal_size().columns - 2
+    old_lines = [line for line in chapter_content.splitlines() if line.strip()]
+    new_lines = [line for line in candidate.splitlines() if line.strip()]
+    changes = [line for line in difflib.unified_diff(old_lines, new_lines, lineterm="", n=0) if line[:1] in "+-" and line[:3] not in ("+++", "---")]
+    for line in changes[:max_lines]:
+        print(line[0] + " " + textwrap.shorten(line[1:], width, placeholder="..."))
+    if len(changes) > max_lines:
+        print(f"... {len(changes) - max_lines} more changed lines")
+    print(f"{sum(line[0] == '+' for line in changes)} lines added, {sum(line[0] == '-' for line in changes)} lines removed")
+
+
+# Function to let the user compare the drafts and pick one, returning None to keep the current draft
+def choose_candidate(chapter_title, chapter_content, candidates):
+    while True:
+        print("\n" + "="*50)
+        show_candidates(chapter_content, candidates)
+        choice = input(f"\nType the number of the draft to keep for {chapter_title}, d<number> to see its changes from the current draft, v<number> to view it, or 0 to keep the current draft:\n ").strip().lower()
+        number = choice.lstrip("dv")
+        if not number.isdigit() or int(number) > len(candidates) or (choice[:1] in "dv" and int(number) == 0):
+            print("Invalid choice, please try again.")
+        elif choice.startswith("d"):
+            show_candidate_diff(chapter_content, candidates[int(number) - 1])
+        elif choice.startswith("v"):
+            print(candidates[int(number) - 1])
+        elif int(number) == 0:
+            return None
+        else:
+            return candidates[int(number) - 1]
+
+
+# Function to ask how the ebook should be generated and exported
+def ask_generation_options():
     # Step 3.1: Ask user if they want to generate images
     generate_images = get_user_input(
         "\nDo you want to generate images for the chapters and cover page?",
@@ -395,239 +2733,768 @@ def main():
         "\nDo you want to continue with fast generation or review each chapter to continue?",
         ["Fast generation", "Review each chapter"]
     )
+    return {
+        "generate_images": generate_images,
+        "pdf_generation_mode": pdf_generation_mode,
+        "generation_mode": generation_mode
+    }
+
 
+# Function to read the generation options of a batch job, with the same choices as the prompts
+def job_generation_options(job):
+    return {
+        "generate_images": bool(job.get("generate_images", False)),
+        "pdf_generation_mode": job.get("pdf_generation_mode", "Single long PDF"),
+        "generation_mode": "Fast generation"
+    }
+
+
+# Main workflow
+def main(resume_folder=None, job=None):
+    # A job from a batch file answers every prompt, so the run needs no user input
+    if job is not None:
+        job_folder = job.get("book_folder") or job["topic"].replace(" ", "_")
+        if job.get("resume", True) and os.path.exists(os.path.join(job_folder, RunManifest.file_name)):
+            resume_folder = job_folder
+    if resume_folder:
+        # Continue an interrupted run from the manifest saved in its book folder
+        book_folder = resume_folder.rstrip("/")
+        manifest = RunManifest.load(book_folder)
+        topic = manifest.get("topic")
+        print(f"Resuming the ebook '{topic}' from {manifest.path}")
+        print("="*50 + "\n")
+    else:
+        # Step 1: Get the ebook topic
+        if job is not None:
+            topic = job["topic"].strip()
+            book_folder = job_folder
+        else:
+            topic = input("Enter the topic for the ebook (Min. 5 characters): ").strip()
+            book_folder = topic.replace(" ", "_")
+        print("="*50 + "\n")
+
+        # Create directory for the ebook
+        if not os.path.exists(book_folder):
+            os.makedirs(book_folder)
+        manifest = RunManifest(book_folder)
+        manifest.set("topic", topic)
+        print(f"Run progress is saved in {manifest.path}, use --resume {book_folder} to continue after a failure")
+
+    # Every API call of this book is labelled with its folder and stage in the metrics
+    metrics.set_labels(book=book_folder)
+    token_budget = job.get("token_budget", book_token_budget) if job is not None else book_token_budget
+    cost_budget = job.get("cost_budget", book_cost_budget) if job is not None else book_cost_budget
+    if token_budget or cost_budget:
+        metrics.set_budget(book_folder, token_budget, cost_budget)
+
+    # Initialize agents with Tavily API key
+    researcher = ResearcherAgent(tavily_api_key)
+    content_organizer = ContentOrganizerAgent(tavily_api_key)
+    writer = WriterAgent()
+    proofreader = ProofreaderAgent()
+    # Chapters, images, transcodes and PDFs of the book run as tasks that start as soon as their inputs are ready
+    tasks = book_task_graph()
+    designer = DesignerAgent(book_folder, tasks, manifest)
+
+    # Research Information
+    metrics.set_labels(stage="research")
+    if manifest.stage_done("research"):
+        research_data = manifest.get("research_data")
+        print("Research data loaded from the manifest.")
+    else:
+        research_task = f"{topic}"
+        research_data = researcher.execute_task(research_task)
+        manifest.set("research_data", research_data)
+        manifest.mark_stage("research")
+        print("\n" + "="*50)
+        print("Research data gathered successfully.")
+        print("="*50 + "\n")
+
+    # Step 2: Generate and review TOC
+    metrics.set_labels(stage="toc")
+    speculator = None
+    if manifest.stage_done("toc"):
+        toc = manifest.get("toc")
+        print("Table of Contents loaded from the manifest.")
+    elif job is not None:
+        # Batch jobs accept the generated TOC as it is
+        toc = [line for line in generate_toc(topic, content_organizer, research_data) if line.strip()]
+        manifest.set("toc", toc)
+        manifest.mark_stage("toc")
+    else:
+        if speculative_chapters:
+            speculator = ChapterSpeculator(topic, book_folder, manifest, writer, researcher, research_data)
+        toc = review_toc(topic, content_organizer, research_data, speculator)
+        manifest.set("toc", toc)
+        manifest.mark_stage("toc")
+
+    # Step 3: Ask the generation options, unless an earlier run already chose them
+    options = manifest.get("options")
+    if not manifest.stage_done("options"):
+        options.update(job_generation_options(job) if job is not None else ask_generation_options())
+        manifest.set("options", options)
+        manifest.mark_stage("options")
+    generate_images = options["generate_images"]
+    pdf_generation_mode = options["pdf_generation_mode"]
+    generation_mode = options["generation_mode"]
+
+    # Start the cover image in the background while the chapters are written
+    if generate_images and not manifest.stage_done("images"):
+        designer.submit_cover_image(topic)
+
+    # Chapters finished by an earlier run are not generated again
+    book = Book(topic, book_folder, toc, manifest)
+    chapter_titles = [chapter.title for chapter in book.chapters]
+    pending_chapters = [chapter for chapter in book.chapters if not chapter.done()]
+    pending_titles = [chapter.title for chapter in pending_chapters]
+    if len(pending_titles) < len(chapter_titles):
+        print(f"{len(chapter_titles) - len(pending_titles)} chapters loaded from the manifest, {len(pending_titles)} left to generate.")
+
+    # Chapters drafted while the TOC was reviewed are not written again
+    drafts = speculator.collect(pending_chapters) if speculator is not None else {}
+
+    # Search the web for every chapter and index the pages, so each chapter prompt only carries its own passages
+    research_index = None
+    metrics.set_labels(stage="chapter_research")
+    if pending_titles and isinstance(research_data, dict):
+        research_documents = manifest.load_research() if manifest.stage_done("chapter_research") else None
+        if research_documents is None:
+            research_documents = researcher.research_chapters(topic, chapter_titles)
+            manifest.save_research(research_documents)
+            manifest.mark_stage("chapter_research")
+        research_index = ResearchIndex()
+        # Full chapter pages go first, so a page also found by the topic search keeps its full text
+        for document in research_documents + research_data.get("results", []):
+            research_index.add_document(document)
+
+    # Predict what the rest of the book costs before any chapter is written
+    undrafted_titles = [chapter_title for chapter_title in pending_titles if chapter_title not in drafts]
+    if undrafted_titles:
+        proofread = job.get("proofread", True) if job is not None else True
+        estimate = estimate_book_cost(topic, undrafted_titles, writer, research_data, research_index, generate_images and not manifest.stage_done("images"), proofread)
+        print(f"Estimated cost of the remaining {len(undrafted_titles)} chapters: ${estimate['cost']:.2f} (at most {estimate['prompt_tokens']} prompt and {estimate['completion_tokens']} completion tokens, {estimate['images']} images), rewrites not included")
+        if generation_mode == "Review each chapter":
+            compare_cost = estimate_book_cost(topic, undrafted_titles[:1], writer, research_data, research_index, proofread=False, candidates=chapter_candidates)["cost"]
+            print(f"Comparing {chapter_candidates} drafts of a chapter in review mode adds about ${compare_cost:.2f} each time")
+        predicted_cost = metrics.totals(book_folder)["cost"] + estimate["cost"]
+        if cost_budget and predicted_cost > cost_budget:
+            message = f"The estimated cost of ${predicted_cost:.2f} is over the budget of ${cost_budget:g} for this book"
+            if job is not None:
+                raise BudgetExceeded(message)
+            if get_user_input(f"\n{message}. Continue anyway? The budget still stops the run when it is reached.", ["Yes", "No"]) == "No":
+                raise BudgetExceeded(message)
+
+    metrics.set_labels(stage="chapters")
     if generation_mode == "Fast generation":
-        # Generate all chapters without further prompts
-        for chapter_title in toc:
-            if "SECTION" in chapter_title.upper():
-                continue  # Skip sections
-            chapter_content, chapter_summary = generate_chapter(chapter_title, writer, research_data, generate_images)
-            chapter_file = os.path.join(book_folder, f"{chapter_title.replace(' ', '_')}.md")
-            with open(chapter_file, "w") as file:
-                file.write(chapter_content)
-            chapter_summaries.append(chapter_summary)
-            print(f"\nGenerated and saved content for {chapter_title}")
-            print("="*50 + "\n")
+        # Generate all chapters without further prompts, several at a time
+        for chapter in pending_chapters:
+            if chapter.title in drafts:
+                chapter_content, chapter_summary = drafts[chapter.title]
+                chapter.save(add_chapter_image(chapter, chapter_content) if generate_images else chapter_content, chapter_summary)
+                if generate_images:
+                    designer.submit_chapter_image(chapter)
+        pending_chapters = [chapter for chapter in pending_chapters if chapter.title not in drafts]
+        generate_chapters_concurrently(pending_chapters, writer, research_data, generate_images, tasks, designer=designer if generate_images else None, research_index=research_index)
     else:
         print("="*50 + "\n")
-        # Generate and review each chapter
-        for chapter_title in toc:
-            if "SECTION" in chapter_title.upper():
-                continue  # Skip sections
+        # Generate and review each chapter, streaming it so a bad draft can be stopped with Ctrl+C
+        print("Chapters are shown while they are written, press Ctrl+C to stop a chapter and choose what to do with it.")
+        for chapter in pending_chapters:
+            chapter_title = chapter.title
+            if chapter_title in drafts:
+                # Show the draft written during the TOC review, it can still be modified or regenerated
+                chapter_content, chapter_summary = drafts[chapter_title]
+                if generate_images:
+                    chapter_content = add_chapter_image(chapter, chapter_content)
+                shown = False
+            else:
+                chapter_content, chapter_summary, shown = review_generate_chapter(chapter, writer, research_data, generate_images, research_index=research_index)
             while True:
-                chapter_content, chapter_summary = generate_chapter(chapter_title, writer, research_data, generate_images)
-                print(f"Generated content for {chapter_title}:\n{chapter_content}")
-                action = input(f"\nType a number and hit enter to select an action regarding the content for {chapter_title}? \n Accept = 1 \n Modify = 2 \n Regenerate = 3:\n ")
+                if not shown:
+                    print(f"Generated content for {chapter_title}:\n{chapter_content}")
+                shown = False
+                action = input(f"\nType a number and hit enter to select an action regarding the content for {chapter_title}? \n Accept = 1 \n Modify = 2 \n Regenerate = 3 \n Compare several drafts = 4:\n ")
                 if action.lower() == "1":
+                    if chapter_summary is None:
+                        chapter_summary = summarize_chapter(chapter_content, writer)
                     # Save chapter content to markdown file
-                    chapter_file = os.path.join(book_folder, f"{chapter_title.replace(' ', '_')}.md")
-                    with open(chapter_file, "w") as file:
-                        file.write(chapter_content)
-                    chapter_summaries.append(chapter_summary)
+                    chapter.save(chapter_content, chapter_summary)
+                    if generate_images:
+                        designer.submit_chapter_image(chapter)
                     print(f"\nAccepted content for {chapter_title}")
                     print("="*50 + "\n")
                     break
                 elif action.lower() == "2":
                     chapter_content = input(f"Enter the modified content for {chapter_title}: ")
+                    chapter_summary = None
                 elif action.lower() == "3":
-                    chapter_content, chapter_summary = generate_chapter(chapter_title, writer, research_data)
-
-    # Step 4: Proofread chapters for repeated content
+                    # Regenerate bypasses the response cache to get a new sample
+                    chapter_content, chapter_summary, shown = review_generate_chapter(chapter, writer, research_data, generate_images, fresh=True, research_index=research_index)
+                elif action.lower() == "4":
+                    count = input(f"How many drafts? (default {chapter_candidates}, at most {max_chapter_candidates}): ").strip()
+                    count = min(max_chapter_candidates, max(2, int(count))) if count.isdigit() else chapter_candidates
+                    compare_cost = estimate_book_cost(topic, [chapter_title], writer, research_data, research_index, proofread=False, candidates=count)["cost"]
+                    print(f"Writing {count} drafts costs about ${compare_cost:.2f}")
+                    try:
+                        candidates = generate_chapter_candidates(chapter, writer, research_data, generate_images, count, research_index=research_index)
+                    except KeyboardInterrupt:
+                        print(f"\nStopped the drafts for {chapter_title}, the current draft is kept.")
+                        continue
+                    candidate = choose_candidate(chapter_title, chapter_content, candidates)
+                    if candidate is not None:
+                        # The kept draft is summarized when it is accepted
+                        chapter_content, chapter_summary = candidate, None
+
+    manifest.mark_stage("chapters")
+
+    # Step 4: Proofread chapters for repeated content, using the chapters held in memory
+    metrics.set_labels(stage="proofreading")
     print("="*50 + "\n")
-    chapters = []
-    for chapter_title in toc:
-        if "SECTION" in chapter_title.upper():
-            continue  # Skip sections
-        chapter_file = os.path.join(book_folder, f"{chapter_title.replace(' ', '_')}.md")
-        with open(chapter_file, "r") as file:
-            chapter_content = file.read()
-        chapters.append({"title": chapter_title, "content": chapter_content})
-
-    while True:
-        repeated_content = proofreader.execute_task(chapters)
+    chapters = book.chapters
+
+    if job is not None and not job.get("proofread", True):
+        manifest.mark_stage("proofreading")
+    rewrite_passes = 0
+    while not manifest.stage_done("proofreading"):
+        with tracer.span("proofreading pass", number=rewrite_passes + 1) as span:
+            repeated_content = proofreader.execute_task(chapters)
+            span["repeated_passages"] = len(repeated_content)
         if not repeated_content:
             print("No repeated content found across chapters.")
+            manifest.mark_stage("proofreading")
             break
 
-        user_choice = get_user_input(
-            "\nDo you want to rewrite the repeated content?",
-            ["Yes", "No"]
-        )
+        if job is not None:
+            # Batch jobs rewrite repeated content automatically, a limited number of times
+            user_choice = "Yes" if rewrite_passes < job.get("rewrite_passes", 1) else "No"
+        else:
+            user_choice = get_user_input(
+                "\nDo you want to rewrite the repeated content?",
+                ["Yes", "No"]
+            )
+        rewrite_passes += 1
         if user_choice.lower() == "no":
+            manifest.mark_stage("proofreading")
             break
 
-        # Delegate rewriting to WriterAgent with full context for each repeated content
-        for repeated in repeated_content:
-            max_attempts = 3
-            for chapter in chapters:
-                if repeated in chapter['content']:
-                    attempts = 0
-                    while repeated in chapter['content'] and attempts < max_attempts:
-                        print(f"Rewriting content for chapter: {chapter['title']} (Attempt {attempts + 1})")
-                        print(f"Original repeated content: {repeated}")
-                        # Provide full context to the WriterAgent
-                        context = "\n\n".join([ch['content'] for ch in chapters])
-                        full_book_context = "\n\n".join([ch['content'] for ch in chapters])
-                        new_content = writer.execute_task(
-                            f"Rewrite the following content to make it unique and remove redundancy. Do not add new sections or content:\n{repeated}\n\nFull Book Context:\n{full_book_context}",
-                            research_data
-                        )
-                        chapter['content'] = chapter['content'].replace(repeated, new_content)
-                        print(f"Rewritten content: {new_content}")
-                        attempts += 1
-                    if attempts == max_attempts:
-                        print(f"Max rewrite attempts reached for chapter: {chapter['title']}. Skipping further rewrites.")
-                    # Save the updated chapter content to markdown file
-                    chapter_file = os.path.join(book_folder, f"{chapter['title'].replace(' ', '_')}.md")
-                    with open(chapter_file, "w") as file:
-                        file.write(chapter['content'])
-        else:
-            # Delegate rewriting to WriterAgent with full context for each repeated content
-            for repeated in repeated_content:
-                max_attempts = 3
-                for chapter in chapters:
-                    if repeated in chapter['content']:
-                        attempts = 0
-                        while repeated in chapter['content'] and attempts < max_attempts:
-                            print(f"Rewriting content for chapter: {chapter['title']} (Attempt {attempts + 1})")
-                            print(f"Original repeated content: {repeated}")
-                            # Provide full context to the WriterAgent
-                            context = "\n\n".join([ch['content'] for ch in chapters])
-                            new_content = writer.execute_task(
-                                f"Rewrite the following content to make it unique and remove redundancy:\n{repeated}\n\nContext:\n{context}",
-                                research_data
-                            )
-                            chapter['content'] = chapter['content'].replace(repeated, new_content)
-                            print(f"Rewritten content: {new_content}")
-                            attempts += 1
-                        if attempts == max_attempts:
-                            print(f"Max rewrite attempts reached for chapter: {chapter['title']}. Skipping further rewrites.")
-                        # Save the updated chapter content to markdown file
-                        chapter_file = os.path.join(book_folder, f"{chapter['title'].replace(' ', '_')}.md")
-                        with open(chapter_file, "w") as file:
-                            file.write(chapter['content'])
-
-    # Step 5: Generate cover page design if images are to be generated
-    if generate_images:
+        # Delegate rewriting to WriterAgent, one request per chapter with only the local context
+        rewrite_repeated_content(chapters, repeated_content, writer, research_data, proofreader.duplicate_passages)
+
+    # Step 5: Start the cover page and chapter images not started yet, the export waits for each one where it is needed
+    metrics.set_labels(stage="images")
+    if generate_images and not manifest.stage_done("images"):
         print("\n" + "="*50)
-        designer.execute_task(topic, toc, chapters)
+        designer.execute_task(topic, chapters)
         print("="*50 + "\n")
 
+    # Step 6: Export the ebook, unless an earlier run already did
+    exported = manifest.stage_done("export")
+    if exported:
+        print(f"The ebook in {book_folder} was already exported.")
+    elif export_book(book, designer, writer, pdf_generation_mode, generate_images):
+        manifest.mark_stage("export")
+        exported = True
+    if generate_images and not manifest.stage_done("images"):
+        designer.wait_images()
+        manifest.mark_stage("images")
+    tasks.close()
+
+    # Show where the time and money went and save the per-call report next to the book
     print("\n" + "="*50)
-    print(f"Total tokens used: {total_tokens}")
-    print(f"Total cost: ${total_cost:.4f}")
+    metrics.print_summary(book_folder)
+    report_files = metrics.save_report(os.path.join(book_folder, "metrics"), book_folder)
+    print(f"API call report saved in {' and '.join(report_files)}")
+    if tracer.enabled:
+        print(f"Timeline saved in {tracer.save(os.path.join(book_folder, 'trace.json'), book_folder)}, open it in chrome://tracing or ui.perfetto.dev")
     print("="*50 + "\n")
 
-    return book_folder, toc, topic, designer, writer, chapter_summaries, pdf_generation_mode, generate_images
+    return book, exported
 
-def merge_chapters_into_single_file(book_folder, toc, book_title, designer, writer, generate_images):
-    final_md_content = f"# {book_title}\n\n"
-    if generate_images:
-        final_md_content += f"![Cover Page]({book_folder}/cover_page.png)\n\n"
-    final_md_content += f"### AUTHOR: {writer.llm}\n\n### DESIGNER: {designer.llm}\n\n## Table of Contents\n\n"
-    for chapter_title in toc:
-        if "SECTION" in chapter_title.upper():
-            continue  # Skip sections
-        final_md_content += f"- {chapter_title}\n"
-    final_md_content += "\n"
-    for chapter_title in toc:
-        if "SECTION" in chapter_title.upper():
-            continue  # Skip sections
-        chapter_file = os.path.join(book_folder, f"{chapter_title.replace(' ', '_')}.md")
-        with open(chapter_file, "r") as file:
-            chapter_content = file.read()
-            final_md_content += f"\n\n" + chapter_content + "\n\n"
-    final_md_content += "Thank you for reading.\n"
-    final_md_file = os.path.join(book_folder, f"{book_title.replace(' ', '_')}.md")
-    with open(final_md_file, "w") as file:
-        file.write(final_md_content)
-    print(f"All chapters merged into {final_md_file}")
-    return final_md_file
 import subprocess
 import os
-from PyPDF2 import PdfMerger
 
 def convert_md_to_pdf(md_file, pdf_file):
-    try:
-        print(f"Running command: markdown-pdf {md_file} -o {pdf_file}")
-        result = subprocess.run(["markdown-pdf", md_file, "-o", pdf_file], check=True, capture_output=True, text=True)
-        print(f"Subprocess output: {result.stdout}")
-        print(f"Subprocess error (if any): {result.stderr}")
-        print(f"Converted {md_file} to {pdf_file}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error converting {md_file} to PDF: {e}")
-
-def merge_pdfs(pdf_files, output_pdf):
-    merger = PdfMerger()
-    for pdf in pdf_files:
-        merger.append(pdf)
-    merger.write(output_pdf)
-    merger.close()
-    print(f"Merged PDFs into {output_pdf}")
+    with tracer.span("pdf render", md_file=md_file):
+        try:
+            print(f"Running command: markdown-pdf {md_file} -o {pdf_file}")
+            result = subprocess.run(["markdown-pdf", md_file, "-o", pdf_file], check=True, capture_output=True, text=True)
+            print(f"Subprocess output: {result.stdout}")
+            print(f"Subprocess error (if any): {result.stderr}")
+            print(f"Converted {md_file} to {pdf_file}")
+            return True
+        except (subprocess.CalledProcessError, FileNotFoundError) as e:
+            print(f"Error converting {md_file} to PDF: {e}")
+            return False
+
+# Function to fingerprint a markdown file together with the images it embeds
+def markdown_fingerprint(md_file):
+    with open(md_file, "r") as file:
+        md_content = file.read()
+    fingerprint = hashlib.sha256(md_content.encode("utf-8"))
+    for image_path in re.findall(r"!\[[^\]]*\]\(([^)]+)\)", md_content):
+        if os.path.exists(image_path):
+            image_stat = os.stat(image_path)
+            fingerprint.update(f"{image_path}:{image_stat.st_size}:{image_stat.st_mtime_ns}".encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+# Function to load the fingerprints of the markdown files the PDFs of a book were made from
+def load_pdf_hashes(book_folder):
+    hashes_file = os.path.join(book_folder, ".pdf_hashes.json")
+    if os.path.exists(hashes_file):
+        with open(hashes_file, "r") as file:
+            return json.load(file)
+    return {}
+
+
+def save_pdf_hashes(book_folder, pdf_hashes):
+    with open(os.path.join(book_folder, ".pdf_hashes.json"), "w") as file:
+        json.dump(pdf_hashes, file, indent=2)
+
+
+# Function to convert a markdown file to PDF, skipping it if it is unchanged since its last PDF
+def render_pdf(md_file, pdf_file, pdf_hashes):
+    fingerprint = markdown_fingerprint(md_file)
+    if os.path.exists(pdf_file) and pdf_hashes.get(pdf_file) == fingerprint:
+        print(f"Skipping {md_file}, unchanged since {pdf_file} was created")
+        return True
+    if convert_md_to_pdf(md_file, pdf_file):
+        pdf_hashes[pdf_file] = fingerprint
+        return True
+    pdf_hashes.pop(pdf_file, None)
+    return False
+
+
+# PyPDF2 is imported by the methods that use it, so it is only loaded when PDFs are merged
+class StreamingPdfWriter:
+    """Writes a merged PDF object by object, so only one source PDF is held in memory at a time."""
+
+    def __init__(self, output_pdf):
+        self.file = open(output_pdf, "wb")
+        self.file.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        self.offsets = {}
+        self.next_number = 1
+        # Identical streams, such as fonts and images used by several chapters, are written once
+        self.shared_streams = {}
+        self.page_numbers = []
+        self.outline = []
+        self.pages_root = self.reserve()
+
+    def reserve(self):
+        number = self.next_number
+        self.next_number += 1
+        return number
+
+    def serialize(self, obj, out, ref):
+        from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+        if isinstance(obj, IndirectObject):
+            # References created by this writer already hold output object numbers
+            out.write(b"%d 0 R" % (obj.idnum if obj.pdf is None else ref(obj)))
+        elif isinstance(obj, DictionaryObject):
+            out.write(b"<<")
+            for key, value in obj.items():
+                if isinstance(obj, StreamObject) and key == "/Length":
+                    continue
+                out.write(b"\n")
+                key.write_to_stream(out, None)
+                out.write(b" ")
+                self.serialize(value, out, ref)
+            if isinstance(obj, StreamObject):
+                out.write(b"\n/Length %d\n>>\nstream\n" % len(obj._data))
+                out.write(obj._data)
+                out.write(b"\nendstream")
+            else:
+                out.write(b"\n>>")
+        elif isinstance(obj, ArrayObject):
+            out.write(b"[")
+            for value in obj:
+                out.write(b" ")
+                self.serialize(value, out, ref)
+            out.write(b" ]")
+        else:
+            obj.write_to_stream(out, None)
+
+    def write_object(self, number, obj, ref):
+        out = io.BytesIO()
+        self.serialize(obj, out, ref)
+        self.offsets[number] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % number)
+        self.file.write(out.getvalue())
+        self.file.write(b"\nendobj\n")
+
+    def append(self, pdf_file, title=None):
+        from PyPDF2 import PdfReader
+        with open(pdf_file, "rb") as stream:
+            self.append_reader(PdfReader(stream), title)
+
+    def append_reader(self, reader, title):
+        from PyPDF2.generic import DictionaryObject, IndirectObject, NameObject, StreamObject
+        numbers = {}
+        queue = []
+
+        def ref(indirect):
+            if indirect.idnum not in numbers:
+                obj = indirect.get_object()
+                key = None
+                if isinstance(obj, StreamObject):
+                    key = hashlib.sha256(repr(sorted((k, repr(v)) for k, v in obj.items() if k != "/Length")).encode("utf-8") + obj._data).hexdigest()
+                if key is not None and key in self.shared_streams:
+                    numbers[indirect.idnum] = self.shared_streams[key]
+                else:
+                    numbers[indirect.idnum] = self.reserve()
+                    if key is not None:
+                        self.shared_streams[key] = numbers[indirect.idnum]
+                    queue.append((numbers[indirect.idnum], obj))
+            return numbers[indirect.idnum]
+
+        # Pages are numbered before anything is written, so links and annotations that point to a page
+        # reference the page written here instead of a second copy of it
+        first_page = len(self.page_numbers)
+        page_numbers = []
+        for page in reader.pages:
+            page_numbers.append(self.reserve())
+            numbers[page.indirect_reference.idnum] = page_numbers[-1]
+        for page, page_number in zip(reader.pages, page_numbers):
+            page_dict = DictionaryObject({key: value for key, value in page.items() if key != "/Parent"})
+            page_dict[NameObject("/Parent")] = IndirectObject(self.pages_root, 0, None)
+            self.write_object(page_number, page_dict, ref)
+            self.page_numbers.append(page_number)
+            # Write every object the page uses right away, then forget it
+            while queue:
+                number, obj = queue.pop()
+                self.write_object(number, obj, ref)
+        if title and len(self.page_numbers) > first_page:
+            self.outline.append((title, self.page_numbers[first_page]))
+        # PyPDF2 readers hold reference cycles, drop the parsed objects now instead of at the next garbage collection
+        reader.resolved_objects.clear()
+
+    def close(self):
+        from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, TextStringObject
+        kids = ArrayObject(IndirectObject(number, 0, None) for number in self.page_numbers)
+        self.write_object(self.pages_root, DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): kids,
+            NameObject("/Count"): NumberObject(len(self.page_numbers))
+        }), None)
+
+        # Bookmarks: one outline item per part, pointing to its first page
+        catalog = DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(self.pages_root, 0, None)
+        })
+        if self.outline:
+            outline_root = self.reserve()
+            item_numbers = [self.reserve() for _ in self.outline]
+            for position, (title, page_number) in enumerate(self.outline):
+                item = DictionaryObject({
+                    NameObject("/Title"): TextStringObject(title),
+                    NameObject("/Parent"): IndirectObject(outline_root, 0, None),
+                    NameObject("/Dest"): ArrayObject([IndirectObject(page_number, 0, None), NameObject("/Fit")])
+                })
+                if position > 0:
+                    item[NameObject("/Prev")] = IndirectObject(item_numbers[position - 1], 0, None)
+                if position < len(item_numbers) - 1:
+                    item[NameObject("/Next")] = IndirectObject(item_numbers[position + 1], 0, None)
+                self.write_object(item_numbers[position], item, None)
+            self.write_object(outline_root, DictionaryObject({
+                NameObject("/Type"): NameObject("/Outlines"),
+                NameObject("/First"): IndirectObject(item_numbers[0], 0, None),
+                NameObject("/Last"): IndirectObject(item_numbers[-1], 0, None),
+                NameObject("/Count"): NumberObject(len(item_numbers))
+            }), None)
+            catalog[NameObject("/Outlines")] = IndirectObject(outline_root, 0, None)
+            catalog[NameObject("/PageMode")] = NameObject("/UseOutlines")
+        catalog_number = self.reserve()
+        self.write_object(catalog_number, catalog, None)
+
+        # Cross-reference table and trailer
+        xref_offset = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_number)
+        for number in range(1, self.next_number):
+            self.file.write(b"%010d 00000 n \n" % self.offsets[number])
+        self.file.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_number, catalog_number, xref_offset))
+        self.file.close()
+
+
+# Function to merge PDFs into one file with a bookmark for each part
+def merge_pdfs(pdf_files, output_pdf, outline_titles=None):
+    with tracer.span("pdf merge", output_pdf=output_pdf, files=len(pdf_files)):
+        outline_titles = outline_titles or [None] * len(pdf_files)
+        writer = StreamingPdfWriter(output_pdf)
+        try:
+            for pdf_file, title in zip(pdf_files, outline_titles):
+                writer.append(pdf_file, title)
+        finally:
+            writer.close()
+        print(f"Merged PDFs into {output_pdf}")
+
+# Function to write the cover, TOC and back cover pages and export the ebook as PDF
+def export_book(book, designer, writer, pdf_generation_mode, generate_images):
+    metrics.set_labels(stage="export")
+    tasks = designer.tasks
+    single_file = pdf_generation_mode == "Single long PDF"
+    # With Pillow, every image is transcoded as soon as it is saved and the export variant is embedded
+    image_variant = image_export_variant if generate_images and Image is not None else None
+    if generate_images and Image is None:
+        print("Pillow is not installed, the images are exported as generated. Install it with: pip install pillow")
+    image_tasks = {}
+    if generate_images:
+        for image_path in [book.cover_image_path] + [chapter.image_path for chapter in book.chapters]:
+            if image_variant:
+                image_tasks[image_path] = designer.submit_variants(image_path)
+            elif image_path in designer.image_futures:
+                image_tasks[image_path] = designer.image_futures[image_path]
 
-if __name__ == "__main__":
-    book_folder, toc, topic, designer, writer, chapter_summaries, pdf_generation_mode, generate_images = main()
-
-    # Generate cover page markdown
-    cover_md_content = f"# {topic}\n\n![Cover Page]({book_folder}/cover_page.png)\n\n### AUTHOR: {writer.llm}\n\n### DESIGNER: {designer.llm}\n"
-    cover_md_file = os.path.join(book_folder, "cover.md")
-    with open(cover_md_file, "w") as file:
-        file.write(cover_md_content)
-
-    # Generate table of contents markdown
-    toc_md_content = "## Table of Contents\n\n"
-    for chapter_title in toc:
-        if "SECTION" in chapter_title.upper():
-            continue  # Skip sections
-        toc_md_content += f"- {chapter_title}\n"
-    toc_md_file = os.path.join(book_folder, "toc.md")
-    with open(toc_md_file, "w") as file:
-        file.write(toc_md_content)
-
-    # Generate back cover markdown
-    back_cover_md_content = "## Thank you for reading.\n"
-    back_cover_md_file = os.path.join(book_folder, "back_cover.md")
-    with open(back_cover_md_file, "w") as file:
-        file.write(back_cover_md_content)
-
-    if pdf_generation_mode == "Single long PDF":
-        # Merge all markdown files into a single markdown file
-        final_md_file = merge_chapters_into_single_file(book_folder, toc, topic, designer, writer, generate_images)
+    # Write the cover, TOC and back cover markdown, and the merged book for a single PDF, in one pass
+    with tracer.span("markdown", single_file=single_file):
+        book.write_markdown(writer.llm, designer.llm, generate_images, single_file, image_variant)
+
+    # Every PDF is rendered as soon as the images it embeds are ready, several markdown-pdf processes at a time
+    pdf_hashes = load_pdf_hashes(book.folder)
+
+    def render(md_file, pdf_file, image_paths=()):
+        after = [image_tasks[image_path] for image_path in image_paths if image_path in image_tasks]
+        return tasks.add(f"pdf:{pdf_file}", render_pdf, md_file, pdf_file, pdf_hashes, after=after, resource="render")
+
+    if single_file:
         # Convert the single markdown file to a PDF
-        final_pdf_file = final_md_file.replace(".md", ".pdf")
         print("\n" + "="*50)
-        convert_md_to_pdf(final_md_file, final_pdf_file)
+        converted = render(book.md_file, book.pdf_file, image_tasks).result()
+        save_pdf_hashes(book.folder, pdf_hashes)
         print("="*50 + "\n")
+        return converted
     else:
         # Convert markdown files to PDFs
-        cover_pdf_file = cover_md_file.replace(".md", ".pdf")
-        toc_pdf_file = toc_md_file.replace(".md", ".pdf")
-        back_cover_pdf_file = back_cover_md_file.replace(".md", ".pdf")
-
-        print("\n" + "="*50)
-        convert_md_to_pdf(cover_md_file, cover_pdf_file)
-        print("="*50 + "\n")
-        print("\n" + "="*50)
-        convert_md_to_pdf(toc_md_file, toc_pdf_file)
-        print("="*50 + "\n")
         print("\n" + "="*50)
-        convert_md_to_pdf(back_cover_md_file, back_cover_pdf_file)
+        pdf_tasks = [
+            render(book.cover_md_file, book.cover_pdf_file, [book.cover_image_path]),
+            render(book.toc_md_file, book.toc_pdf_file),
+            render(book.back_cover_md_file, book.back_cover_pdf_file)
+        ]
+        pdf_tasks += [render(chapter.export_path(image_variant), chapter.pdf_path, [chapter.image_path]) for chapter in book.chapters]
+        converted = all([pdf_task.result() for pdf_task in pdf_tasks])
+        save_pdf_hashes(book.folder, pdf_hashes)
         print("="*50 + "\n")
 
-        chapter_pdf_files = []
-        for chapter_title in toc:
-            if "SECTION" in chapter_title.upper():
-                continue  # Skip sections
-            chapter_md_file = os.path.join(book_folder, f"{chapter_title.replace(' ', '_')}.md")
-            chapter_pdf_file = chapter_md_file.replace(".md", ".pdf")
-            print("\n" + "="*50)
-            convert_md_to_pdf(chapter_md_file, chapter_pdf_file)
-            print("="*50 + "\n")
-            chapter_pdf_files.append(chapter_pdf_file)
+        # Do not merge an incomplete book, resuming retries the export
+        if not converted:
+            print("Some PDF files could not be created, skipping the merge.")
+            return False
 
         # Merge all PDFs into a single PDF
-        all_pdfs = [cover_pdf_file, toc_pdf_file] + chapter_pdf_files + [back_cover_pdf_file]
-        final_pdf_file = os.path.join(book_folder, f"{topic.replace(' ', '_')}.pdf")
         print("\n" + "="*50)
-        merge_pdfs(all_pdfs, final_pdf_file)
+        merge_book_pdfs(book)
         print("="*50 + "\n")
+        return True
+
+
+# Function to merge the cover, TOC, chapter and back cover PDFs of a book into its PDF, with a bookmark for each
+def merge_book_pdfs(book):
+    parts = book.pdf_parts()
+    merge_pdfs([pdf_file for pdf_file, _ in parts], book.pdf_file, [title for _, title in parts])
+
+
+# Function to export a book folder of an earlier run again, with the options chosen then and without API calls
+def export_folder(book_folder, tasks, pdf_generation_mode=None):
+    book = Book.load(book_folder)
+    manifest = book.manifest
+    if not manifest.stage_done("chapters"):
+        print(f"The chapters of {book.folder} are not finished, continue the run with --resume {book.folder}")
+        return False
+    options = manifest.get("options")
+    generate_images = options.get("generate_images", False)
+    if generate_images:
+        missing_images = [image_path for image_path in [book.cover_image_path] + [chapter.image_path for chapter in book.chapters] if not os.path.exists(image_path)]
+        if missing_images:
+            print(f"{len(missing_images)} images of {book.folder} were never generated, continue the run with --resume {book.folder} to add them")
+    metrics.set_labels(book=book.folder)
+    exported = export_book(book, DesignerAgent(book.folder, tasks, book.manifest), WriterAgent(), pdf_generation_mode or options.get("pdf_generation_mode", "Single long PDF"), generate_images)
+    if exported:
+        manifest.mark_stage("export")
+    if tracer.enabled:
+        # Kept apart from the trace.json of the run that generated the book
+        tracer.save(os.path.join(book.folder, "export_trace.json"), book.folder)
+    return exported
+
+
+# Function to merge the part PDFs of a chapter-broken book folder again, without rendering anything
+def merge_folder(book_folder):
+    book = Book.load(book_folder)
+    missing = [pdf_file for pdf_file, _ in book.pdf_parts() if not os.path.exists(pdf_file)]
+    if missing:
+        print(f"{len(missing)} PDFs of {book.folder} are missing, such as {missing[0]}; export the book first")
+        return False
+    merge_book_pdfs(book)
+    return True
+
+
+# Function to print the progress, output and API usage of a book folder from its manifest and metrics report
+def print_book_stats(book_folder):
+    book = Book.load(book_folder)
+    stages = [stage for stage, status in book.manifest.get("stages", {}).items() if status == "done"]
+    print(f"{book.topic} ({book.folder})")
+    print(f"Chapters done: {sum(chapter.done() for chapter in book.chapters)} of {len(book.chapters)}")
+    print(f"Stages done: {', '.join(stages) or 'none'}")
+    if os.path.exists(book.pdf_file):
+        print(f"PDF: {book.pdf_file} ({os.path.getsize(book.pdf_file) / 1024 / 1024:.1f} MB)")
+    report_path = os.path.join(book.folder, "metrics.json")
+    if not os.path.exists(report_path):
+        print("No metrics report, the run has not finished yet")
+        return None
+    with open(report_path, "r") as file:
+        report = json.load(file)
+    MetricsCollector.print_report(report["stages"], report["totals"])
+    return report["totals"]
+
+
+# Function to run the export, merge or stats command on book folders, exporting several books at a time
+def run_folder_command(command, book_folders, book_workers=1, pdf_generation_mode=None):
+    tasks = book_task_graph()
+    totals = []
+
+    def run(book_folder):
+        started = time.time()
+        try:
+            if command == "export":
+                succeeded = export_folder(book_folder, tasks, pdf_generation_mode)
+            elif command == "merge":
+                succeeded = merge_folder(book_folder)
+            else:
+                book_totals = print_book_stats(book_folder)
+                if book_totals is not None:
+                    totals.append(book_totals)
+                succeeded = True
+        except FileNotFoundError as e:
+            print(f"{book_folder} is not a book folder, {e.filename} is missing")
+            succeeded = False
+        except Exception as e:
+            print(f"{command} failed for {book_folder} ({type(e).__name__}: {e})")
+            succeeded = False
+        return succeeded, round(time.time() - started, 1)
+
+    results = []
+    if command == "export" and book_workers > 1:
+        # The books share one task graph, so PDF renders and transcodes stay within their limits across books
+        with ThreadPoolExecutor(max_workers=book_workers) as executor:
+            futures = {submit_with_labels(executor, run, book_folder): book_folder for book_folder in book_folders}
+            for future in as_completed(futures):
+                succeeded, seconds = future.result()
+                results.append(succeeded)
+                print(f"[{len(results)}/{len(book_folders)}] {'done' if succeeded else 'failed'}: {futures[future]} ({seconds}s)")
+    else:
+        for book_folder in book_folders:
+            succeeded, seconds = run(book_folder)
+            results.append(succeeded)
+            if command == "stats":
+                print("="*50)
+            else:
+                print(f"[{len(results)}/{len(book_folders)}] {'done' if succeeded else 'failed'}: {book_folder} ({seconds}s)")
+    tasks.close()
+
+    if command == "stats" and len(totals) > 1:
+        print(f"{len(totals)} books: {sum(total['prompt_tokens'] + total['completion_tokens'] for total in totals)} tokens, ${sum(total['cost'] for total in totals):.4f}")
+    elif command != "stats":
+        print(f"{sum(results)} of {len(book_folders)} books {'exported' if command == 'export' else 'merged'}")
+    return all(results)
+
+
+# Function to read batch jobs from a JSONL or YAML file
+def load_jobs(job_file):
+    with open(job_file, "r") as file:
+        if job_file.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit("PyYAML is needed for YAML job files, install it with: pip install pyyaml")
+            jobs = yaml.safe_load(file) or []
+            if isinstance(jobs, dict):
+                jobs = jobs.get("books", [])
+        else:
+            jobs = [json.loads(line) for line in file if line.strip()]
+    for job in jobs:
+        if not job.get("topic"):
+            raise SystemExit(f"Every job in {job_file} needs a topic: {job}")
+    return jobs
+
+
+# Function to generate and export one book of a batch without prompts
+def run_job(job):
+    started = time.time()
+    result = {"topic": job["topic"]}
+    try:
+        book, exported = main(job=job)
+        result.update({
+            "status": "done" if exported else "export_failed",
+            "book_folder": book.folder,
+            "chapters": len(book.chapters),
+            "pdf": book.pdf_file if exported else None,
+            "cost": metrics.totals(book.folder)["cost"]
+        })
+    except Exception as e:
+        result.update({"status": "failed", "error": f"{type(e).__name__}: {e}"})
+    result["seconds"] = round(time.time() - started, 1)
+
+    # Save the result next to the book so every folder documents its own run
+    book_folder = result.get("book_folder") or job.get("book_folder") or job["topic"].replace(" ", "_")
+    if os.path.isdir(book_folder):
+        with open(os.path.join(book_folder, "result.json"), "w") as file:
+            json.dump(result, file, indent=2)
+    return result
+
+
+# Function to generate many books from a job file, several books at a time
+def run_batch(job_file, book_workers):
+    jobs = load_jobs(job_file)
+    print(f"Generating {len(jobs)} books, {book_workers} at a time, at most {max_inflight_requests} API requests in flight")
+    results = []
+    with ThreadPoolExecutor(max_workers=book_workers) as executor:
+        # Each book runs in its own copy of the metrics labels
+        futures = [submit_with_labels(executor, run_job, job) for job in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"[{len(results)}/{len(jobs)}] {result['status']}: {result['topic']} ({result['seconds']}s)")
+
+    results_file = os.path.splitext(job_file)[0] + "_results.jsonl"
+    with open(results_file, "w") as file:
+        for result in results:
+            file.write(json.dumps(result) + "\n")
+    print("\n" + "="*50)
+    print(f"{sum(result['status'] == 'done' for result in results)} of {len(jobs)} books done, results saved in {results_file}")
+    metrics.print_summary()
+    report_files = metrics.save_report(os.path.splitext(job_file)[0] + "_metrics")
+    print(f"API call report for all books saved in {' and '.join(report_files)}")
+    if tracer.enabled:
+        print(f"Timeline of all books saved in {tracer.save(os.path.splitext(job_file)[0] + '_trace.json')}")
+    print("="*50 + "\n")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create an ebook using AI agents.")
+    parser.add_argument("--resume", metavar="BOOK_FOLDER", help="resume an interrupted run from the manifest saved in BOOK_FOLDER")
+    parser.add_argument("--batch", metavar="JOB_FILE", help="generate every book listed in a JSONL or YAML job file without prompts")
+    parser.add_argument("--book-workers", type=int, default=2, help="number of books generated at the same time in batch mode (default: 2)")
+    # Commands on book folders of earlier runs; they make no API calls and never load the OpenAI client
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    export_parser = subparsers.add_parser("export", help="export generated book folders again")
+    export_parser.add_argument("book_folders", nargs="+", metavar="BOOK_FOLDER")
+    export_parser.add_argument("--pdf-mode", choices=["Single long PDF", "Chapter-broken PDF"], help="export mode, by default the one chosen when the book was generated")
+    export_parser.add_argument("--book-workers", type=int, default=2, help="number of books exported at the same time (default: 2)")
+    merge_parser = subparsers.add_parser("merge", help="merge the chapter PDFs of chapter-broken book folders again")
+    merge_parser.add_argument("book_folders", nargs="+", metavar="BOOK_FOLDER")
+    stats_parser = subparsers.add_parser("stats", help="show the progress and API usage of book folders")
+    stats_parser.add_argument("book_folders", nargs="+", metavar="BOOK_FOLDER")
+    args = parser.parse_args()
+    logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s", stream=sys.stdout)
+
+    if args.command:
+        succeeded = run_folder_command(args.command, args.book_folders, max(1, args.book_workers), getattr(args, "pdf_mode", None))
+        sys.exit(0 if succeeded else 1)
+    elif args.batch:
+        run_batch(args.batch, max(1, args.book_workers))
+    else:
+        try:
+            main(resume_folder=args.resume)
+        except BudgetExceeded as e:
+            raise SystemExit(f"{e}. The progress is saved, raise BOOK_TOKEN_BUDGET or BOOK_COST_BUDGET and continue with --resume.")
@@ -0,0 +1,27 @@
+import os
+import sys
+
+# Tests run offline: no API key, the mock backend and no response cache on disk
+os.environ.pop("OPENAI_API_KEY", None)
+os.environ["MODEL_BACKEND"] = "mock"
+os.environ["MOCK_LATENCY"] = "0"
+os.environ["RESPONSE_CACHE"] = "0"
+os.environ["TRACE"] = "0"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import ebook_project
+
+
+@pytest.fixture
+def make_chapters(tmp_path):
+    # Function to return the chapters of a book in a temporary folder with the given contents
+    def make(contents):
+        toc = [f"CHAPTER {number:02d} - Part {number}" for number in range(1, len(contents) + 1)]
+        book = ebook_project.Book("Proofreading Test", str(tmp_path), toc, ebook_project.RunManifest(str(tmp_path)))
+        for chapter, content in zip(book.chapters, contents):
+            chapter.save(content)
+        return book.chapters
+    return make
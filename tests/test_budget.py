@@ -0,0 +1,49 @@
+import pytest
+
+import ebook_project
+
+
+def test_calls_checked_before_any_is_recorded_share_the_budget():
+    metrics = ebook_project.MetricsCollector(ebook_project.model_pricing)
+    price = metrics.price("chat", "gpt-4o", 1000, 1000)
+    metrics.set_budget("book", cost=price * 3.5)
+
+    with metrics.labels(book="book"):
+        # Three calls fit the budget, the fourth is refused although none of them has been recorded yet
+        reservations = [metrics.check_budget("chat", "gpt-4o", 1000, 1000) for _ in range(3)]
+        with pytest.raises(ebook_project.BudgetExceeded):
+            metrics.check_budget("chat", "gpt-4o", 1000, 1000)
+
+        # A call that used fewer tokens than reserved and a failed call leave room for two more
+        metrics.record("chat", "gpt-4o", 100, 100, reservation=reservations[0])
+        metrics.release(reservations[1])
+        reservations.append(metrics.check_budget("chat", "gpt-4o", 1000, 1000))
+        reservations.append(metrics.check_budget("chat", "gpt-4o", 1000, 1000))
+        with pytest.raises(ebook_project.BudgetExceeded):
+            metrics.check_budget("chat", "gpt-4o", 1000, 1000)
+
+
+def test_token_budget_counts_reserved_tokens():
+    metrics = ebook_project.MetricsCollector(ebook_project.model_pricing)
+    metrics.set_budget("book", tokens=5000)
+
+    with metrics.labels(book="book"):
+        metrics.check_budget("chat", "gpt-4o", 1000, 1000)
+        metrics.check_budget("chat", "gpt-4o", 1000, 1000)
+        with pytest.raises(ebook_project.BudgetExceeded):
+            metrics.check_budget("chat", "gpt-4o", 1000, 1000)
+
+
+def test_prompts_are_shortened_to_the_context_window(monkeypatch):
+    monkeypatch.setitem(ebook_project.model_context, "small-model", 1000)
+    messages = [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": "word " * 3000}]
+
+    fitted, prompt_tokens = ebook_project.fit_messages(messages, 200, "small-model")
+    assert prompt_tokens <= 800
+    assert fitted[0] == messages[0]
+
+
+def test_models_without_a_known_context_window_are_refused():
+    messages = [{"role": "user", "content": "Write a chapter"}]
+    with pytest.raises(ebook_project.UnknownContextWindow, match="MODEL_CONTEXT"):
+        ebook_project.fit_messages(messages, 100, "unknown-model")
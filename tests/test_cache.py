@@ -0,0 +1,51 @@
+import itertools
+
+import pytest
+
+import ebook_project
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Every call to time.time is one second later, so the order of use is never a tie
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(ebook_project.time, "time", lambda: float(next(ticks)))
+
+
+def test_least_recently_used_entry_is_evicted_past_the_size_limit(tmp_path, clock):
+    cache = ebook_project.ResponseCache(str(tmp_path / "cache" / "responses.sqlite"), 300)
+    for key in ["a", "b", "c"]:
+        cache.put(key, key.encode() * 100)
+    # Reading "a" makes "b" the least recently used entry
+    assert cache.get("a") == b"a" * 100
+
+    cache.put("d", b"d" * 100)
+    assert cache.get("b") is None
+    assert [cache.get(key) is not None for key in ["a", "c", "d"]] == [True, True, True]
+    assert cache.total_bytes == 300
+
+    # Replacing an entry counts its new size only once
+    cache.put("d", b"d" * 50)
+    assert cache.total_bytes == 250
+
+
+def test_cache_is_kept_between_runs(tmp_path, clock):
+    path = str(tmp_path / "responses.sqlite")
+    cache = ebook_project.ResponseCache(path, 10000)
+    cache.put_json("answer", {"content": "Chapter text", "tokens_used": 12})
+    cache.connection.close()
+
+    reopened = ebook_project.ResponseCache(path, 10000)
+    assert reopened.get_json("answer") == {"content": "Chapter text", "tokens_used": 12}
+    assert reopened.total_bytes == cache.total_bytes
+    assert reopened.get_json("missing") is None
+
+
+def test_cache_keys_are_stable():
+    messages = [{"role": "user", "content": "Hello"}]
+    key = ebook_project.ResponseCache.make_key("chat", model="gpt-4o", messages=messages, max_tokens=100)
+    # Keys saved by earlier runs stay valid, whatever the order of the parameters
+    assert key == "cde0ff8326f8b90aae07186ec29bbff61451c83f166127a9c3dafdfc62c3acd2"
+    assert key == ebook_project.ResponseCache.make_key("chat", max_tokens=100, messages=messages, model="gpt-4o")
+    assert key != ebook_project.ResponseCache.make_key("chat", model="gpt-4o", messages=messages, max_tokens=101)
+    assert key != ebook_project.ResponseCache.make_key("image", model="gpt-4o", messages=messages, max_tokens=100)
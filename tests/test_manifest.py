@@ -0,0 +1,76 @@
+import json
+import sys
+import threading
+
+import ebook_project
+
+
+def test_chapters_marked_from_many_threads_are_all_saved(tmp_path):
+    manifest = ebook_project.RunManifest(str(tmp_path))
+    errors = []
+
+    def mark(start):
+        try:
+            for number in range(start, start + 50):
+                manifest.mark_chapter(f"CHAPTER {number}", f"chapter_{number}.md", f"content {number}")
+        except Exception as e:
+            errors.append(e)
+
+    # Switch threads often so a chapter is marked while another thread writes the manifest
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=mark, args=(start,)) for start in range(0, 400, 50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    assert errors == []
+    with open(tmp_path / "manifest.json") as file:
+        assert len(json.load(file)["chapters"]) == 400
+
+
+def test_resume_skips_only_unchanged_chapters(tmp_path):
+    folder = str(tmp_path)
+    book = ebook_project.Book("Resume Test", folder, ["CHAPTER 01 - One", "SECTION A", "CHAPTER 02 - Two"], ebook_project.RunManifest(folder))
+    book.manifest.set("toc", book.toc)
+    book.manifest.mark_stage("toc")
+    first, second = book.chapters
+    first.save("# One\n\nFirst chapter.", "Summary of one")
+    second.save("# Two\n\nSecond chapter.")
+
+    # A later run loads the manifest from the folder
+    manifest = ebook_project.RunManifest.load(folder)
+    assert manifest.stage_done("toc")
+    assert not manifest.stage_done("chapters")
+    assert manifest.get("toc") == book.toc
+    assert manifest.chapter_summary("CHAPTER 01 - One") == "Summary of one"
+    assert manifest.chapter_done("CHAPTER 01 - One", ebook_project.RunManifest.content_hash("# One\n\nFirst chapter."))
+    # A chapter edited since it was saved is written again
+    assert not manifest.chapter_done("CHAPTER 02 - Two", ebook_project.RunManifest.content_hash("# Two\n\nEdited."))
+    assert not manifest.chapter_done("CHAPTER 03 - Three", ebook_project.RunManifest.content_hash(""))
+
+
+def test_images_saved_before_a_failure_are_not_generated_again(tmp_path):
+    folder = str(tmp_path)
+    image_path = f"{folder}/cover_page.png"
+
+    def image_calls():
+        return [record for record in ebook_project.metrics.select(folder) if record["kind"] == "image"]
+
+    with ebook_project.metrics.labels(book=folder):
+        tasks = ebook_project.book_task_graph()
+        designer = ebook_project.DesignerAgent(folder, tasks, ebook_project.RunManifest(folder))
+        assert designer.save_image("A cover", image_path, "Cover")
+        tasks.close()
+        assert len(image_calls()) == 1
+
+        # The run stops before the images stage is marked done, and --resume loads the manifest again
+        tasks = ebook_project.book_task_graph()
+        designer = ebook_project.DesignerAgent(folder, tasks, ebook_project.RunManifest.load(folder))
+        assert designer.save_image("A cover", image_path, "Cover")
+        tasks.close()
+        assert len(image_calls()) == 1
@@ -0,0 +1,87 @@
+import re
+
+import pytest
+
+PyPDF2 = pytest.importorskip("PyPDF2")
+
+import ebook_project
+
+
+# Function to write a PDF whose pages each link to the next page with an annotation that points back to its own page
+def write_linked_pdf(path, pages, label):
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    catalog = add(None)
+    page_tree = add(None)
+    font = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_ids = [add(None) for _ in range(pages)]
+    for number, page_id in enumerate(page_ids):
+        content = b"BT /F1 18 Tf 56 700 Td (%s page %d) Tj ET" % (label.encode(), number + 1)
+        content_id = add(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        next_page = page_ids[(number + 1) % pages]
+        annotation = add(b"<< /Type /Annot /Subtype /Link /Rect [56 690 300 720] /P %d 0 R /Dest [%d 0 R /Fit] >>" % (page_id, next_page))
+        objects[page_id - 1] = (
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Annots [%d 0 R] >>" % (page_tree, content_id, font, annotation)
+        )
+    objects[catalog - 1] = b"<< /Type /Catalog /Pages %d 0 R >>" % page_tree
+    objects[page_tree - 1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % page_id for page_id in page_ids), pages)
+
+    with open(path, "wb") as file:
+        file.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(file.tell())
+            file.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = file.tell()
+        file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            file.write(b"%010d 00000 n \n" % offset)
+        file.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog, xref))
+
+
+def test_merge_keeps_links_on_the_merged_pages(tmp_path):
+    pdf_files = []
+    for label in ["a", "b", "c"]:
+        pdf_files.append(str(tmp_path / f"{label}.pdf"))
+        write_linked_pdf(pdf_files[-1], 5, label)
+    output_pdf = str(tmp_path / "book.pdf")
+
+    ebook_project.merge_pdfs(pdf_files, output_pdf, ["A", "B", "C"])
+
+    with open(output_pdf, "rb") as file:
+        data = file.read()
+    # Every page is written once and there is a single page tree
+    assert len(re.findall(rb"/Type /Page(?!s)", data)) == 15
+    assert len(re.findall(rb"/Type /Pages", data)) == 1
+
+    reader = PyPDF2.PdfReader(output_pdf)
+    assert len(reader.pages) == 15
+    page_ids = [page.indirect_reference.idnum for page in reader.pages]
+    for index, page in enumerate(reader.pages):
+        annotation = page["/Annots"][0].get_object()
+        # /P is the page itself and /Dest the next page of the same source file
+        assert annotation.raw_get("/P").idnum == page_ids[index]
+        first = index - index % 5
+        assert annotation["/Dest"][0].idnum == page_ids[first + (index + 1) % 5]
+
+
+def test_merge_writes_bookmarks_and_shared_streams_once(tmp_path):
+    pdf_files = []
+    for name in ["a", "b"]:
+        pdf_files.append(str(tmp_path / f"{name}.pdf"))
+        write_linked_pdf(pdf_files[-1], 2, "same")
+    output_pdf = str(tmp_path / "book.pdf")
+
+    ebook_project.merge_pdfs(pdf_files, output_pdf, ["First", "Second"])
+
+    reader = PyPDF2.PdfReader(output_pdf)
+    assert [item.title for item in reader.outline] == ["First", "Second"]
+    # Both files have the same page contents, so each content stream is written once
+    assert len(reader.pages) == 4
+    with open(output_pdf, "rb") as file:
+        assert file.read().count(b"BT /F1 18 Tf") == 2
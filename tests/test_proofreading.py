@@ -0,0 +1,53 @@
+import ebook_project
+
+REPEATED = "Good soil holds water and air, feeds the roots and keeps the plants growing strong through the whole season."
+NEARLY_REPEATED = "Good soil holds water and air, feeds the roots and keeps the plants growing strong through the whole year."
+
+
+def test_near_duplicates_are_found_with_their_offsets(make_chapters):
+    chapters = make_chapters([
+        f"# Soil\n\n{REPEATED}\n\nCompost is made from kitchen scraps, leaves and grass clippings left to rot over many months.",
+        f"# Water\n\nDrip lines put water at the roots so less of it evaporates on hot summer afternoons in the garden.\n\n{NEARLY_REPEATED}\n\nShort line."
+    ])
+
+    duplicates = ebook_project.find_near_duplicates(chapters)
+    assert len(duplicates) == 1
+    duplicate = duplicates[0]
+    assert duplicate["chapter"] == chapters[1].title
+    assert duplicate["original_chapter"] == chapters[0].title
+    assert duplicate["passage"] == NEARLY_REPEATED
+    assert chapters[1].content[duplicate["start"]:duplicate["start"] + len(NEARLY_REPEATED)] == NEARLY_REPEATED
+    assert 0.35 <= duplicate["similarity"] < 1
+
+
+def test_near_duplicate_signatures_are_stable():
+    first, second = ebook_project.NearDuplicateIndex(), ebook_project.NearDuplicateIndex()
+    shingles = first.shingles(REPEATED)
+    assert first.signature(shingles) == second.signature(shingles)
+    # Paragraphs too short to compare are not indexed
+    assert first.shingles("Too short to compare.") == set()
+
+
+def test_llm_proofreading_only_checks_the_edited_chapter_again(make_chapters, monkeypatch):
+    monkeypatch.setattr(ebook_project, "proofread_mode", "llm")
+    chapters = make_chapters([
+        f"# Part {number}\n\nParagraph {number} about gardens. It has a second sentence.\n\nAnother paragraph of part {number}."
+        for number in range(1, 11)
+    ])
+    proofreader = ebook_project.ProofreaderAgent()
+    analyzed = []
+    analyze_section = proofreader.analyze_section
+
+    def count_section(chapter_title, section, digest):
+        analyzed.append(chapter_title)
+        return analyze_section(chapter_title, section, digest)
+
+    monkeypatch.setattr(proofreader, "analyze_section", count_section)
+    proofreader.execute_task(chapters)
+    assert len(analyzed) == 10
+
+    # Editing the first sentence of chapter 1 changes the digest every later chapter is checked against
+    chapters[0].save(chapters[0].content.replace("Paragraph 1 about gardens.", "Paragraph 1 about orchards."))
+    analyzed.clear()
+    proofreader.execute_task(chapters)
+    assert analyzed == [chapters[0].title]
@@ -0,0 +1,73 @@
+import json
+
+import ebook_project
+
+DOCUMENTS = [
+    {"title": "Bees", "url": "https://example.com/bees", "content": "Honey bees pollinate crops. A hive holds one queen and thousands of worker bees."},
+    {"title": "Soil", "url": "https://example.com/soil", "content": "Compost improves soil structure. Worms mix compost into the soil."},
+    {"title": "Water", "url": "https://example.com/water", "content": "Drip irrigation saves water in dry gardens."},
+]
+
+
+def test_index_ranks_the_relevant_passage_first():
+    index = ebook_project.ResearchIndex(chunk_chars=200)
+    for document in DOCUMENTS:
+        index.add_document(document)
+
+    results = index.search("compost for the soil", 2)
+    assert results[0]["url"] == "https://example.com/soil"
+    assert results[0]["score"] > 0
+    assert index.search("", 3) == []
+
+
+def test_index_skips_repeated_pages_and_passages():
+    index = ebook_project.ResearchIndex(chunk_chars=200)
+    index.add_document(DOCUMENTS[0])
+    index.add_document(DOCUMENTS[0])
+    # The same passage on another page is indexed once
+    index.add_document(dict(DOCUMENTS[0], url="https://example.com/mirror"))
+    assert len(index.chunks) == 1
+
+
+def test_chapter_research_sends_only_the_top_passages():
+    index = ebook_project.ResearchIndex(chunk_chars=200)
+    for document in DOCUMENTS:
+        index.add_document(document)
+    research_data = {"query": "Gardening", "answer": "Gardens need care.", "results": DOCUMENTS}
+
+    chapter_research = index.chapter_research(research_data, "CHAPTER 02 - Watering with Drip Irrigation", k=1)
+    assert chapter_research["query"] == "Gardening"
+    assert chapter_research["answer"] == "Gardens need care."
+    assert [source["url"] for source in chapter_research["sources"]] == ["https://example.com/water"]
+
+
+def test_local_tavily_answers_like_tavily(tmp_path):
+    for number, document in enumerate(DOCUMENTS):
+        (tmp_path / f"{number}.md").write_text(f"# {document['title']}\n\n{document['content']}")
+    (tmp_path / "notes.json").write_text("{}")
+    tavily = ebook_project.LocalTavily.from_folder(str(tmp_path))
+    assert len(tavily.documents) == 3
+
+    response = tavily.search("honey bees", max_results=2, include_raw_content=True)
+    assert set(response) == {"query", "answer", "images", "results", "response_time", "follow_up_questions"}
+    assert response["results"][0]["title"] == "Bees"
+    assert response["results"][0]["raw_content"].startswith("# Bees")
+    assert len(response["results"]) <= 2
+    assert len({result["url"] for result in response["results"]}) == len(response["results"])
+
+
+def test_research_corpus_is_kept_out_of_the_manifest(tmp_path):
+    folder = str(tmp_path)
+    manifest = ebook_project.RunManifest(folder)
+    manifest.save_research(DOCUMENTS)
+    manifest.mark_chapter("CHAPTER 01 - Bees", "CHAPTER_01_-_Bees.md", "content")
+
+    with open(tmp_path / "manifest.json") as file:
+        assert json.load(file)["research_documents"] == "research.json"
+    assert ebook_project.RunManifest.load(folder).load_research() == DOCUMENTS
+
+    # Manifests of older runs hold the documents themselves
+    assert ebook_project.RunManifest(folder, {"research_documents": DOCUMENTS}).load_research() == DOCUMENTS
+    # The research is done again when its file is gone
+    (tmp_path / "research.json").unlink()
+    assert ebook_project.RunManifest.load(folder).load_research() is None
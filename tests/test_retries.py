@@ -0,0 +1,118 @@
+import threading
+import time
+
+import pytest
+
+import ebook_project
+
+
+class FakeResponse:
+    """HTTP response with a status code and headers, like the ones requests returns."""
+
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # No real waiting, and the jitter always takes its largest value so the delays are exact
+    slept = []
+    monkeypatch.setattr(ebook_project.time, "sleep", slept.append)
+    monkeypatch.setattr(ebook_project.random, "uniform", lambda low, high: high)
+    monkeypatch.setattr(ebook_project, "api_max_retries", 3)
+    monkeypatch.setattr(ebook_project, "api_backoff_base", 1)
+    monkeypatch.setattr(ebook_project, "api_backoff_max", 60)
+    return slept
+
+
+def responses(*results):
+    results = list(results)
+    return lambda: results.pop(0)
+
+
+def test_rate_limit_waits_for_retry_after_and_throttles(sleeps):
+    limiter = ebook_project.AdaptiveLimiter("Test", 8)
+    rate_limited = FakeResponse(429, {"retry-after": "2"})
+
+    result, retries = ebook_project.call_with_retries(responses(rate_limited, FakeResponse(200)), "test request", limiter)
+
+    assert result.status_code == 200
+    assert retries == 1
+    assert rate_limited.closed
+    assert sleeps == [2.5]
+    assert limiter.limit == 4
+
+
+def test_retry_after_ms_is_preferred(sleeps):
+    ebook_project.call_with_retries(responses(FakeResponse(503, {"retry-after-ms": "1500", "retry-after": "9"}), FakeResponse(200)), "test request")
+    assert sleeps == [2.0]
+
+
+def test_gives_up_after_the_maximum_retries(sleeps):
+    result, retries = ebook_project.call_with_retries(lambda: FakeResponse(503), "test request")
+    # The last response is returned to the caller with exponential backoff between the attempts
+    assert result.status_code == 503
+    assert retries == 3
+    assert sleeps == [1, 2, 4]
+
+    def drop_connection():
+        raise ebook_project.requests.exceptions.ConnectionError("connection reset")
+
+    sleeps.clear()
+    with pytest.raises(ebook_project.requests.exceptions.ConnectionError):
+        ebook_project.call_with_retries(drop_connection, "test request")
+    assert len(sleeps) == 3
+
+
+def test_errors_that_cannot_succeed_are_not_retried(sleeps):
+    result, retries = ebook_project.call_with_retries(lambda: FakeResponse(400), "test request")
+    assert (result.status_code, retries, sleeps) == (400, 0, [])
+
+
+def test_limiter_shrinks_on_rate_limits_and_grows_back():
+    limiter = ebook_project.AdaptiveLimiter("Test", 4)
+    limiter.observe({"x-ratelimit-remaining-requests": "2"})
+    assert limiter.limit == 2
+    limiter.observe({"x-ratelimit-remaining-tokens": "50", "x-ratelimit-limit-tokens": "1000"})
+    assert limiter.limit == 1
+    limiter.throttle("is rate limiting")
+    assert limiter.limit == 1
+
+    # One more request is allowed after four times the current limit of successes in a row
+    for _ in range(3):
+        limiter.observe({})
+    assert limiter.limit == 1
+    limiter.observe({})
+    assert limiter.limit == 2
+    for _ in range(8 + 12 + 100):
+        limiter.observe({})
+    assert limiter.limit == 4
+
+
+def test_limiter_caps_the_requests_in_flight():
+    limiter = ebook_project.AdaptiveLimiter("Test", 2)
+    in_flight = []
+    lock = threading.Lock()
+    current = [0]
+
+    def request():
+        with limiter:
+            with lock:
+                current[0] += 1
+                in_flight.append(current[0])
+            time.sleep(0.02)
+            with lock:
+                current[0] -= 1
+
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(in_flight) == 2
+    assert limiter.in_flight == 0
@@ -0,0 +1,42 @@
+import ebook_project
+
+RESEARCH = {"query": "Gardening", "answer": "Gardens need care.", "results": []}
+
+
+def test_choose_candidate_shows_drafts_before_keeping_one(monkeypatch, capsys):
+    candidates = ["# Draft one\n\nFirst text.", "# Draft two\n\nSecond text."]
+    answers = iter(["9", "d0", "d2", "v1", "2"])
+    monkeypatch.setattr("builtins.input", lambda prompt="": next(answers))
+
+    assert ebook_project.choose_candidate("CHAPTER 01 - One", "# Current\n\nText.", candidates) == candidates[1]
+    output = capsys.readouterr().out
+    assert output.count("Invalid choice") == 2
+    assert "First text." in output
+
+
+def test_choose_candidate_can_keep_the_current_draft(monkeypatch):
+    monkeypatch.setattr("builtins.input", lambda prompt="": "0")
+    assert ebook_project.choose_candidate("CHAPTER 01 - One", "# Current", ["# Draft one", "# Draft two"]) is None
+
+
+def test_candidates_are_written_by_one_request(tmp_path):
+    folder = str(tmp_path)
+    book = ebook_project.Book("Gardening", folder, ["CHAPTER 01 - Soil"], ebook_project.RunManifest(folder))
+    with ebook_project.metrics.labels(book=folder):
+        candidates = ebook_project.generate_chapter_candidates(book.chapters[0], ebook_project.WriterAgent(), RESEARCH, False, 3)
+
+    assert len(candidates) == 3
+    assert len(set(candidates)) == 3
+    assert all(ebook_project.summary_marker not in candidate for candidate in candidates)
+    calls = ebook_project.metrics.select(folder)
+    assert len(calls) == 1
+    assert calls[0]["kind"] == "chat"
+
+
+def test_estimate_grows_with_the_number_of_candidates():
+    writer = ebook_project.WriterAgent()
+    single = ebook_project.estimate_book_cost("Gardening", ["CHAPTER 01 - Soil"], writer, RESEARCH, proofread=False)
+    three = ebook_project.estimate_book_cost("Gardening", ["CHAPTER 01 - Soil"], writer, RESEARCH, proofread=False, candidates=3)
+    assert three["prompt_tokens"] == single["prompt_tokens"]
+    assert three["completion_tokens"] - single["completion_tokens"] == 2 * writer.max_tokens
+    assert ebook_project.chapter_candidates <= ebook_project.max_chapter_candidates
@@ -0,0 +1,58 @@
+import json
+
+import ebook_project
+
+REPEATED = "Good soil holds water and air, feeds the roots and keeps the plants growing strong through the whole season."
+
+
+class FakeWriter:
+    """Writer that answers every rewrite request with numbered replacement passages and keeps the prompts."""
+
+    def __init__(self):
+        self.prompts = []
+
+    def execute_task(self, task, research_data, kind="chapter"):
+        self.prompts.append(task)
+        count = task.count("Passage to rewrite:")
+        return json.dumps({str(number): f"Rewritten passage {len(self.prompts)}.{number}." for number in range(1, count + 1)})
+
+
+def test_repeated_passages_are_located_after_their_first_copy(make_chapters):
+    chapters = make_chapters([
+        f"# One\n\n{REPEATED}",
+        f"# Two\n\nIntro.\n\n{REPEATED}\n\nMore.\n\n{REPEATED}"
+    ])
+
+    locations = ebook_project.locate_repeated_passages(chapters, [REPEATED])
+    assert [(index, chapters[index].content[start:start + len(passage)]) for index, start, passage in locations] == [(1, REPEATED), (1, REPEATED)]
+    assert locations[0][1] < locations[1][1]
+
+
+def test_rewrites_are_spliced_in_place_with_local_context_only(make_chapters):
+    far_section = "# Far Away\n\nThis section is unrelated to the repeated passage and should not be sent."
+    chapters = make_chapters([
+        f"# One\n\n{REPEATED}",
+        f"# Two\n\nIntro.\n\n{REPEATED}\n\nMore.\n\n{REPEATED}\n\n{far_section}"
+    ])
+    writer = FakeWriter()
+
+    ebook_project.rewrite_repeated_content(chapters, [REPEATED], writer, {"answer": "Gardening."})
+
+    # Both copies in the second chapter are rewritten in one request, the first copy of the book stays
+    assert len(writer.prompts) == 1
+    assert "should not be sent" not in writer.prompts[0]
+    assert chapters[0].content == f"# One\n\n{REPEATED}"
+    assert chapters[1].content == f"# Two\n\nIntro.\n\nRewritten passage 1.1.\n\nMore.\n\nRewritten passage 1.2.\n\n{far_section}"
+    with open(chapters[1].path) as file:
+        assert file.read() == chapters[1].content
+
+
+def test_rewrites_are_read_from_fenced_or_broken_answers():
+    assert ebook_project.parse_rewrites('Here they are:\n```json\n{"1": " New text. ", "2": "Other"}\n```') == {"1": "New text.", "2": "Other"}
+    assert ebook_project.parse_rewrites("I could not rewrite these passages.") == {}
+
+
+def test_passage_context_stops_at_the_surrounding_headings():
+    content = "# One\n\nFirst section.\n\n## Two\n\nBefore. PASSAGE after.\n\n## Three\n\nLast section."
+    start = content.index("PASSAGE")
+    assert ebook_project.passage_context(content, start, start + len("PASSAGE")) == "## Two\n\nBefore. PASSAGE after."
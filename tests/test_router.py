@@ -0,0 +1,55 @@
+import pytest
+
+import ebook_project
+
+
+# Function to return a router over the real OpenAI backend (without an API key) and the mock backend
+def make_router(default_backend="openai"):
+    backends = {"openai": ebook_project.OpenAIBackend(), "mock": ebook_project.MockBackend(0, 0)}
+    return ebook_project.ModelRouter(backends, default_backend)
+
+
+def test_backends_and_models_are_chosen_from_env(monkeypatch):
+    monkeypatch.setenv("MODEL_CHAPTER", "mock:gpt-4o, gpt-4o-mini")
+    monkeypatch.setenv("MODEL_SUMMARY", "gpt-4o-mini")
+    router = make_router()
+
+    assert [(backend.name, model) for backend, model in router.route("chapter")] == [("mock", "gpt-4o"), ("openai", "gpt-4o-mini")]
+    assert [(backend.name, model) for backend, model in router.route("summary")] == [("openai", "gpt-4o-mini")]
+    # Tasks without a route of their own use the chapter models
+    assert router.route("unknown") == router.route("chapter")
+    assert router.primary_model("chapter") == "gpt-4o"
+    # MODEL_BACKEND=mock makes models without a prefix use the mock backend
+    assert make_router("mock").route("toc")[0][0].name == "mock"
+
+
+def test_a_failed_backend_falls_back_to_the_next_model(monkeypatch, capsys):
+    monkeypatch.setenv("MODEL_CHAPTER", "openai:gpt-4o,mock:gpt-4o")
+    monkeypatch.setattr(ebook_project, "model_router", make_router())
+    messages = [{"role": "user", "content": "Write a chapter about soil"}]
+
+    # Without an API key the OpenAI call fails and the mock backend answers
+    content = ebook_project.chat_completion(messages, 200, task="chapter")
+    assert content
+    assert "falling back to mock:gpt-4o" in capsys.readouterr().out
+
+
+def test_the_last_failure_is_raised(monkeypatch):
+    monkeypatch.setenv("MODEL_TOC", "openai:gpt-4o,openai:gpt-4o-mini")
+    router = make_router()
+    calls = []
+
+    def call(backend, model):
+        calls.append(model)
+        raise ebook_project.requests.exceptions.ConnectionError(f"{model} is down")
+
+    with pytest.raises(ebook_project.requests.exceptions.ConnectionError, match="gpt-4o-mini is down"):
+        router.run("toc", call)
+    assert calls == ["gpt-4o", "gpt-4o-mini"]
+
+    # Errors that are not API failures are not hidden by a fallback
+    def fail(backend, model):
+        raise ValueError("bad prompt")
+
+    with pytest.raises(ValueError):
+        router.run("toc", fail)
@@ -0,0 +1,71 @@
+import concurrent.futures
+
+import ebook_project
+
+
+class NoResearch:
+    """Researcher that finds nothing for the chapters, so drafts only use the topic research."""
+
+    def research_chapters(self, topic, chapter_titles):
+        return []
+
+
+# Function to return a speculator for a book in a temporary folder, drafting with the mock backend
+def make_speculator(folder, max_chapters=3, max_cost=10.0):
+    research_data = {"query": "Gardening", "answer": "Gardens need care.", "results": []}
+    manifest = ebook_project.RunManifest(str(folder))
+    return ebook_project.ChapterSpeculator("Gardening", str(folder), manifest, ebook_project.WriterAgent(), NoResearch(), research_data, max_chapters, max_cost)
+
+
+# Function to wait until every draft started so far is finished
+def wait_drafts(speculator):
+    with speculator.lock:
+        futures = [future for future, cancelled in speculator.drafts.values()]
+    concurrent.futures.wait(futures)
+
+
+def test_drafts_of_titles_kept_in_a_modified_toc_are_used(tmp_path):
+    folder = str(tmp_path)
+    with ebook_project.metrics.labels(book=folder):
+        speculator = make_speculator(tmp_path)
+        speculator.update(["CHAPTER 01 - A", "CHAPTER 02 - B", "CHAPTER 03 - C"])
+        wait_drafts(speculator)
+        # A chapter inserted at the top moves C out of the first three, its finished draft is kept
+        speculator.update(["CHAPTER 00 - Intro", "CHAPTER 01 - A", "CHAPTER 02 - B", "CHAPTER 03 - C"])
+        wait_drafts(speculator)
+        # B is removed, its draft is thrown away, and C stays out of the first three
+        toc = ["CHAPTER 00 - Intro", "CHAPTER 01 - A", "CHAPTER 02 - D", "CHAPTER 03 - C"]
+        speculator.update(toc)
+        wait_drafts(speculator)
+        book = ebook_project.Book("Gardening", folder, toc, speculator.manifest)
+        drafts = speculator.collect(book.chapters)
+
+    assert sorted(drafts) == ["CHAPTER 00 - Intro", "CHAPTER 01 - A", "CHAPTER 02 - D", "CHAPTER 03 - C"]
+    content, summary = drafts["CHAPTER 03 - C"]
+    assert content
+
+
+def test_drafts_stop_at_the_spend_cap(tmp_path):
+    folder = str(tmp_path)
+    toc = ["CHAPTER 01 - A", "CHAPTER 02 - B", "CHAPTER 03 - C"]
+    with ebook_project.metrics.labels(book=folder):
+        speculator = make_speculator(tmp_path)
+        estimate = ebook_project.estimate_book_cost("Gardening", ["CHAPTER 01 - A"], speculator.writer, speculator.research_data, proofread=False)["cost"]
+
+        # A cap below the estimate of one chapter writes nothing
+        speculator.max_cost = estimate * 0.5
+        speculator.update(toc)
+        wait_drafts(speculator)
+        assert speculator.collect(ebook_project.Book("Gardening", folder, toc, speculator.manifest).chapters) == {}
+        assert speculator.spent() == 0
+
+    # A cap of one and a half chapters writes one chapter, or two if the first costs less than estimated
+    capped_folder = str(tmp_path / "capped")
+    with ebook_project.metrics.labels(book=capped_folder):
+        speculator = make_speculator(capped_folder, max_cost=estimate * 1.5)
+        speculator.update(toc)
+        wait_drafts(speculator)
+        drafts = speculator.collect(ebook_project.Book("Gardening", capped_folder, toc, speculator.manifest).chapters)
+        # Drafts running at the same time reserve their estimate, so together they stay under the cap
+        assert 1 <= len(drafts) < 3
+        assert speculator.spent() <= estimate * 1.5
@@ -0,0 +1,39 @@
+import contextlib
+
+import pytest
+
+import ebook_project
+
+
+class InterruptedBackend:
+    """Backend that is interrupted with Ctrl+C after the first tokens, or while the stream is still being opened."""
+
+    name = "test"
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.limiter = contextlib.nullcontext()
+
+    def stream_chat(self, model, messages, max_tokens, task):
+        if not self.tokens:
+            raise KeyboardInterrupt
+
+        def events():
+            for token in self.tokens:
+                yield {"text": token}
+            raise KeyboardInterrupt
+
+        return events(), 0
+
+
+@pytest.mark.parametrize("tokens", [[], ["Chapter ", "one"]])
+def test_ctrl_c_aborts_the_generation(tokens):
+    received = []
+    messages = [{"role": "user", "content": "Write a chapter"}]
+
+    with pytest.raises(ebook_project.GenerationAborted) as aborted:
+        ebook_project.stream_chat_completion(InterruptedBackend(tokens), "gpt-4o", messages, 100, "chapter", received.append)
+
+    # The text received before Ctrl+C is kept
+    assert aborted.value.partial_content == "".join(tokens)
+    assert received == tokens
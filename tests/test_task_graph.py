@@ -0,0 +1,92 @@
+import concurrent.futures
+import threading
+import time
+
+import pytest
+
+import ebook_project
+
+
+@pytest.fixture
+def graph():
+    graph = ebook_project.TaskGraph({"llm": 4, "render": 1})
+    yield graph
+    graph.close()
+
+
+def test_tasks_run_after_the_tasks_they_wait_for(graph):
+    order = []
+    lock = threading.Lock()
+
+    def step(name, seconds=0.0):
+        time.sleep(seconds)
+        with lock:
+            order.append(name)
+        return name
+
+    a = graph.add("a", step, "a", 0.05)
+    b = graph.add("b", step, "b", 0.02, after=[a])
+    c = graph.add("c", step, "c", after=[a])
+    d = graph.add("d", step, "d", after=[b, c])
+
+    assert d.result(timeout=5) == "d"
+    assert order[0] == "a" and order[-1] == "d"
+    assert sorted(order[1:3]) == ["b", "c"]
+    # A task added again under the same name is the first one
+    assert graph.add("a", step, "other") is a
+
+
+def test_a_failure_reaches_every_task_waiting_for_it(graph):
+    ran = []
+
+    def fail():
+        raise RuntimeError("chapter failed")
+
+    a = graph.add("a", fail)
+    b = graph.add("b", ran.append, "b", after=[a])
+    c = graph.add("c", ran.append, "c", after=[b])
+
+    with pytest.raises(RuntimeError, match="chapter failed"):
+        c.result(timeout=5)
+    assert isinstance(b.exception(timeout=5), RuntimeError)
+    assert ran == []
+
+
+def test_cancelled_tasks_cancel_the_tasks_waiting_for_them(graph):
+    release = threading.Event()
+    ran = []
+    a = graph.add("a", release.wait, 5)
+    b = graph.add("b", ran.append, "b", after=[a])
+    c = graph.add("c", ran.append, "c", after=[b])
+
+    # Tasks that have not started are dropped, the running one finishes
+    graph.cancel()
+    release.set()
+    assert a.result(timeout=5) is True
+    assert b.cancelled() and c.cancelled()
+
+    # A task waiting for a cancelled task is cancelled when it would start
+    d = graph.add("d", ran.append, "d", after=[b])
+    e = graph.add("e", ran.append, "e", after=[d])
+    concurrent.futures.wait([d, e], timeout=5)
+    assert d.cancelled() and e.cancelled()
+    assert ran == []
+
+
+def test_each_resource_runs_at_most_its_limit_of_tasks(graph):
+    running = [0]
+    most = [0]
+    lock = threading.Lock()
+
+    def render():
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    tasks = [graph.add(f"render {number}", render, resource="render") for number in range(4)]
+    for task in tasks:
+        task.result(timeout=5)
+    assert most[0] == 1